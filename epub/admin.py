@@ -1 +1,10 @@
 from django.contrib import admin
+
+from epub.models import BuildJob
+
+class BuildJobAdmin(admin.ModelAdmin):
+    list_display = ('product', 'status', 'priority', 'created', 'started', 'finished')
+    list_filter = ('status',)
+    search_fields = ('product',)
+
+admin.site.register(BuildJob, BuildJobAdmin)
@@ -0,0 +1,616 @@
+"""
+Helpers for writing the zip container of an ePub.
+
+The standard :class:`zipfile.ZipFile` seeks backwards to patch the header of
+every file it adds, so it can only write to real files. :class:`EPubZipFile`
+never seeks, which lets an ePub be written to any object with a ``write``
+method, or be drained chunk by chunk through a :class:`ZipStream`.
+"""
+import os
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+
+try:
+    from hashlib import sha1 as sha_constructor
+except ImportError:
+    from sha import new as sha_constructor
+
+# Files bigger than this are copied into the archive ``CHUNK_SIZE`` bytes at
+# a time, instead of being read whole.
+STREAM_THRESHOLD = 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+
+class StreamWriter(object):
+    """
+    Wraps a write-only stream (a socket, an ``HttpResponse``, ``sys.stdout``)
+    and keeps track of the number of bytes written, which is all
+    :class:`zipfile.ZipFile` needs to know about its position. Whatever is
+    written also goes to ``copy``, if given.
+    """
+    def __init__(self, fileobj, copy=None):
+        self.fileobj = fileobj
+        self.copy = copy
+        self.position = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        if hasattr(self.fileobj, 'flush'):
+            self.fileobj.flush()
+
+
+class ZipStream(object):
+    """
+    A write-only buffer that holds what has been written since it was last
+    drained. Used to turn the archive into an iterator of chunks. Whatever is
+    written also goes to ``copy``, if given.
+    """
+    def __init__(self, copy=None):
+        self._chunks = []
+        self.copy = copy
+        self.size = 0
+        self.position = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        if self.copy is not None:
+            self.copy.write(data)
+        self.size += len(data)
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """
+        Returns everything written since the last call and empties the buffer.
+        """
+        data = ''.join(self._chunks)
+        self._chunks = []
+        self.size = 0
+        return data
+
+
+class CompressionPolicy(object):
+    """
+    Decides how each entry of the archive is compressed, by media type.
+
+    Entries are deflated at ``level`` (``1`` is the fastest, ``9`` the
+    smallest), except the media types that ``rules`` map to
+    ``zipfile.ZIP_STORED``. By default, those are images that are already
+    compressed, since deflating them again costs time and saves nothing.
+    ``rules`` can also map a media type to ``zipfile.ZIP_DEFLATED``.
+    """
+    default_rules = {
+        'image/jpeg': zipfile.ZIP_STORED,
+        'image/png': zipfile.ZIP_STORED,
+        'image/gif': zipfile.ZIP_STORED,
+    }
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, rules=None):
+        self.level = level
+        self.rules = dict(self.default_rules)
+        self.rules.update(rules or {})
+
+    def get_compress_type(self, mime_type):
+        return self.rules.get(mime_type, zipfile.ZIP_DEFLATED)
+
+    def get_fingerprint(self, fingerprint):
+        """
+        Adds the compression level to an entry's fingerprint, so an entry
+        compressed at another level is not reused by an incremental build.
+        """
+        if fingerprint and self.level != zlib.Z_DEFAULT_COMPRESSION:
+            return '%s@%d' % (fingerprint, self.level)
+        return fingerprint
+
+# Ready made policies: ``fast`` for previews, ``max`` for final downloads.
+PROFILES = {
+    'default': CompressionPolicy(),
+    'fast': CompressionPolicy(level=1),
+    'max': CompressionPolicy(level=9),
+}
+
+
+def get_policy(policy):
+    """
+    Returns ``policy`` if it is a :class:`CompressionPolicy`, or the profile of
+    that name in :data:`PROFILES`. ``None`` is the ``default`` profile.
+    """
+    if policy is None:
+        return PROFILES['default']
+    if isinstance(policy, basestring):
+        try:
+            return PROFILES[policy]
+        except KeyError:
+            raise ValueError("Unknown compression profile %r. Use one of %s." % (policy, ', '.join(sorted(PROFILES.keys()))))
+    return policy
+
+
+def file_fingerprint(filepath):
+    """
+    A cheap fingerprint of the file at ``filepath``, from its size and
+    modification time, used to tell whether it changed since the last build.
+    """
+    st = os.stat(filepath)
+    return '%d:%d' % (st.st_size, int(st.st_mtime))
+
+
+# The digests of the files hashed so far, by path, size and modification time
+_hash_cache = {}
+_HASH_CACHE_SIZE = 10000
+
+def hash_file(filepath, chunk_size=CHUNK_SIZE):
+    """
+    Returns the SHA-1 hex digest of the file at ``filepath``. The digest is
+    remembered until the file changes size or modification time.
+    """
+    st = os.stat(filepath)
+    key = (filepath, st.st_size, st.st_mtime)
+    digest = _hash_cache.get(key)
+    if digest is not None:
+        return digest
+    sha = sha_constructor()
+    f = open(filepath, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            sha.update(chunk)
+    finally:
+        f.close()
+    if len(_hash_cache) >= _HASH_CACHE_SIZE:
+        _hash_cache.clear()
+    digest = _hash_cache[key] = sha.hexdigest()
+    return digest
+
+
+def compress_entry(arcname, data, compress_type, date_time, fingerprint=None, stats=None, level=zlib.Z_DEFAULT_COMPRESSION):
+    """
+    Compresses ``data`` for the entry ``arcname`` without touching an archive,
+    so it can be done in any thread. Unicode data is encoded to ASCII using
+    XML character references, so it is safe whatever encoding the document
+    declares.
+
+    The optional ``fingerprint`` is stored as the comment of the entry, so a
+    later build can tell whether the entry can be copied from this archive.
+    See :class:`PreviousArchive`. If a ``stats`` dict is given, the seconds
+    spent encoding and compressing are stored in it as ``encode`` and
+    ``compress``. ``level`` is the deflate level, from ``1`` to ``9``.
+
+    :returns: The :class:`zipfile.ZipInfo` for the entry and the compressed bytes
+    :rtype: ``tuple``
+    """
+    start = time.time()
+    if isinstance(data, unicode):
+        data = data.encode('ascii', 'xmlcharrefreplace')
+    encoded = time.time()
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = 0600 << 16
+    zinfo.compress_type = compress_type
+    if isinstance(fingerprint, unicode):
+        fingerprint = fingerprint.encode('utf-8')
+    zinfo.comment = fingerprint or ''
+    zinfo.file_size = len(data)
+    zinfo.CRC = zlib.crc32(data) & 0xffffffff
+    if compress_type == zipfile.ZIP_DEFLATED:
+        co = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = co.compress(data) + co.flush()
+    zinfo.compress_size = len(data)
+    if stats is not None:
+        stats['encode'] = stats.get('encode', 0.0) + encoded - start
+        stats['compress'] = stats.get('compress', 0.0) + time.time() - encoded
+    return zinfo, data
+
+
+def _iter_buffered(chunks, size):
+    """
+    Joins the small strings yielded by ``chunks`` into strings of at least
+    ``size`` characters, except the last one.
+    """
+    buffered = []
+    length = 0
+    for chunk in chunks:
+        buffered.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            yield ''.join(buffered)
+            buffered = []
+            length = 0
+    if buffered:
+        yield ''.join(buffered)
+
+
+def read_compressed(zf, zinfo):
+    """
+    Returns the data of the entry ``zinfo`` in the :class:`zipfile.ZipFile`
+    ``zf`` as it is stored, without decompressing it.
+    """
+    zf.fp.seek(zinfo.header_offset, 0)
+    fheader = struct.unpack(zipfile.structFileHeader, zf.fp.read(zipfile.sizeFileHeader))
+    if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+        raise zipfile.BadZipfile("Bad magic number for file header")
+    zf.fp.read(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH])
+    return zf.fp.read(zinfo.compress_size)
+
+
+def copy_entry(old, arcname, date_time):
+    """
+    Returns a new :class:`zipfile.ZipInfo` for the entry ``arcname``, with the
+    timestamp ``date_time``, whose compressed data is the same as that of
+    ``old``. The same ``ZipInfo`` cannot be written to two archives, since
+    each records its offset in it.
+    """
+    zinfo = zipfile.ZipInfo(arcname, date_time)
+    zinfo.external_attr = old.external_attr
+    zinfo.compress_type = old.compress_type
+    zinfo.comment = old.comment
+    zinfo.CRC = old.CRC
+    zinfo.file_size = old.file_size
+    zinfo.compress_size = old.compress_size
+    return zinfo
+
+
+class PreviousArchive(object):
+    """
+    An earlier build of an ePub, whose unchanged entries are copied into a new
+    archive as they are stored, without rendering or compressing them again.
+
+    An entry is unchanged when it was written with the same fingerprint (see
+    :func:`compress_entry`). Entries without a fingerprint are never reused.
+    """
+    def __init__(self, file):
+        self.zipfile = zipfile.ZipFile(file)
+        self._lock = threading.Lock()
+
+    def has(self, arcname, fingerprint, compress_type=None):
+        """
+        Tells whether the entry ``arcname`` can be reused: it exists and was
+        written with ``fingerprint`` and, if given, ``compress_type``.
+        """
+        if not fingerprint:
+            return False
+        try:
+            old = self.zipfile.getinfo(arcname)
+        except KeyError:
+            return False
+        if compress_type is not None and old.compress_type != compress_type:
+            return False
+        if isinstance(fingerprint, unicode):
+            fingerprint = fingerprint.encode('utf-8')
+        return old.comment == fingerprint
+
+    def get(self, arcname, fingerprint, date_time, compress_type=None):
+        """
+        Returns the entry ``arcname`` in the same form as
+        :func:`compress_entry`, or ``None`` if it cannot be reused. See
+        :meth:`PreviousArchive.has`.
+        """
+        if not self.has(arcname, fingerprint, compress_type):
+            return None
+        old = self.zipfile.getinfo(arcname)
+        self._lock.acquire()
+        try:
+            data = read_compressed(self.zipfile, old)
+        finally:
+            self._lock.release()
+        return copy_entry(old, arcname, date_time), data
+
+    def close(self):
+        self.zipfile.close()
+
+
+class SharedParts(object):
+    """
+    Compressed entries shared by archives built at the same time, such as
+    the editions of a :class:`epub.fanout.FanOutBuilder`. Each part is made
+    once, by the first archive that needs it; archives asking for it
+    meanwhile wait for it rather than making it again.
+
+    Parts are kept until :meth:`SharedParts.clear` is called, so they should
+    be shared only for as long as the builds last.
+    """
+    def __init__(self):
+        self._parts = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self.made = 0
+        self.shared = 0
+
+    def get(self, key, arcname, date_time, make, stats=None):
+        """
+        Returns the part stored under ``key`` in the same form as
+        :func:`compress_entry`, for the entry ``arcname`` with the timestamp
+        ``date_time``. If there is no such part yet, it is made by calling
+        ``make``. ``reused`` is set in ``stats`` if the part was made for
+        another archive.
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                part = self._parts.get(key)
+                event = None
+                if part is None:
+                    event = self._pending.get(key)
+                    if event is None:
+                        self._pending[key] = threading.Event()
+                else:
+                    self.shared += 1
+            finally:
+                self._lock.release()
+            if part is not None:
+                if stats is not None:
+                    stats['reused'] = True
+                return copy_entry(part[0], arcname, date_time), part[1]
+            if event is None:
+                break
+            event.wait()
+        try:
+            part = make()
+            self._lock.acquire()
+            try:
+                self._parts[key] = part
+                self.made += 1
+            finally:
+                self._lock.release()
+        finally:
+            self._lock.acquire()
+            try:
+                event = self._pending.pop(key)
+            finally:
+                self._lock.release()
+            event.set()
+        return part
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._parts = {}
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._parts)
+
+
+class EPubZipFile(zipfile.ZipFile):
+    """
+    A write-only :class:`zipfile.ZipFile` that never seeks. ``file`` can be a
+    path or any object with a ``write`` method.
+
+    Every entry gets the same timestamp, ``date_time``, which defaults to the
+    time the archive was created. Entries are compressed according to
+    ``policy``, a :class:`CompressionPolicy` or the name of one of the
+    :data:`PROFILES`.
+    """
+    def __init__(self, file, date_time=None, policy=None):
+        if not isinstance(file, basestring) and not isinstance(file, (StreamWriter, ZipStream)):
+            file = StreamWriter(file)
+        zipfile.ZipFile.__init__(self, file, 'w', zipfile.ZIP_DEFLATED)
+        self.date_time = date_time or time.localtime(time.time())[:6]
+        self.policy = get_policy(policy)
+
+    def write_data(self, arcname, data, compress_type=None, stats=None, mime_type=None):
+        """
+        Adds ``data`` to the archive as ``arcname``. See :func:`compress_entry`.
+        Unless ``compress_type`` is given, the policy decides from
+        ``mime_type``.
+
+        :returns: The :class:`zipfile.ZipInfo` of the new entry
+        """
+        if compress_type is None:
+            compress_type = self.policy.get_compress_type(mime_type)
+        zinfo, data = compress_entry(arcname, data, compress_type, self.date_time, stats=stats, level=self.policy.level)
+        self.write_compressed(zinfo, data)
+        return zinfo
+
+    def write_compressed(self, zinfo, data):
+        """
+        Adds an entry whose data is already compressed, as returned by
+        :func:`compress_entry`. ``zinfo`` must have its ``CRC``,
+        ``file_size`` and ``compress_size`` set.
+        """
+        self._write_entry(zinfo, [data])
+
+    def _write_entry(self, zinfo, chunks):
+        if not self.fp:
+            raise RuntimeError("Attempt to write to ZIP archive that was already closed")
+        zinfo.header_offset = self.fp.tell()
+        self._writecheck(zinfo)
+        self._didModify = True
+        self.fp.write(zinfo.FileHeader())
+        for chunk in chunks:
+            self.fp.write(chunk)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
+
+    def write_chunks(self, arcname, chunks, compress_type=None, stats=None, mime_type=None):
+        """
+        Adds the data yielded by ``chunks`` to the archive as ``arcname``,
+        compressing it as it comes, so a large document never has to be
+        built as one string. Unicode chunks are encoded like
+        :func:`compress_entry` does. The compressed data is kept in a
+        temporary file that stays in memory only if it is small, until the
+        checksum and sizes needed in the header are known. The seconds spent
+        producing the chunks are stored in ``stats`` as ``render``.
+
+        :returns: The :class:`zipfile.ZipInfo` of the new entry
+        """
+        if stats is None:
+            stats = {}
+        if compress_type is None:
+            compress_type = self.policy.get_compress_type(mime_type)
+        encode = compress = 0.0
+        co = None
+        if compress_type == zipfile.ZIP_DEFLATED:
+            co = zlib.compressobj(self.policy.level, zlib.DEFLATED, -15)
+        spool = tempfile.SpooledTemporaryFile(STREAM_THRESHOLD)
+        crc = 0
+        file_size = 0
+        start = time.time()
+        try:
+            for chunk in _iter_buffered(chunks, CHUNK_SIZE):
+                started = time.time()
+                if isinstance(chunk, unicode):
+                    chunk = chunk.encode('ascii', 'xmlcharrefreplace')
+                encoded = time.time()
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                if co is not None:
+                    chunk = co.compress(chunk)
+                spool.write(chunk)
+                encode += encoded - started
+                compress += time.time() - encoded
+            if co is not None:
+                started = time.time()
+                spool.write(co.flush())
+                compress += time.time() - started
+            zinfo = zipfile.ZipInfo(arcname, self.date_time)
+            zinfo.external_attr = 0600 << 16
+            zinfo.compress_type = compress_type
+            zinfo.file_size = file_size
+            zinfo.CRC = crc & 0xffffffff
+            zinfo.compress_size = spool.tell()
+            spool.seek(0)
+            self._write_entry(zinfo, iter(lambda: spool.read(CHUNK_SIZE), ''))
+        finally:
+            spool.close()
+        stats['encode'] = stats.get('encode', 0.0) + encode
+        stats['compress'] = stats.get('compress', 0.0) + compress
+        stats['render'] = stats.get('render', 0.0) + time.time() - start - encode - compress
+        return zinfo
+
+    def write_file(self, filepath, arcname, compress_type=None, previous=None, stats=None, mime_type=None, shared=None):
+        """
+        Adds the contents of the file at ``filepath`` to the archive as
+        ``arcname``. The entry is copied from ``previous``, a
+        :class:`PreviousArchive`, if the file has not changed since, or taken
+        from ``shared``, a :class:`SharedParts`, if another archive compressed
+        it already. The
+        seconds spent reading the file are stored in ``stats`` as ``read``,
+        and ``reused`` is set if the entry was copied. ``compress_type`` and
+        ``mime_type`` are the same as for :meth:`EPubZipFile.write_data`.
+
+        Files bigger than ``STREAM_THRESHOLD`` are never held in memory as a
+        whole, nor shared. See :meth:`EPubZipFile.write_stream`.
+
+        :returns: The :class:`zipfile.ZipInfo` of the new entry
+        """
+        if stats is None:
+            stats = {}
+        if compress_type is None:
+            compress_type = self.policy.get_compress_type(mime_type)
+        fingerprint = self.policy.get_fingerprint(file_fingerprint(filepath))
+        if previous is not None:
+            entry = previous.get(arcname, fingerprint, self.date_time, compress_type)
+            if entry:
+                self.write_compressed(*entry)
+                stats['reused'] = True
+                return entry[0]
+        if os.path.getsize(filepath) > STREAM_THRESHOLD:
+            return self.write_stream(filepath, arcname, compress_type, fingerprint, stats)
+        if shared is not None:
+            key = ('file', filepath, fingerprint, compress_type, self.policy.level)
+            zinfo, data = shared.get(key, arcname, self.date_time,
+                lambda: self.compress_file(filepath, arcname, compress_type, fingerprint, stats), stats)
+        else:
+            zinfo, data = self.compress_file(filepath, arcname, compress_type, fingerprint, stats)
+        self.write_compressed(zinfo, data)
+        return zinfo
+
+    def compress_file(self, filepath, arcname, compress_type, fingerprint=None, stats=None):
+        """
+        Reads the file at ``filepath`` and compresses it for the entry
+        ``arcname`` like :func:`compress_entry`, without adding it to the
+        archive. The seconds spent reading it are stored in ``stats`` as
+        ``read``.
+        """
+        if stats is None:
+            stats = {}
+        start = time.time()
+        f = open(filepath, 'rb')
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        stats['read'] = stats.get('read', 0.0) + time.time() - start
+        return compress_entry(arcname, data, compress_type, self.date_time, fingerprint, stats, self.policy.level)
+
+    def write_stream(self, filepath, arcname, compress_type, fingerprint=None, stats=None):
+        """
+        Adds the file at ``filepath`` to the archive ``CHUNK_SIZE`` bytes at a
+        time. As the archive is never seeked, the checksum and sizes needed
+        in the header are worked out in a first pass over the file. A stored
+        file is then read again; a deflated one is kept compressed in a
+        temporary file that stays in memory only if it is small.
+
+        :returns: The :class:`zipfile.ZipInfo` of the new entry
+        """
+        if stats is None:
+            stats = {}
+        start = time.time()
+        compressed = None
+        compress = 0.0
+        if compress_type == zipfile.ZIP_DEFLATED:
+            co = zlib.compressobj(self.policy.level, zlib.DEFLATED, -15)
+            compressed = tempfile.SpooledTemporaryFile(STREAM_THRESHOLD)
+        crc = 0
+        file_size = 0
+        f = open(filepath, 'rb')
+        try:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+                if compressed is not None:
+                    started = time.time()
+                    compressed.write(co.compress(chunk))
+                    compress += time.time() - started
+            if compressed is not None:
+                compressed.write(co.flush())
+                compressed.seek(0)
+                source = compressed
+            else:
+                f.seek(0)
+                source = f
+
+            if isinstance(fingerprint, unicode):
+                fingerprint = fingerprint.encode('utf-8')
+            zinfo = zipfile.ZipInfo(arcname, self.date_time)
+            zinfo.external_attr = 0600 << 16
+            zinfo.compress_type = compress_type
+            zinfo.comment = fingerprint or ''
+            zinfo.file_size = file_size
+            zinfo.CRC = crc & 0xffffffff
+            if compressed is not None:
+                compressed.seek(0, 2)
+                zinfo.compress_size = compressed.tell()
+                compressed.seek(0)
+            else:
+                zinfo.compress_size = file_size
+            self._write_entry(zinfo, iter(lambda: source.read(CHUNK_SIZE), ''))
+        finally:
+            f.close()
+            if compressed is not None:
+                compressed.close()
+        stats['compress'] = stats.get('compress', 0.0) + compress
+        stats['read'] = stats.get('read', 0.0) + time.time() - start - compress
+        return zinfo
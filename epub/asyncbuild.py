@@ -0,0 +1,168 @@
+"""
+Generating an ePub without blocking the caller.
+
+:meth:`EPub.generate_epub_async` starts the build in a background thread and
+returns an :class:`AsyncBuild` right away. Article content, images and the
+archive are all read and written by that thread, so an event loop (Twisted,
+Tornado, ...) stays responsive. Progress comes back as build events, which
+can be iterated over, polled, or pushed to a callback.
+"""
+import threading
+import Queue
+
+from django.db import connection
+
+from epub.archive import PreviousArchive
+from epub.report import BuildReport
+
+
+class AsyncBuild(object):
+    """
+    A build of an :class:`EPub` running in a background thread.
+
+    Every build event is a dict whose ``type`` is one of:
+
+    * ``entry``: an entry was written. The other keys are those of a
+      :class:`epub.report.BuildReport` entry.
+    * ``finished``: the archive is complete. ``report`` is the
+      :class:`epub.report.BuildReport`.
+    * ``failed``: the build raised ``error``. The archive is incomplete.
+
+    ``finished`` or ``failed`` is always the last event.
+    """
+    def __init__(self, epub, filepath, workers=None, previous=None, callback=None):
+        self.epub = epub
+        self.filepath = filepath
+        self.workers = workers
+        self.previous = previous
+        self.callback = callback
+        self.report = None
+        self.error = None
+        self._events = Queue.Queue()
+        self._done = threading.Event()
+        self._done_callbacks = []
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.setDaemon(True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _emit(self, event):
+        self._events.put(event)
+        if self.callback is not None:
+            self.callback(event)
+
+    def _entry_written(self, entry):
+        event = dict(entry)
+        event['type'] = 'entry'
+        self._emit(event)
+
+    def _run(self):
+        report = BuildReport()
+        previous = None
+        epub = None
+        copy = None
+        last_event = None
+        try:
+            try:
+                self.epub._check_sources(self.filepath)
+                if self.previous is not None:
+                    previous = PreviousArchive(self.previous)
+                epub, copy = self.epub._open_archive(self.filepath)
+                for arcname in self.epub._write_epub(epub, self.workers, previous, report, self._entry_written):
+                    pass
+                epub.close()
+                epub = None
+                finishing, copy = copy, None
+                self.epub._finish(report, self.filepath, finishing)
+                self.report = report
+                last_event = {'type': 'finished', 'report': report}
+            except BaseException, e:
+                self.error = e
+                last_event = {'type': 'failed', 'error': e}
+                if not isinstance(e, Exception):
+                    raise
+        finally:
+            try:
+                if epub is not None:
+                    epub.close()
+                self.epub._discard_copy(copy)
+                if previous is not None:
+                    previous.close()
+                # The thread has a connection of its own
+                connection.close()
+            finally:
+                # The last event comes before the build is done, so whoever
+                # waits for it finds the event
+                try:
+                    self._emit(last_event)
+                finally:
+                    self._lock.acquire()
+                    try:
+                        self._done.set()
+                        callbacks, self._done_callbacks = self._done_callbacks, []
+                    finally:
+                        self._lock.release()
+        for func in callbacks:
+            func(self)
+
+    def done(self):
+        """
+        Tells whether the build has finished or failed.
+        """
+        return self._done.isSet()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the build is done, or ``timeout`` seconds have passed.
+
+        :returns: The :class:`epub.report.BuildReport`, or ``None`` if the
+                  build is still running
+        :raises: The error of the build, if it failed
+        """
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.report
+
+    def add_done_callback(self, func):
+        """
+        Calls ``func`` with this build once it is done, from the build thread,
+        or right away if it is already done. Use it to hand the result to an
+        event loop, e.g. with Twisted's ``reactor.callFromThread``.
+        """
+        self._lock.acquire()
+        try:
+            if not self._done.isSet():
+                self._done_callbacks.append(func)
+                return
+        finally:
+            self._lock.release()
+        func(self)
+
+    def poll(self):
+        """
+        Returns the events that happened since the last call, without
+        blocking.
+        """
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except Queue.Empty:
+                return events
+
+    def __iter__(self):
+        """
+        Iterates over the build events as they happen, until the build is
+        done. Blocks while waiting for the next event.
+        """
+        while True:
+            event = self._events.get()
+            if event['type'] in ('finished', 'failed'):
+                self._done.wait()
+                yield event
+                return
+            yield event
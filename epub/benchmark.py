@@ -0,0 +1,204 @@
+"""
+Benchmarks of generating large ePubs from synthetic editions.
+
+Run them with the ``epub_benchmark`` management command::
+
+    python manage.py epub_benchmark --sizes=10,1000,10000 --output=results.json
+
+Each edition is built in a child process, so the peak memory of one does not
+hide that of the next. Nothing is read from the database or the network.
+"""
+import os
+import random
+import shutil
+import tempfile
+import time
+import Queue
+
+DEFAULT_SIZES = (10, 1000, 10000)
+
+# How often the parent checks that a child process is still running
+POLL_SECONDS = 1
+
+FIRST_NAMES = (u'Charles', u'Mary Kate', u'Jos\xe9', u'Zo\xeb', u'Fran\xe7ois', u'Bj\xf6rn', u'Ana', u'Wei')
+LAST_NAMES = (u'Pearson', u'Van Hinder', u'Garc\xeda', u'St. James', u'M\xfcller', u'\xd8stergaard', u'de la Cruz', u'Li')
+WORDS = (u'lorem', u'ipsum', u'dolor', u'sit', u'amet', u'consectetur', u'adipiscing',
+         u'elit', u'na\xefve', u'caf\xe9', u'r\xe9sum\xe9', u'\u2014', u'\u201cquoted\u201d',
+         u'\u6771\u4eac', u'\u0417\u0434\u0440\u0430\u0432\u0441\u0442\u0432\u0443\u0439',
+         u'\u03b1\u03b2\u03b3', u'stra\xdfe', u'\u2026')
+
+
+def make_paragraph(rnd):
+    words = [rnd.choice(WORDS) for i in range(rnd.randint(20, 120))]
+    return u'<p>%s.</p>' % u' '.join(words).capitalize()
+
+
+def make_story(rnd, index):
+    """
+    A synthetic story, shaped like the ``Story`` model of the example project.
+    Stories vary from one paragraph to about 40KB of text.
+    """
+    paragraphs = rnd.choice((1, 3, 8, 20, 60))
+    return {
+        'headline': u'Story %d: %s' % (index, u' '.join([rnd.choice(WORDS) for i in range(6)])),
+        'subhead': rnd.choice((u'', u' '.join([rnd.choice(WORDS) for i in range(10)]))),
+        'byline': u'%s %s' % (rnd.choice(FIRST_NAMES), rnd.choice(LAST_NAMES)),
+        'story': u'\n'.join([make_paragraph(rnd) for i in range(paragraphs)]),
+        'slug': u'story-%d' % index,
+    }
+
+
+def make_images(rnd, directory, count):
+    """
+    Writes ``count`` incompressible files of varied size into ``directory``,
+    standing in for photos, and returns their paths.
+    """
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'photo%d.jpg' % i)
+        f = open(path, 'wb')
+        try:
+            length = rnd.choice((20, 100, 400)) * 1024
+            f.write(('%0*x' % (length * 2, rnd.getrandbits(length * 8))).decode('hex'))
+        finally:
+            f.close()
+        paths.append(path)
+    return paths
+
+
+def make_edition(size, directory, seed=0, images_per_article=0.1):
+    """
+    Returns an :class:`EPub` with ``size`` synthetic articles and about one
+    image for every ten articles, whose files are written into ``directory``.
+    """
+    from epub.models import EPub
+    rnd = random.Random(seed)
+    e = EPub()
+    e.date_time = (2009, 7, 5, 12, 0, 0)
+    e.metadata.set_unique_id(value='benchmark-%d-%d' % (size, seed), id='BookId')
+    e.metadata.title = u'Benchmark Edition of %d Articles' % size
+    e.metadata.publisher = u'Daily Times Publishing Inc'
+    e.metadata.add_date('2009-07-05')
+    for path in make_images(rnd, directory, int(size * images_per_article) or 1):
+        e.add_image(path)
+    for i in range(size):
+        story = make_story(rnd, i)
+        e.add_article(story['headline'], story, story['slug'] + '.html', story['byline'])
+    return e
+
+
+def peak_memory():
+    """
+    The peak resident memory of this process, in kilobytes.
+    """
+    import resource, sys
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes on OS X, kilobytes elsewhere
+        maxrss = maxrss / 1024
+    return maxrss
+
+
+def run_case(size, seed=0, workers=None):
+    """
+    Builds one edition of ``size`` articles and measures it.
+
+    :returns: The measurements, in seconds, bytes and kilobytes of memory
+    :rtype: ``dict``
+    """
+    directory = tempfile.mkdtemp(prefix='epub-benchmark-')
+    try:
+        start = time.time()
+        e = make_edition(size, directory, seed)
+        setup = time.time() - start
+
+        start = time.time()
+        unicode(e.metadata)
+        metadata = time.time() - start
+
+        path = os.path.join(directory, 'edition.epub')
+        start = time.time()
+        report = e.generate_epub(path, workers=workers)
+        generate = time.time() - start
+
+        stages = report.stages
+        return {
+            'size': size,
+            'workers': workers,
+            'setup_seconds': setup,
+            'metadata_seconds': metadata,
+            'generate_seconds': generate,
+            'article_seconds': stages.get('article', {}).get('seconds', 0.0),
+            'output_bytes': os.path.getsize(path),
+            'peak_memory_kb': peak_memory(),
+        }
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def _run_child(queue, size, seed, workers):
+    try:
+        queue.put(run_case(size, seed, workers))
+    except Exception, e:
+        queue.put(e)
+        raise
+
+
+def run_benchmarks(sizes=DEFAULT_SIZES, seed=0, workers=None):
+    """
+    Runs :func:`run_case` for each of ``sizes``, each in its own process.
+
+    :returns: A list of the measurements of each case
+    """
+    from multiprocessing import Process, Queue
+    results = []
+    for size in sizes:
+        queue = Queue()
+        child = Process(target=_run_child, args=(queue, size, seed, workers))
+        child.start()
+        result = _wait_for_result(child, queue)
+        child.join()
+        if isinstance(result, Exception):
+            raise result
+        results.append(result)
+    return results
+
+
+def _wait_for_result(child, queue):
+    """
+    Returns what ``child`` puts in ``queue``.
+
+    :raises: ``RuntimeError`` if the child died without a result, as when it
+             is killed by a signal or the out-of-memory killer
+    """
+    while True:
+        alive = child.is_alive()
+        try:
+            return queue.get(True, POLL_SECONDS)
+        except Queue.Empty:
+            if not alive:
+                break
+    child.join()
+    raise RuntimeError("The benchmark process stopped without a result, with exit code %s." % child.exitcode)
+
+
+def compare(results, baseline):
+    """
+    Compares two lists of measurements by edition size.
+
+    :returns: ``(size, key, baseline value, new value, ratio)`` for every
+              measurement present in both
+    :rtype: ``list``
+    """
+    old = dict([(case['size'], case) for case in baseline])
+    rows = []
+    for case in results:
+        if case['size'] not in old:
+            continue
+        for key in sorted(case.keys()):
+            if key in ('size', 'workers'):
+                continue
+            before, after = old[case['size']].get(key), case[key]
+            if before:
+                rows.append((case['size'], key, before, after, float(after) / before))
+    return rows
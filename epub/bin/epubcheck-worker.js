@@ -0,0 +1,47 @@
+/*
+ * A long-lived epubcheck worker, run by epub.epubcheck with jrunscript:
+ *
+ *     jrunscript -cp epubcheck-1.0.3.jar:lib/saxon.jar -f epubcheck-worker.js
+ *
+ * Once it has loaded epubcheck it writes
+ *
+ *     epubcheck<TAB>ready
+ *
+ * then reads the path of an ePub from each line of its input and validates it
+ * with the epubcheck library. For every error and warning it writes a line
+ *
+ *     epubcheck<TAB>message<TAB>error|warning<TAB>resource<TAB>line<TAB>text
+ *
+ * and then, once the ePub is checked,
+ *
+ *     epubcheck<TAB>done<TAB>true|false
+ *
+ * Other lines of output can be ignored. It exits at the end of its input.
+ */
+var input = new java.io.BufferedReader(new java.io.InputStreamReader(java.lang.System['in'], 'UTF-8'));
+var output = new java.io.PrintStream(java.lang.System.out, true, 'UTF-8');
+
+function clean(value) {
+    return String(value == null ? '' : value).replace(/[\t\r\n]+/g, ' ');
+}
+
+function send(severity, resource, line, message) {
+    output.println(['epubcheck', 'message', severity, clean(resource), line, clean(message)].join('\t'));
+}
+
+var report = new Packages.com.adobe.epubcheck.api.Report({
+    error: function(resource, line, message) { send('error', resource, line, message); },
+    warning: function(resource, line, message) { send('warning', resource, line, message); }
+});
+output.println(['epubcheck', 'ready'].join('\t'));
+
+var path;
+while ((path = input.readLine()) != null) {
+    var valid = false;
+    try {
+        valid = new Packages.com.adobe.epubcheck.api.EpubCheck(new java.io.File(path), report).validate();
+    } catch (e) {
+        send('error', '', -1, e);
+    }
+    output.println(['epubcheck', 'done', valid ? 'true' : 'false'].join('\t'));
+}
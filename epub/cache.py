@@ -0,0 +1,170 @@
+"""
+Caches of rendered articles, so an article included in many ePubs is only
+rendered once.
+
+An entry is keyed by the source of the article template and the
+``content_hash`` given to :meth:`EPub.add_article`. Articles without a
+``content_hash``, or rendered with a template passed to :class:`EPub`
+without a key in its ``template_keys``, are never cached. Use one with an
+:class:`EPub` by setting its ``article_cache``::
+
+    from epub.cache import LocMemArticleCache
+
+    article_cache = LocMemArticleCache(max_entries=5000)
+
+    e = EPub()
+    e.article_cache = article_cache
+"""
+import threading
+import time
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
+from django.utils.hashcompat import sha_constructor
+
+
+class ArticleCache(object):
+    """
+    The base class of the article caches. Subclasses implement ``_get`` and
+    ``_set``; this class keeps the ``hits`` and ``misses`` counters.
+    """
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, template_key, content_hash):
+        """
+        Returns the cache key for an article with ``content_hash`` rendered
+        with the template identified by ``template_key``.
+        """
+        return sha_constructor('%s:%s' % (template_key, content_hash)).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the rendered article stored under ``key``, or ``None``.
+        """
+        value = self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._set(key, value)
+
+    def clear(self):
+        """
+        Forgets every rendered article.
+        """
+        raise NotImplementedError
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, value):
+        raise NotImplementedError
+
+
+class LocMemArticleCache(ArticleCache):
+    """
+    A least-recently-used cache in the memory of the process. The oldest
+    entries are evicted when there are more than ``max_entries`` of them, or
+    when together they are bigger than ``max_bytes``. It is safe to share
+    between threads.
+    """
+    def __init__(self, max_entries=1000, max_bytes=None):
+        super(LocMemArticleCache, self).__init__()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        self._lock.acquire()
+        try:
+            value = self._entries.pop(key, None)
+            if value is not None:
+                # Move the entry to the end, as the most recently used
+                self._entries[key] = value
+            return value
+        finally:
+            self._lock.release()
+
+    def _set(self, key, value):
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._entries[key] = value
+            self.size += len(value)
+            while self._entries and (
+                (self.max_entries and len(self._entries) > self.max_entries) or
+                (self.max_bytes and self.size > self.max_bytes)):
+                oldest = iter(self._entries).next()
+                self.size -= len(self._entries.pop(oldest))
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+
+class DjangoArticleCache(ArticleCache):
+    """
+    Stores the rendered articles with Django's cache framework, so they can be
+    shared between processes and servers. ``cache`` is a cache backend, or
+    ``None`` to use the default one. Eviction is left to the backend; entries
+    expire after ``timeout`` seconds.
+
+    The keys hold a version number, also stored in the cache. Clearing the
+    cache moves to the next version, so the entries stored until then are
+    never read again and are left to expire.
+    """
+    def __init__(self, cache=None, timeout=None, key_prefix='epub-article'):
+        super(DjangoArticleCache, self).__init__()
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _get_version_key(self):
+        return '%s:version' % self.key_prefix
+
+    def _get_version(self):
+        version = self.cache.get(self._get_version_key())
+        if version is None:
+            # Should the version itself have expired, starting from the time
+            # keeps the entries of the earlier versions out of reach
+            self.cache.add(self._get_version_key(), int(time.time()))
+            version = self.cache.get(self._get_version_key())
+        return version
+
+    def _key(self, key):
+        return '%s:%s:%s' % (self.key_prefix, self._get_version(), key)
+
+    def _get(self, key):
+        return self.cache.get(self._key(key))
+
+    def _set(self, key, value):
+        self.cache.set(self._key(key), value, self.timeout)
+
+    def clear(self):
+        try:
+            self.cache.incr(self._get_version_key())
+        except ValueError:
+            self.cache.add(self._get_version_key(), int(time.time()))
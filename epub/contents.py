@@ -0,0 +1,216 @@
+"""
+The layout of the contents pages and of the navMap of an ePub.
+
+By default there is one contents page, ``contents.html``, listing every
+article, and the navMap of ``toc.ncx`` is flat. With hundreds of articles
+that page is slow for reading systems to open and lay out, so two settings
+change the layout:
+
+* ``EPub.contents_page_size`` caps the number of entries of a contents page.
+  Longer lists are continued on ``contents_2.html``, ``contents_3.html``, ...
+  each linking to the page before and after it.
+* Articles can be added with a ``section`` (see :meth:`EPub.add_article`).
+  Consecutive articles of the same section make one section of the edition,
+  so articles should be added section by section. ``contents.html`` then
+  lists the sections, continued on further pages if there are more of them
+  than ``contents_page_size``. Each section has contents pages of its own, read just
+  before its articles, and the navMap nests the articles of each section
+  under a ``navPoint`` for the section::
+
+    e = EPub()
+    e.contents_page_size = 50
+    for story in news:
+        e.add_article(story.headline, story.body, section='News')
+    for story in sports:
+        e.add_article(story.headline, story.body, section='Sports')
+
+Articles added without a section between sections are listed on pages of
+their own, and their ``navPoint`` is not nested.
+
+The contents pages are next to the articles in ``OEBPS/text``, so articles
+are never given the names in :data:`RESERVED_FILENAMES`.
+"""
+import re
+
+# The file names of the title and contents pages
+RESERVED_FILENAMES = re.compile(r'^(title_page|contents(_\d+)?)\.html$')
+
+
+class ContentsPage(object):
+    """
+    A contents page: its ``number``, counting from 1, the title of the
+    ``section`` it lists, if any, and the ``articles`` on it. The page
+    listing the sections has them in ``sections`` instead.
+    """
+    def __init__(self, number, section=None, articles=(), sections=None):
+        self.number = number
+        self.section = section
+        self.articles = articles
+        self.sections = sections
+        self.previous = None
+        self.next = None
+
+    def get_id(self):
+        if self.number == 1:
+            return 'contents'
+        return 'contents%d' % self.number
+    id = property(get_id)
+
+    def get_filename(self):
+        if self.number == 1:
+            return 'contents.html'
+        return 'contents_%d.html' % self.number
+    filename = property(get_filename)
+
+    def __repr__(self):
+        return '<ContentsPage: %s>' % self.filename
+
+
+class Section(object):
+    """
+    A run of consecutive articles with the same ``title`` as their section,
+    starting at the position ``start`` of the articles of the ePub.
+    """
+    def __init__(self, title, start, articles):
+        self.title = title
+        self.start = start
+        self.articles = articles
+        self.pages = []
+
+    def get_filename(self):
+        return self.pages[0].filename
+    filename = property(get_filename)
+
+
+class NavPoint(object):
+    """
+    A ``navPoint`` of the navMap, with the ``navPoint`` nested in it as its
+    ``children``.
+    """
+    __slots__ = ('id', 'play_order', 'title', 'filename', 'children')
+
+    def __init__(self, id, play_order, title, filename, children=()):
+        self.id = id
+        self.play_order = play_order
+        self.title = title
+        self.filename = filename
+        self.children = children
+
+
+def get_sections(articles):
+    """
+    Returns the :class:`Section` of ``articles``, or an empty list if none
+    of them has a section.
+    """
+    sections = []
+    has_titles = False
+    for position, article in enumerate(articles):
+        title = article['section']
+        has_titles = has_titles or title is not None
+        if sections and sections[-1].title == title:
+            sections[-1].articles.append(article)
+        else:
+            sections.append(Section(title, position, [article]))
+    if not has_titles:
+        return []
+    return sections
+
+
+class Contents(object):
+    """
+    The contents pages, spine and navMap of ``articles``, the articles of an
+    :class:`epub.models.EPub`.
+
+    :param page_size: Optional. The most articles or sections listed on one
+                      page. **Default:** all of them.
+    """
+    def __init__(self, articles, page_size=None):
+        self.articles = articles
+        self.page_size = page_size
+        self.sections = get_sections(articles)
+        self.pages = []
+        if self.sections:
+            for sections in self._split(self.sections):
+                self._add_page(sections=sections)
+            self._index_size = len(self.pages)
+            for section in self.sections:
+                section.pages = self._paginate(section.title, section.articles)
+        else:
+            self._paginate(None, articles)
+        for previous, page in zip(self.pages, self.pages[1:]):
+            previous.next = page
+            page.previous = previous
+
+    def _add_page(self, section=None, articles=(), sections=None):
+        page = ContentsPage(len(self.pages) + 1, section, articles, sections)
+        self.pages.append(page)
+        return page
+
+    def _split(self, items):
+        if not self.page_size or len(items) <= self.page_size:
+            return [items]
+        return [items[start:start + self.page_size] for start in xrange(0, len(items), self.page_size)]
+
+    def _paginate(self, section, articles):
+        return [self._add_page(section, part) for part in self._split(articles)]
+
+    def get_extra_pages(self):
+        """
+        Returns the pages after ``contents.html``, which the package file
+        adds to its manifest.
+        """
+        return self.pages[1:]
+    extra_pages = property(get_extra_pages)
+
+    def get_depth(self):
+        """
+        Returns the ``dtb:depth`` of the navMap.
+        """
+        for section in self.sections:
+            if section.title is not None:
+                return 2
+        return 1
+    depth = property(get_depth)
+
+    def iter_spine(self):
+        """
+        Yields the manifest ids of the spine after ``contents.html``.
+        """
+        if not self.sections:
+            for page in self.pages[1:]:
+                yield page.id
+            for position in xrange(len(self.articles)):
+                yield 'article%d' % (position + 1)
+            return
+        for page in self.pages[1:self._index_size]:
+            yield page.id
+        for section in self.sections:
+            for page in section.pages:
+                yield page.id
+            for position in xrange(section.start, section.start + len(section.articles)):
+                yield 'article%d' % (position + 1)
+
+    def iter_nav_points(self):
+        """
+        Yields the :class:`NavPoint` of the navMap after those of the title
+        and contents pages.
+        """
+        if not self.sections:
+            for position, article in enumerate(self.articles):
+                yield NavPoint('article%d' % (position + 1), position + 3, article['title'], article['filename'])
+            return
+        play_order = 3
+        for number, section in enumerate(self.sections):
+            if section.title is not None:
+                section_play_order = play_order
+                play_order += 1
+            children = []
+            for position, article in enumerate(section.articles):
+                children.append(NavPoint('article%d' % (section.start + position + 1), play_order,
+                    article['title'], article['filename']))
+                play_order += 1
+            if section.title is None:
+                for nav_point in children:
+                    yield nav_point
+            else:
+                yield NavPoint('section%d' % (number + 1), section_play_order, section.title, section.filename, children)
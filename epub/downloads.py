@@ -0,0 +1,213 @@
+"""
+Caches of finished ePub archives, for serving the same book many times.
+
+An archive is keyed by the fingerprint of its :class:`EPub` (see
+:meth:`EPub.get_fingerprint`), so it is built again only when something in
+it changed. When several requests ask for the same book that is not cached
+yet, only the first builds it; the others wait for it and share the result.
+"""
+import os
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+
+
+class CachedArchive(object):
+    """
+    A finished archive: its ``size`` in bytes, the time it was ``modified``
+    and either the ``path`` of the file or its ``data``.
+    """
+    def __init__(self, size, modified, path=None, data=None):
+        self.size = size
+        self.modified = modified
+        self.path = path
+        self.data = data
+
+    def open(self, chunk_size=64 * 1024):
+        """
+        Returns an iterator over the content of the archive.
+        """
+        if self.path is None:
+            return iter([self.data])
+        return _iter_file(self.path, chunk_size)
+
+
+def _iter_file(path, chunk_size):
+    f = open(path, 'rb')
+    try:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    finally:
+        f.close()
+
+
+class ArchiveCache(object):
+    """
+    The base class of the archive caches. Subclasses implement ``get`` and
+    ``build``.
+    """
+    def get(self, key):
+        """
+        Returns the :class:`CachedArchive` stored under ``key``, or ``None``.
+        """
+        raise NotImplementedError
+
+    def build(self, key, epub):
+        """
+        Generates ``epub``, stores it under ``key`` and returns the
+        :class:`CachedArchive`.
+        """
+        raise NotImplementedError
+
+
+class FileArchiveCache(ArchiveCache):
+    """
+    Keeps the archives as files in ``directory``. Archives are written to a
+    temporary file and then renamed, so another process never reads a half
+    written one. Old archives are not removed.
+
+    :param directory: **Default:** the ``EPUB_ARCHIVE_CACHE_DIR`` setting, or
+                      ``epub-archives`` in the temporary directory.
+    """
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = getattr(settings, 'EPUB_ARCHIVE_CACHE_DIR', None) or \
+                os.path.join(tempfile.gettempdir(), 'epub-archives')
+        self.directory = directory
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key[:2], '%s.epub' % key)
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return CachedArchive(st.st_size, st.st_mtime, path=path)
+
+    def build(self, key, epub):
+        path = self.get_path(key)
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Another process made it first
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                for chunk in epub.iter_epub():
+                    f.write(chunk)
+            finally:
+                f.close()
+            os.rename(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return self.get(key)
+
+
+class DjangoArchiveCache(ArchiveCache):
+    """
+    Keeps the archives in Django's cache framework, for small books served
+    from several servers. ``cache`` is a cache backend, or ``None`` to use
+    the default one. Entries expire after ``timeout`` seconds.
+    """
+    def __init__(self, cache=None, timeout=None, key_prefix='epub-archive'):
+        if cache is None:
+            from django.core.cache import cache
+        self.cache = cache
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def _key(self, key):
+        return '%s:%s' % (self.key_prefix, key)
+
+    def get(self, key):
+        value = self.cache.get(self._key(key))
+        if value is None:
+            return None
+        modified, data = value
+        return CachedArchive(len(data), modified, data=data)
+
+    def build(self, key, epub):
+        data = ''.join(epub.iter_epub())
+        modified = time.time()
+        self.cache.set(self._key(key), (modified, data), self.timeout)
+        return CachedArchive(len(data), modified, data=data)
+
+
+# The locks of the archives being built, with the number of threads using
+# each, so concurrent requests for the same archive wait for one build.
+_build_locks = {}
+_build_locks_lock = threading.Lock()
+
+def _acquire_build_lock(key):
+    _build_locks_lock.acquire()
+    try:
+        lock, users = _build_locks.get(key, (None, 0))
+        if lock is None:
+            lock = threading.Lock()
+        _build_locks[key] = (lock, users + 1)
+    finally:
+        _build_locks_lock.release()
+    lock.acquire()
+    return lock
+
+def _release_build_lock(key, lock):
+    lock.release()
+    _build_locks_lock.acquire()
+    try:
+        users = _build_locks[key][1] - 1
+        if users:
+            _build_locks[key] = (lock, users)
+        else:
+            del _build_locks[key]
+    finally:
+        _build_locks_lock.release()
+
+
+def get_archive(epub, archive_cache, key=None):
+    """
+    Returns the :class:`CachedArchive` of ``epub`` from ``archive_cache``,
+    building it if it is not there yet. Only one thread builds a given
+    archive at a time; the others wait for it.
+
+    :param key: The fingerprint of ``epub``, if it is known already.
+    :returns: The archive, or ``None`` if ``epub`` has no fingerprint
+    """
+    if key is None:
+        key = epub.get_fingerprint()
+        if key is None:
+            return None
+    archive = archive_cache.get(key)
+    if archive is not None:
+        return archive
+    lock = _acquire_build_lock(key)
+    try:
+        archive = archive_cache.get(key)
+        if archive is None:
+            archive = archive_cache.build(key, epub)
+        return archive
+    finally:
+        _release_build_lock(key, lock)
+
+
+_default_archive_cache = None
+
+def get_default_archive_cache():
+    """
+    Returns the :class:`FileArchiveCache` used when a view is not given one.
+    """
+    global _default_archive_cache
+    if _default_archive_cache is None:
+        _default_archive_cache = FileArchiveCache()
+    return _default_archive_cache
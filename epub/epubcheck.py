@@ -0,0 +1,392 @@
+"""
+Full validation of ePubs with the epubcheck jar in ``epub/bin``, for many
+ePubs at a time.
+
+Starting a JVM takes longer than checking most ePubs, so an
+:class:`EpubCheckPool` keeps its Java processes running and hands them one
+ePub after another::
+
+    from epub.epubcheck import EpubCheckPool
+
+    pool = EpubCheckPool(workers=4)
+    try:
+        for result in pool.validate_batch(paths):
+            if not result.valid:
+                print result.path
+                for problem in result.problems:
+                    print ' ', problem
+    finally:
+        pool.close()
+
+The long-lived workers run ``epub/bin/epubcheck-worker.js`` with
+``jrunscript``, which comes with the Java Development Kit. Without it, or if
+it cannot run the script (the ``jrunscript`` of Java 15 and later has no
+JavaScript engine), every ePub is checked by a new ``java -jar`` process, as
+before.
+
+A pool can also be the ``validator`` of an :class:`EPub`.
+"""
+import os
+import re
+import subprocess
+import threading
+import time
+import Queue
+from distutils.spawn import find_executable
+
+from epub.validation import Problem
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin')
+EPUBCHECK_JAR = os.path.join(BIN_DIR, 'epubcheck-1.0.3', 'epubcheck-1.0.3.jar')
+WORKER_SCRIPT = os.path.join(BIN_DIR, 'epubcheck-worker.js')
+
+# A line printed by ``java -jar epubcheck.jar``, such as
+# ``ERROR: book.epub/OEBPS/content.opf(12): element "foo" not allowed here``
+OUTPUT_LINE = re.compile(r'^(ERROR|WARNING): (.*?)(?:\((-?\d+)\))?: (.*)$')
+
+
+class EpubCheckError(Exception):
+    """
+    Raised when epubcheck could not be run at all.
+    """
+    pass
+
+
+class EpubCheckResult(object):
+    """
+    The outcome of checking the ePub at ``path``: the ``problems`` epubcheck
+    reported, as :class:`epub.validation.Problem` instances, and the
+    ``seconds`` it took.
+    """
+    def __init__(self, path, problems, seconds=0.0):
+        self.path = path
+        self.problems = problems
+        self.seconds = seconds
+
+    errors = property(lambda x: [problem for problem in x.problems if problem.is_error])
+    warnings = property(lambda x: [problem for problem in x.problems if not problem.is_error])
+    valid = property(lambda x: not x.errors)
+
+    def __repr__(self):
+        return '<EpubCheckResult: %s, %d errors, %d warnings>' % (self.path, len(self.errors), len(self.warnings))
+
+
+def make_problem(severity, resource, line, message):
+    line = int(line)
+    if line < 0:
+        line = None
+    return Problem(severity, resource, message, line)
+
+
+def parse_output(output, epub_name=None):
+    """
+    Returns the problems in the output of ``java -jar epubcheck.jar``.
+    Resources are given relative to the ePub, without ``epub_name``.
+    """
+    problems = []
+    for line in output.splitlines():
+        match = OUTPUT_LINE.match(line.strip())
+        if match is None:
+            continue
+        severity, resource, number, message = match.groups()
+        if epub_name and resource.startswith(epub_name):
+            resource = resource[len(epub_name):].lstrip('/')
+        problems.append(make_problem(severity.lower(), resource, number or -1, message))
+    return problems
+
+
+def _kill(process):
+    try:
+        process.kill()
+    except OSError:
+        pass
+
+
+class _Worker(object):
+    """
+    One long-lived Java process running the worker script. Its output is
+    read by a thread of its own, so a process that hangs can be given up on
+    after ``timeout`` seconds.
+    """
+    def __init__(self, jrunscript, jar, timeout=None):
+        classpath = os.pathsep.join([jar, os.path.join(os.path.dirname(jar), 'lib', 'saxon.jar')])
+        self.process = subprocess.Popen([jrunscript, '-cp', classpath, '-f', WORKER_SCRIPT],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.timeout = timeout
+        self._lines = Queue.Queue()
+        reader = threading.Thread(target=self._read)
+        reader.setDaemon(True)
+        reader.start()
+        self._wait_ready()
+
+    def _read(self):
+        for line in iter(self.process.stdout.readline, ''):
+            self._lines.put(line)
+        self._lines.put('')
+
+    def _readline(self, deadline):
+        """
+        Returns the next line of output, or ``''`` at its end.
+
+        :raises: :class:`EpubCheckError` if ``deadline`` passes first, after
+                 stopping the process
+        """
+        try:
+            if deadline is None:
+                return self._lines.get()
+            return self._lines.get(True, max(deadline - time.time(), 0))
+        except Queue.Empty:
+            self.kill()
+            raise EpubCheckError("The epubcheck worker did not answer within %s seconds." % self.timeout)
+
+    def _get_deadline(self):
+        if self.timeout is None:
+            return None
+        return time.time() + self.timeout
+
+    def _wait_ready(self):
+        """
+        Waits for the script to say it is ready.
+
+        :raises: :class:`EpubCheckError` if it stopped instead
+        """
+        deadline = self._get_deadline()
+        other = []
+        while True:
+            line = self._readline(deadline)
+            if not line:
+                break
+            if line.rstrip('\r\n') == 'epubcheck\tready':
+                return
+            other.append(line)
+        self.close()
+        raise EpubCheckError("The epubcheck worker did not start: %s" % ''.join(other).strip())
+
+    def check(self, path):
+        """
+        Returns the problems found in the ePub at ``path``.
+
+        :raises: :class:`EpubCheckError` if the process died or did not
+                 answer in time
+        """
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        problems = []
+        other = []
+        deadline = self._get_deadline()
+        try:
+            self.process.stdin.write(os.path.abspath(path) + '\n')
+            self.process.stdin.flush()
+            while True:
+                line = self._readline(deadline)
+                if not line:
+                    break
+                fields = line.rstrip('\r\n').split('\t')
+                if fields[0] != 'epubcheck':
+                    other.append(line)
+                elif fields[1] == 'done':
+                    return problems
+                elif fields[1] == 'message' and len(fields) == 6:
+                    problems.append(make_problem(fields[2], fields[3].decode('utf-8'), fields[4], fields[5].decode('utf-8')))
+        except IOError:
+            pass
+        self.close()
+        raise EpubCheckError("The epubcheck worker stopped: %s" % ''.join(other).strip())
+
+    def alive(self):
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.alive():
+            _kill(self.process)
+            self.process.wait()
+
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.close()
+            except IOError:
+                pass
+            self.process.wait()
+
+
+class EpubCheckPool(object):
+    """
+    Checks ePubs with epubcheck, ``workers`` at a time.
+
+    :param workers: The number of ePubs checked at the same time, and of Java
+                    processes kept running.
+    :type workers: ``int``
+    :param jar: The epubcheck jar. **Default:** the one in ``epub/bin``.
+    :param persistent: Whether to keep the Java processes running between
+                       ePubs. **Default:** ``None``, if ``jrunscript`` can be
+                       found and a first worker starts.
+    :type persistent: ``bool``
+    :param timeout: The most seconds a Java process may take to start or to
+                    check one ePub before it is stopped. ``None`` waits for
+                    ever. **Default:** ``300``
+    """
+    def __init__(self, workers=2, jar=EPUBCHECK_JAR, java='java', jrunscript='jrunscript', persistent=None, timeout=300):
+        self.workers = workers
+        self.jar = jar
+        self.java = java
+        self.timeout = timeout
+        self.jrunscript = find_executable(jrunscript) or jrunscript
+        self._idle = Queue.Queue()
+        self._lock = threading.Lock()
+        self._all = []
+        if persistent is None:
+            persistent = os.path.isabs(self.jrunscript) and self._probe()
+        self.persistent = persistent
+
+    def _probe(self):
+        """
+        Tells whether a worker starts. It is kept for the first ePub.
+        """
+        try:
+            self._release(self._acquire())
+        except EpubCheckError:
+            return False
+        return True
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        try:
+            worker = _Worker(self.jrunscript, self.jar, self.timeout)
+        except OSError, e:
+            raise EpubCheckError("Could not run %s: %s" % (self.jrunscript, e))
+        self._lock.acquire()
+        try:
+            self._all.append(worker)
+        finally:
+            self._lock.release()
+        return worker
+
+    def _release(self, worker):
+        if worker.alive():
+            self._idle.put(worker)
+        else:
+            self._lock.acquire()
+            try:
+                if worker in self._all:
+                    self._all.remove(worker)
+            finally:
+                self._lock.release()
+
+    def check(self, path):
+        """
+        Checks the ePub at ``path``. If the worker checking it stops or does
+        not answer in time, it is tried once more with a new one.
+
+        :rtype: :class:`EpubCheckResult`
+        :raises: :class:`EpubCheckError` if epubcheck could not be run, or
+                 failed on both tries
+        """
+        start = time.time()
+        if not self.persistent:
+            return EpubCheckResult(path, self._check_process(path), time.time() - start)
+        for attempt in range(2):
+            worker = self._acquire()
+            try:
+                problems = worker.check(path)
+                break
+            except EpubCheckError:
+                if attempt:
+                    raise
+            finally:
+                self._release(worker)
+        return EpubCheckResult(path, problems, time.time() - start)
+
+    def _check_process(self, path):
+        try:
+            process = subprocess.Popen([self.java, '-jar', self.jar, path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError, e:
+            raise EpubCheckError("Could not run %s: %s" % (self.java, e))
+        timer = None
+        killed = []
+        if self.timeout is not None:
+            def stop():
+                killed.append(True)
+                _kill(process)
+            timer = threading.Timer(self.timeout, stop)
+            timer.start()
+        try:
+            stdout, stderr = process.communicate()
+        finally:
+            if timer is not None:
+                timer.cancel()
+        if killed:
+            raise EpubCheckError("epubcheck did not finish within %s seconds." % self.timeout)
+        problems = parse_output(stderr, os.path.basename(path))
+        if process.returncode and not problems:
+            raise EpubCheckError("epubcheck failed: %s" % (stderr or stdout).strip())
+        return problems
+
+    def validate_batch(self, paths):
+        """
+        Checks the ePubs at ``paths``, ``workers`` at a time.
+
+        :returns: The results, in the same order as ``paths``
+        :rtype: ``list`` of :class:`EpubCheckResult`
+        :raises: :class:`EpubCheckError` if epubcheck could not be run
+        """
+        pending = Queue.Queue()
+        for item in enumerate(paths):
+            pending.put(item)
+        results = [None] * len(paths)
+        failures = []
+
+        def run():
+            while not failures:
+                try:
+                    index, path = pending.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = self.check(path)
+                except EpubCheckError, e:
+                    failures.append(e)
+
+        threads = [threading.Thread(target=run) for i in range(min(self.workers, len(paths)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if failures:
+            raise failures[0]
+        return results
+
+    def validate(self, path):
+        """
+        Returns the problems epubcheck finds in the ePub at ``path``, so the
+        pool can be the ``validator`` of an :class:`EPub`.
+        """
+        return self.check(path).problems
+
+    def close(self):
+        """
+        Stops the Java processes.
+        """
+        self._lock.acquire()
+        try:
+            workers, self._all = self._all, []
+        finally:
+            self._lock.release()
+        for worker in workers:
+            worker.close()
+        self._idle = Queue.Queue()
+
+
+def validate_batch(paths, workers=2):
+    """
+    Checks the ePubs at ``paths`` with a new :class:`EpubCheckPool`.
+    """
+    pool = EpubCheckPool(workers)
+    try:
+        return pool.validate_batch(paths)
+    finally:
+        pool.close()
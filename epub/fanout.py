@@ -0,0 +1,179 @@
+"""
+Building many editions of an ePub that share most of their articles.
+
+Regional or topical variants of the same issue differ in their metadata and
+in which articles they carry, and in what order. Built as separate
+:class:`EPub` instances, each renders and compresses every article again. A
+:class:`FanOutBuilder` holds one pool of articles and assets, renders and
+compresses each of them once, and writes all the editions at the same time
+from those shared parts::
+
+    from epub.fanout import FanOutBuilder
+
+    builder = FanOutBuilder()
+    for story in stories:
+        builder.add_article(story.slug, story.headline, story)
+    builder.add_image('/media/logo.png')
+
+    builder.add_edition('north', ['weather-north', 'front-page', 'sports'],
+        metadata={'title': 'The Daily Times: North'})
+    builder.add_edition('south', ['front-page', 'weather-south'],
+        metadata={'title': 'The Daily Times: South'})
+
+    reports = builder.generate({
+        'north': '/srv/epub/north.epub',
+        'south': '/srv/epub/south.epub',
+    }, workers=4)
+
+Every edition carries all the images and files of the pool, so the
+references in the articles resolve in each of them. The editions are written
+in threads: lazy content read from the database is loaded in the thread of
+the first edition that needs it, on that thread's own connection.
+"""
+from multiprocessing.pool import ThreadPool
+
+from epub.archive import SharedParts
+from epub.models import EPub, EPubMetadata
+from epub.report import BuildReport
+
+
+class FanOutBuilder(object):
+    """
+    Builds several editions from one pool of articles and assets.
+
+    :param epub: Optional. The :class:`EPub` holding the pool, whose
+                 templates, ``compression``, ``date_time``, ``article_cache``,
+                 ``image_pipeline``, ``validator`` and ``contents_page_size``
+                 every edition shares.
+                 **Default:** a new :class:`EPub`.
+    """
+    def __init__(self, epub=None):
+        if epub is None:
+            epub = EPub()
+        self.pool = epub
+        self.articles = {}
+        self.authors = {}
+        self.editions = []
+        self.shared_parts = SharedParts()
+
+    def add_article(self, key, title, content, filename=None, author=None, content_hash=None, section=None):
+        """
+        Adds an article to the pool under ``key``, by which the editions
+        refer to it. The other parameters are the same as for
+        :meth:`EPub.add_article`.
+        """
+        if key in self.articles:
+            raise ValueError("There is already an article %r in the pool." % (key,))
+        self.pool.add_article(title, content, filename, author, content_hash, section)
+        self.articles[key] = self.pool.articles[-1]
+        self.authors[key] = author
+
+    def add_image(self, filepath, name=None, mime_type=None):
+        """
+        Adds an image to every edition. See :meth:`EPub.add_image`.
+        """
+        return self.pool.add_image(filepath, name, mime_type)
+
+    def add_file(self, filepath, name=None, mime_type=None):
+        """
+        Adds a file to every edition. See :meth:`EPub.add_file`.
+        """
+        return self.pool.add_file(filepath, name, mime_type)
+
+    def add_edition(self, name, articles, metadata=None):
+        """
+        Defines the edition ``name``, made of the ``articles`` of the pool
+        with those keys, in that order.
+
+        :param metadata: Optional. The metadata of the edition, an
+                         :class:`EPubMetadata` or a ``dict``.
+        :raises: ``KeyError`` if an article is not in the pool
+        """
+        if name in [edition[0] for edition in self.editions]:
+            raise ValueError("There is already an edition %r." % (name,))
+        for key in articles:
+            if key not in self.articles:
+                raise KeyError("There is no article %r in the pool." % (key,))
+        self.editions.append((name, list(articles), metadata))
+
+    def get_edition(self, name):
+        """
+        Returns a new :class:`EPub` for the edition ``name``. Its articles and
+        assets are those of the pool, not copies of them. The metadata of
+        the edition is used as it is, so it should not be shared with another
+        edition that adds contributors.
+        """
+        for edition_name, keys, metadata in self.editions:
+            if edition_name == name:
+                break
+        else:
+            raise KeyError("There is no edition %r." % (name,))
+        epub = EPub(self.pool.templates, self.pool.template_keys)
+        for attr in ('date_time', 'article_cache', 'image_pipeline', 'compression', 'validator', 'contents_page_size'):
+            setattr(epub, attr, getattr(self.pool, attr))
+        epub.shared_parts = self.shared_parts
+        epub.articles = [self.articles[key] for key in keys]
+        epub.images = self.pool.images
+        epub.files = self.pool.files
+        epub.asset_aliases = self.pool.asset_aliases
+        epub._assets_by_hash = self.pool._assets_by_hash
+        if isinstance(metadata, dict):
+            metadata = EPubMetadata(**metadata)
+        if metadata is not None:
+            epub._metadata = metadata
+        for key in keys:
+            if self.authors[key]:
+                epub.metadata.add_contributor(self.authors[key], role="aut")
+        return epub
+
+    def generate(self, filepaths, workers=None, article_workers=None):
+        """
+        Writes every edition to its path in ``filepaths``, ``workers`` at a
+        time. Editions without a path are skipped. Each shared article and
+        asset is rendered and compressed by the first edition that needs it;
+        the others copy the compressed part.
+
+        :param filepaths: The path, or any object with a ``write`` method, of
+                          each edition, keyed by edition name
+        :type filepaths: ``dict``
+        :param workers: The number of editions written at the same time.
+                        **Default:** all of them.
+        :param article_workers: The number of threads each edition renders
+                                its articles with, as the ``workers`` of
+                                :meth:`EPub.generate_epub`.
+        :returns: The :class:`epub.report.BuildReport` of each edition, by name
+        :rtype: ``dict``
+        :raises: The first error raised while writing an edition, once the
+                 others are finished
+        """
+        names = [edition[0] for edition in self.editions if edition[0] in filepaths]
+        if not names:
+            return {}
+        pipeline = self.pool.image_pipeline
+        if pipeline is not None:
+            # Shrink each image once, before the editions race for it
+            for img in self.pool.images:
+                pipeline.process(img['orig'], img['mimetype'])
+        pool = ThreadPool(min(workers or len(names), len(names)))
+        try:
+            reports = pool.map(lambda name: self._generate_edition(name, filepaths[name], article_workers), names)
+        finally:
+            pool.close()
+            pool.join()
+            self.shared_parts.clear()
+        return dict(zip(names, reports))
+
+    def _generate_edition(self, name, filepath, workers):
+        epub = self.get_edition(name)
+        report = BuildReport()
+        archive, copy = epub._open_archive(filepath)
+        try:
+            for arcname in epub._write_epub(archive, workers, None, report):
+                pass
+        except:
+            archive.close()
+            epub._discard_copy(copy)
+            raise
+        archive.close()
+        epub._finish(report, filepath, copy)
+        return report
@@ -0,0 +1,117 @@
+"""
+An optional stage that shrinks images before they go into an ePub.
+
+Set the ``image_pipeline`` of an :class:`EPub` to an :class:`ImagePipeline`
+and every JPEG and PNG image added with :meth:`EPub.add_image` is scaled down
+to fit ``max_dimension`` and recompressed when the ePub is generated::
+
+    from epub.images import ImagePipeline
+
+    e = EPub()
+    e.image_pipeline = ImagePipeline(max_dimension=1200, jpeg_quality=75)
+
+The processed images are saved in ``cache_dir``, keyed by a hash of the
+original image and the settings, so the same photo is only processed once.
+How they are compressed in the archive is up to the ``compression`` policy of
+the :class:`EPub`, which stores JPEG, PNG and GIF images as they are.
+
+Requires the Python Imaging Library.
+"""
+import os
+import shutil
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.hashcompat import sha_constructor
+
+from epub.archive import hash_file
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+FORMATS = {
+    'image/jpeg': 'JPEG',
+    'image/png': 'PNG',
+}
+
+
+class ImagePipeline(object):
+    """
+    Scales JPEG and PNG images down to fit in ``max_dimension`` pixels on
+    either side, and saves them again with ``jpeg_quality`` and the
+    optimizer of PIL.
+
+    :param cache_dir: Where the processed images are kept. **Default:** the
+                      ``EPUB_IMAGE_CACHE_DIR`` setting, or ``epub-images`` in
+                      the temporary directory.
+    """
+    def __init__(self, max_dimension=1200, jpeg_quality=75, optimize=True, cache_dir=None):
+        if Image is None:
+            raise ImproperlyConfigured("The image pipeline requires the Python Imaging Library.")
+        if cache_dir is None:
+            from django.conf import settings
+            cache_dir = getattr(settings, 'EPUB_IMAGE_CACHE_DIR', None) or \
+                os.path.join(tempfile.gettempdir(), 'epub-images')
+        self.max_dimension = max_dimension
+        self.jpeg_quality = jpeg_quality
+        self.optimize = optimize
+        self.cache_dir = cache_dir
+
+    def get_settings_key(self):
+        return 'max%s-q%s-o%d' % (self.max_dimension, self.jpeg_quality, bool(self.optimize))
+
+    def get_cache_path(self, filepath, mime_type):
+        """
+        Returns where the processed version of ``filepath`` is cached.
+        """
+        ext = os.path.splitext(filepath)[1]
+        key = sha_constructor('%s:%s:%s' % (hash_file(filepath), mime_type, self.get_settings_key())).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def process(self, filepath, mime_type):
+        """
+        Returns the path of the processed version of the image at
+        ``filepath``, processing it if it is not in the cache yet. Images in
+        other formats than JPEG and PNG are returned unchanged, as are images
+        that would not get any smaller.
+        """
+        if mime_type not in FORMATS:
+            return filepath
+        cache_path = self.get_cache_path(filepath, mime_type)
+        if not os.path.exists(cache_path):
+            directory = os.path.dirname(cache_path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    # Another process made it first
+                    pass
+            # Write to a temporary file first, so a concurrent build never
+            # sees a half written image.
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            os.close(fd)
+            try:
+                self._convert(filepath, tmp_path, FORMATS[mime_type])
+                if os.path.getsize(tmp_path) >= os.path.getsize(filepath):
+                    shutil.copyfile(filepath, tmp_path)
+                os.rename(tmp_path, cache_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return cache_path
+
+    def _convert(self, source, dest, format):
+        img = Image.open(source)
+        if self.max_dimension and max(img.size) > self.max_dimension:
+            img.thumbnail((self.max_dimension, self.max_dimension), Image.ANTIALIAS)
+        options = {'optimize': self.optimize}
+        if format == 'JPEG':
+            if img.mode not in ('RGB', 'L'):
+                img = img.convert('RGB')
+            options['quality'] = self.jpeg_quality
+        img.save(dest, format, **options)
@@ -0,0 +1,47 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import simplejson
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10,1000,10000',
+            help='Comma separated numbers of articles of the editions to build.'),
+        make_option('--seed', dest='seed', type='int', default=0,
+            help='Seed for generating the synthetic editions.'),
+        make_option('--workers', dest='workers', type='int', default=None,
+            help='Number of threads rendering the articles.'),
+        make_option('--output', dest='output', default=None,
+            help='Save the results as JSON to this file.'),
+        make_option('--compare', dest='compare', default=None,
+            help='Compare the results to those saved in this file.'),
+    )
+    help = 'Benchmarks generating ePubs from synthetic editions of various sizes.'
+
+    def handle(self, *args, **options):
+        from epub.benchmark import run_benchmarks, compare
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError("--sizes must be a comma separated list of numbers.")
+        
+        results = run_benchmarks(sizes, options['seed'], options['workers'])
+        for case in results:
+            print "%(size)6d articles: %(generate_seconds)8.3fs generate, %(metadata_seconds)7.3fs metadata, %(output_bytes)11d bytes, %(peak_memory_kb)8d KB peak" % case
+        
+        if options['compare']:
+            f = open(options['compare'])
+            try:
+                baseline = simplejson.load(f)
+            finally:
+                f.close()
+            for row in compare(results, baseline):
+                print "%6d %-18s %14.3f %14.3f %7.2fx" % row
+        
+        if options['output']:
+            f = open(options['output'], 'w')
+            try:
+                simplejson.dump(results, f, indent=2)
+            finally:
+                f.close()
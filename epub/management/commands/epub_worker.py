@@ -0,0 +1,35 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=2,
+            help='Number of ePubs built at the same time.'),
+        make_option('--once', dest='once', action='store_true', default=False,
+            help='Build the queued ePubs and exit, instead of waiting for more.'),
+        make_option('--requeue-after', dest='requeue_after', type='int', default=3600,
+            help='Queue again the jobs that have been running for this many seconds.'),
+    )
+    help = 'Builds the queued ePubs.'
+
+    def handle(self, *args, **options):
+        from epub.scheduler import BuildScheduler
+        scheduler = BuildScheduler(options['workers'])
+        requeued = scheduler.requeue_stale(options['requeue_after'])
+        if requeued:
+            print "Queued %d stale jobs again." % requeued
+        
+        if options['once']:
+            for job in scheduler.run_pending():
+                print "%s: %s" % (job.product, job.status)
+            return
+        
+        scheduler.start()
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            scheduler.stop()
@@ -0,0 +1,35 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=2,
+            help='Number of ePubs checked at the same time.'),
+    )
+    help = 'Validates ePubs with epubcheck, keeping the Java processes running between them.'
+    args = '<epub epub ...>'
+
+    def handle(self, *paths, **options):
+        from epub.epubcheck import EpubCheckPool, EpubCheckError
+        if not paths:
+            raise CommandError("Give the paths of the ePubs to check.")
+        pool = EpubCheckPool(options['workers'])
+        try:
+            try:
+                results = pool.validate_batch(paths)
+            except EpubCheckError, e:
+                raise CommandError(str(e))
+        finally:
+            pool.close()
+        
+        invalid = 0
+        for result in results:
+            print "%s: %d errors, %d warnings (%.2fs)" % (result.path, len(result.errors), len(result.warnings), result.seconds)
+            for problem in result.problems:
+                print "  %s" % problem
+            if not result.valid:
+                invalid += 1
+        if invalid:
+            raise CommandError("%d of %d ePubs are not valid." % (invalid, len(results)))
@@ -1,10 +1,143 @@
+import copy
+import itertools
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import zipfile
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from django.utils.datastructures import SortedDict as OrderedDict
+
 from django import template
-from django.template.loader import get_template
+from django.conf import settings
+from django.db import models
+from django.template.defaultfilters import slugify
+from django.template.loader import get_template, find_template_source
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+from epub.archive import EPubZipFile, PreviousArchive, StreamWriter, ZipStream, compress_entry, file_fingerprint, get_policy, hash_file
+from epub import package
+from epub.contents import Contents, RESERVED_FILENAMES
+from epub.records import Article, Asset, RecordList
+from epub.report import BuildReport
+from epub.signals import entry_written, build_finished
+from epub.sources import LazyContent, QuerySetSource, get_lazy_content
+
+logger = logging.getLogger('epub')
+if hasattr(logging, 'NullHandler'):
+    logger.addHandler(logging.NullHandler())
+
+# Compiled templates, keyed by the template name and the settings used to find
+# it, so changing the template directories or loaders loads them again.
+_template_cache = {}
+_template_keys = {}
+
+# The templates an ePub is rendered with
+TEMPLATE_NAMES = ('epub/content.opf', 'epub/toc.ncx', 'epub/title_page.html', 'epub/contents.html', 'epub/article.html')
+
+def get_cached_template(name):
+    """
+    Returns the compiled template ``name``, loading it with Django's
+    ``get_template`` only the first time it is asked for.
+    """
+    key = (name, tuple(settings.TEMPLATE_DIRS), tuple(settings.TEMPLATE_LOADERS))
+    try:
+        return _template_cache[key]
+    except KeyError:
+        tmpl = _template_cache[key] = get_template(name)
+        return tmpl
+
+def get_template_key(name):
+    """
+    Returns a string that identifies the current source of the template
+    ``name``, used to key the rendered article caches in :mod:`epub.cache`.
+    Only the source of ``name`` itself is used, not that of the templates it
+    extends or includes.
+    """
+    key = (name, tuple(settings.TEMPLATE_DIRS), tuple(settings.TEMPLATE_LOADERS))
+    try:
+        return _template_keys[key]
+    except KeyError:
+        source = find_template_source(name)[0]
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        tmpl_key = _template_keys[key] = '%s:%s' % (name, sha_constructor(source).hexdigest())
+        return tmpl_key
+
+def clear_template_cache():
+    """
+    Forgets every compiled template, for example after the templates on disk
+    have been edited in a long-running process.
+    """
+    _template_cache.clear()
+    _template_keys.clear()
+
+common_second_words = frozenset(('al', 'da', 'de', 'del', 'dela', 'della', 'di', 'du', 'el', 'la', 'le', 'mc', 'o\'', 'san', 'st', 'sta', 'van', 'vande', 'vanden', 'vander', 'von',))
+common_third_words = frozenset(('van', 'de', ))
+common_suffixes = frozenset(("jr", "sr", "ii", "iii", "iv", "md", "phd"))
+
+# The most recently formatted names, as the same bylines come up again and
+# again. At most ``NAME_CACHE_SIZE`` of them are kept.
+NAME_CACHE_SIZE = 10000
+_name_cache = OrderedDict()
+_name_cache_lock = threading.Lock()
 
-common_second_words = ('al', 'da', 'de', 'del', 'dela', 'della', 'di', 'du', 'el', 'la', 'le', 'mc', 'o\'', 'san', 'st', 'sta', 'van', 'vande', 'vanden', 'vander', 'von',)
-common_third_words = ('van', 'de', )
-common_suffixes = ("jr", "sr", "ii", "iii", "iv", "md", "phd")
 def format_name(name):
+    """
+    Returns ``name`` formatted by :func:`parse_name`, remembering the result
+    for the next time the same name comes up.
+    """
+    _name_cache_lock.acquire()
+    try:
+        file_as = _name_cache.pop(name, None)
+        if file_as is not None:
+            # Move it to the end, as the most recently used
+            _name_cache[name] = file_as
+            return file_as
+    finally:
+        _name_cache_lock.release()
+    
+    file_as = parse_name(name)
+    _name_cache_lock.acquire()
+    try:
+        _name_cache[name] = file_as
+        while len(_name_cache) > NAME_CACHE_SIZE:
+            del _name_cache[iter(_name_cache).next()]
+    finally:
+        _name_cache_lock.release()
+    return file_as
+
+def format_names(names):
+    """
+    Formats a list of names, such as the bylines of an edition, at once.
+    Each distinct name is only formatted once.
+    
+    :returns: The formatted names, in the same order as ``names``
+    :rtype: ``list``
+    """
+    formatted = {}
+    for name in names:
+        if name not in formatted:
+            formatted[name] = format_name(name)
+    return [formatted[name] for name in names]
+
+def clear_name_cache():
+    """
+    Forgets the names formatted so far.
+    """
+    _name_cache_lock.acquire()
+    try:
+        _name_cache.clear()
+    finally:
+        _name_cache_lock.release()
+
+def parse_name(name):
     """
     Takes a name in the format ``first [middle/initial] last [suffix]`` and 
     returns it as ``last [suffix], first [middle/initial]``. Covers a wide variety
@@ -46,7 +179,7 @@ def format_name(name):
     
     #check for 3-word last names, then 2-word last names
     if length >= 2 and pieces[-2].lower() in common_third_words:
-        lname = [pieces.pop(-2), pieces.pop(-1), lastname]
+        lname = [pieces.pop(-2), pieces.pop(-1), last_name]
         last_name = " ".join(lname)
     elif length >= 1 and pieces[-1].lower() in common_second_words:
         last_name = " ".join([pieces.pop(-1), last_name])
@@ -57,6 +190,17 @@ def format_name(name):
     return u'%s, %s' % (last_name, first_name)
 
 
+def xml_escape(value):
+    """
+    Escapes ``value`` for use as XML text or as a double quoted attribute.
+    """
+    if not isinstance(value, basestring):
+        value = unicode(value)
+    elif not isinstance(value, unicode):
+        value = value.decode('utf-8')
+    return value.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;').replace(u'"', u'&quot;')
+
+
 class EPubMetadata(object):
     """
     Manages the metadata for an :class:`EPubMetadata` object. It has some methods
@@ -74,7 +218,16 @@ class EPubMetadata(object):
     valid_date_events = ['creation', 'publication', 'modification']
     _unique_id = None
     
-    _default_metadata = lambda x: dict(title='', language='en', identifier=[], creator={}, contributor={}, subject=[], relation=[], date=[], type=[])
+    # The order of the elements in the serialized metadata. Other elements
+    # follow in alphabetical order, then the ``<meta>`` elements.
+    element_order = ('title', 'language', 'identifier', 'creator', 'contributor',
+        'publisher', 'description', 'subject', 'date', 'type', 'format', 'source',
+        'relation', 'coverage', 'rights')
+    
+    # The serialized metadata, until something changes
+    _serialized = None
+    
+    _default_metadata = lambda x: dict(title='', language='en', identifier=[], creator=OrderedDict(), contributor=OrderedDict(), subject=[], relation=[], date=[], type=[])
     
     def __init__(self, *args, **kwargs):
         """
@@ -94,24 +247,30 @@ class EPubMetadata(object):
         self._metadata.update(kwargs)
     
     def __setattr__(self, name, value):
-        if name in ['_metadata','_unique_id', 'unique_id', 'creation_date', 'modification_date', 'publication_date',]:
+        if name in ['_metadata','_unique_id', '_serialized', 'unique_id', 'creation_date', 'modification_date', 'publication_date',]:
             object.__setattr__(self, name, value)
         elif name in self._has_many:
             raise AttributeError("Please set the %s attribute using the add_%s method." % (name, name))
         else:
             self._metadata[name] = value
+            self._serialized = None
     
     def __getattr__(self, name):
         if name == '_metadata':
             return None
-        else:
-            return self._metadata.get(name, '')
+        value = self._metadata.get(name, '')
+        if isinstance(value, (list, dict)):
+            # A copy, as changing it would not reach the serialized metadata.
+            # Use the ``add_`` methods instead.
+            return copy.deepcopy(value)
+        return value
     
     def update(self, metadata):
         """
         Merge another EPubMetadata instance with this one, overriding this one's
         values where necessary, adding where it can.
         """
+        self._serialized = None
         if metadata._unique_id:
             self.set_unique_id(id=metadata._unique_id['id'], scheme=metadata._unique_id['scheme'], value=metadata._unique_id['value'])
         
@@ -134,6 +293,7 @@ class EPubMetadata(object):
         :param event: Optional. One of :ref:``EPubMetada.valid_date_events``
         :type event: ``string``
         """
+        self._serialized = None
         if event and event in self.valid_date_events:
             self._metadata['date'].append({'value':value, 'opf:event':event})
         elif event and event not in self.valid_date_events:
@@ -183,6 +343,7 @@ class EPubMetadata(object):
             raise AttributeError("A creator role must be empty or one of %s." % str(self.valid_roles))
         
         self._metadata['creator'][value] = {'opf:file-as':file_as, 'opf:role':role}
+        self._serialized = None
     
     def add_meta(self, name, content):
         """
@@ -192,8 +353,9 @@ class EPubMetadata(object):
         and closing ``<meta>`` tags.
         """
         if not self._metadata.has_key('meta'):
-            self._metadata['meta'] = {}
-        self._metadata['meta']['name'] = content
+            self._metadata['meta'] = OrderedDict()
+        self._metadata['meta'][name] = content
+        self._serialized = None
     
     def get_unique_id(self):
         """
@@ -204,7 +366,7 @@ class EPubMetadata(object):
         :returns: The unique id identifier
         :rtype: ``dict(id, opf:scheme, value)`` 
         """
-        return self._unique_id
+        return dict(self._unique_id)
     
     def set_unique_id(self, value, id, scheme=None):
         """
@@ -223,6 +385,7 @@ class EPubMetadata(object):
         :type scheme: ``string``
         """
         self._unique_id = {'id':id, 'opf:scheme':scheme, 'value':value}
+        self._serialized = None
         for item in self._metadata['identifier']:
             if item['id'] == id:
                 item['opf:scheme'] = scheme
@@ -234,37 +397,44 @@ class EPubMetadata(object):
     
     def add_identifier(self, value, id=None, scheme=None):
         self._metadata['identifier'].append({'id':id, 'opf:scheme':scheme, 'value':value})
+        self._serialized = None
     
     def add_contributor(self, value, file_as=None, role="aut"):
         if not file_as:
             file_as = format_name(value)
         self._metadata['contributor'][value] = {'opf:file-as':file_as, 'opf:role':role}
+        self._serialized = None
     
     def add_subject(self, value):
         self._metadata['subject'].append(value)
+        self._serialized = None
     
     def add_relation(self, value):
         self._metadata['relation'].append(value)
+        self._serialized = None
     
     def add_type(self, value):
         self._metadata['type'].append(value)
+        self._serialized = None
     
-    def _format_dict(self, tag, my_dict):
+    def _format_element(self, tag, value, attrs=None):
         """
-        makes all the keys in the dict attributes, except the key 'value'
+        Returns a ``<dc:tag>`` element, with ``attrs`` as attributes in
+        alphabetical order. Attributes without a value are left out.
         """
-        attrs = my_dict.copy()
-        try:
-            value = attrs.get('value','')
-            del attrs['value']
-        except KeyError:
-            value = ''
-        attributes = []
-        for key, val in attrs.items():
-            if val:
-                attributes.append(u'%s="%s"' % (key, val.encode('ascii','xmlcharrefreplace')))
-        output = [u'<dc:%s %s>' % (tag, " ".join(attributes)),value.encode('ascii','xmlcharrefreplace'),'</dc:%s>' % tag]
-        return "".join(output)
+        attributes = u''
+        if attrs:
+            attributes = u''.join([u' %s="%s"' % (key, xml_escape(attrs[key])) for key in sorted(attrs.keys()) if attrs[key]])
+        return u'<dc:%s%s>%s</dc:%s>' % (tag, attributes, xml_escape(value), tag)
+    
+    def copy(self):
+        """
+        Returns a copy of this metadata that can be changed on its own.
+        """
+        metadata = EPubMetadata()
+        metadata._metadata = copy.deepcopy(self._metadata)
+        metadata._unique_id = dict(self._unique_id)
+        return metadata
     
     def __eq__(self, other):
         # TODO: Implement __eq__
@@ -275,25 +445,55 @@ class EPubMetadata(object):
         return ret
     
     def __unicode__(self):
-        md_list = []
-        for key, val in self._metadata.items():
-            if key == 'meta':
-                # Need a slightly different format
-                for meta in val.items():
-                    md_list.append(u'<meta name="%s" content="%s" />' % meta)
-            elif isinstance(val, (list, tuple)):
+        """
+        Serializes the metadata as the elements of the ``<metadata>`` block of
+        the OPF file, one per line, in the order of ``element_order``. Values
+        are escaped here, so they should be given as plain text.
+        
+        The result is kept until the metadata is changed through this
+        object's methods or attributes.
+        """
+        if self._serialized is not None:
+            return self._serialized
+        
+        keys = [key for key in self.element_order if key in self._metadata]
+        keys.extend(sorted([key for key in self._metadata.keys() if key not in self.element_order and key != 'meta']))
+        lines = []
+        for key in keys:
+            val = self._metadata[key]
+            if isinstance(val, (list, tuple)):
                 for item in val:
                     if isinstance(item, dict):
-                        md_list.append(self._format_dict(key, item))
+                        attrs = dict([(k, v) for k, v in item.items() if k != 'value'])
+                        lines.append(self._format_element(key, item.get('value', ''), attrs))
                     else:
-                        md_list.append(u'<dc:%s>%s</dc:%s>' % (key, item.encode('ascii', 'xmlcharrefreplace'), key))
-            elif isinstance(val, (dict)):
+                        lines.append(self._format_element(key, item))
+            elif isinstance(val, dict):
                 for item_key, item_val in val.items():
-                    item_val['value']=item_key
-                    md_list.append(self._format_dict(key, item_val))
+                    lines.append(self._format_element(key, item_key, item_val))
             else:
-                md_list.append(u'<dc:%s>%s</dc:%s>' % (key, val.encode('ascii', 'xmlcharrefreplace'), key))
-        return u'\n'.join(md_list)
+                lines.append(self._format_element(key, val))
+        for name, content in self._metadata.get('meta', {}).items():
+            lines.append(u'<meta name="%s" content="%s" />' % (xml_escape(name), xml_escape(content)))
+        
+        self._serialized = u'\n'.join(lines)
+        return self._serialized
+
+
+def _records_property(name, id_prefix, key, record_class, path_key=None, reserved=None):
+    """
+    A property holding a :class:`epub.records.RecordList` of
+    ``record_class``. A plain list assigned to it is turned into one.
+    """
+    attr = '_%s' % name
+    def get(self):
+        return getattr(self, attr)
+    def set(self, records):
+        if not isinstance(records, RecordList):
+            records = RecordList(records, id_prefix, key, path_key, reserved, record_class)
+        setattr(self, attr, records)
+    return property(get, set)
+
 
 class EPub(object):
     """
@@ -301,12 +501,83 @@ class EPub(object):
     """
     _metadata = None
     
-    def __init__(self):
+    # The articles, images and files, as records of :mod:`epub.records`,
+    # indexed by file name, manifest id and the path they were added from
+    articles = _records_property('articles', 'article', 'filename', Article, reserved=RESERVED_FILENAMES)
+    images = _records_property('images', 'img', 'href', Asset, 'orig')
+    files = _records_property('files', 'file', 'href', Asset, 'orig')
+    
+    # The timestamp given to every entry in the archive, as a
+    # ``(year, month, day, hour, minute, second)`` tuple. Set it to make builds
+    # reproducible; it defaults to the time of the build.
+    date_time = None
+    
+    # An optional cache of rendered articles, shared between EPubs. See
+    # :mod:`epub.cache`.
+    article_cache = None
+    
+    # An optional stage that shrinks images as they are written. See
+    # :mod:`epub.images`.
+    image_pipeline = None
+    
+    # How the entries are compressed: a :class:`epub.archive.CompressionPolicy`
+    # or the name of a profile, ``'fast'`` for previews or ``'max'`` for final
+    # downloads. ``None`` deflates at the default level and stores images that
+    # are already compressed.
+    compression = None
+    
+    # Compressed entries shared with other EPubs built at the same time, an
+    # :class:`epub.archive.SharedParts`. Set by :mod:`epub.fanout`.
+    shared_parts = None
+    
+    # The most entries listed on one contents page; longer lists are
+    # continued on further pages. ``None`` lists them all on one page. See
+    # :mod:`epub.contents`.
+    contents_page_size = None
+    
+    # An optional check of the archive once it is written, such as a
+    # :class:`epub.validation.Validator`. The problems it finds end up in the
+    # ``problems`` of the :class:`epub.report.BuildReport`. An archive written
+    # to a stream, or by :meth:`EPub.iter_epub`, is also copied to a
+    # temporary file while it is written, which is checked and removed.
+    validator = None
+    
+    def __init__(self, templates=None, template_keys=None):
+        """
+        :param templates: Optional. Compiled templates to use instead of
+                          loading them, keyed by template name, such as
+                          ``{'epub/article.html': Template(...)}``.
+        :type templates: ``dict``
+        :param template_keys: Optional. A string for each template in
+                              ``templates``, by name, that changes whenever
+                              its source does, such as a hash of the source.
+                              Articles rendered with a template without a key
+                              are not cached.
+        :type template_keys: ``dict``
+        """
+        self.templates = templates or {}
+        self.template_keys = template_keys or {}
         self.articles = []
         self.images = []
         self.files = []
+        # The names of images and files that were already added under
+        # another name, relative to ``OEBPS``, mapped to that name
+        self.asset_aliases = {}
+        self._assets_by_hash = {}
+        self._alias_pattern = None
         self._metadata = EPubMetadata()
     
+    def open(cls, path):
+        """
+        Opens the stored ePub at ``path`` for reading single documents out of
+        it, or for adding articles to it.
+        
+        :rtype: :class:`epub.reader.EPubReader`
+        """
+        from epub.reader import EPubReader
+        return EPubReader(path)
+    open = classmethod(open)
+    
     def get_metadata(self):
         return self._metadata
     
@@ -318,58 +589,327 @@ class EPub(object):
     metadata = property(get_metadata, set_metadata)
     
     # content
-    def add_article(self, title, content, filename=None, author=None):
+    def add_article(self, title, content, filename=None, author=None, content_hash=None, section=None):
+        """
+        Adds an article or chapter. If ``filename`` is left out, it is made
+        from the ``title``. A file name already used by another article gets
+        ``-2``, ``-3``, ... added to it. If ``author`` is given, it is added
+        as a ``contributor``.
+        
+        ``section`` is the title of the section of the edition the article
+        belongs to, such as ``'Sports'``. Articles of a section should be
+        added one after the other. See :mod:`epub.contents`.
+        
+        ``content_hash`` is optional: any string that changes whenever the
+        rendered article would. An incremental build (see the ``previous``
+        parameter of :meth:`EPub.generate_epub`) copies the article from the
+        previous archive when it was built with the same hash.
+        
+        ``content`` can also be loaded only when the article is written: a
+        :class:`epub.sources.LazyContent` such as a
+        :class:`epub.sources.FileContent`, a function returning the content,
+        or a generator of the chunks of the story. See :mod:`epub.sources`.
+        
+        :returns: The new article
+        :rtype: :class:`epub.records.Article`
+        """
         if not filename:
             filename = "%s.html" % slugify(title)
-        self.articles.append({'title': title, 'content':content, 'filename':filename})
+        filename = self.articles.make_unique(filename)
+        content = get_lazy_content(content, title)
+        if content_hash is None and isinstance(content, LazyContent):
+            content_hash = content.content_hash
+        article = Article(title=title, content=content, filename=filename, content_hash=content_hash, section=section)
+        self.articles.append(article)
         if author:
             self.metadata.add_contributor(author, role="aut")
+        return article
+    
+    def get_article(self, filename):
+        """
+        Returns the article whose file name is ``filename``, or ``None``.
+        """
+        return self.articles.get(filename)
+    
+    def replace_article(self, filename, title, content, author=None, content_hash=None, section=None):
+        """
+        Replaces the article whose file name is ``filename`` with a new one,
+        in the same place and under the same file name. The parameters are
+        the same as for :meth:`EPub.add_article`; ``section`` defaults to the
+        section of the article replaced.
+        
+        :raises: ``KeyError`` if there is no such article
+        """
+        old = self.articles.get(filename)
+        if old is None:
+            raise KeyError(filename)
+        if section is None:
+            section = old['section']
+        content = get_lazy_content(content, title)
+        if content_hash is None and isinstance(content, LazyContent):
+            content_hash = content.content_hash
+        article = Article(title=title, content=content, filename=filename, content_hash=content_hash, section=section)
+        self.articles.replace(filename, article)
+        if author:
+            self.metadata.add_contributor(author, role="aut")
+        return article
+    
+    def add_articles_from_queryset(self, queryset, fields=None, chunk_size=100):
+        """
+        Adds an article for every row of ``queryset``. Only the title, file
+        name and byline of each row are read now; the rows themselves are
+        loaded ``chunk_size`` at a time while the ePub is generated, and
+        released once their articles are written.
+        
+        :param queryset: The rows to add, in order. It must not be sliced.
+        :type queryset: ``QuerySet``
+        :param fields: Optional. The names of the fields holding the ``title``,
+                       ``filename`` (without ``.html``), ``byline``, ``body``
+                       and ``subhead`` of an article. The ``body`` and
+                       ``subhead`` fields are rendered as ``story`` and
+                       ``subhead`` by the article template. A ``filename`` or
+                       ``byline`` of ``None`` means there is no such field.
+                       **Default:** the fields of the example ``Story``:
+                       ``headline``, ``slug``, ``byline``, ``story`` and
+                       ``subhead``.
+        :type fields: ``dict``
+        :param chunk_size: The number of rows loaded by each query.
+        :type chunk_size: ``int``
+        """
+        mapping = {'title': 'headline', 'filename': 'slug', 'byline': 'byline', 'body': 'story', 'subhead': 'subhead'}
+        mapping.update(fields or {})
+        aliases = {}
+        for name, field in (('headline', mapping['title']), ('byline', mapping['byline']),
+                            ('story', mapping['body']), ('subhead', mapping['subhead'])):
+            if field and field != name:
+                aliases[name] = field
+        
+        source = QuerySetSource(queryset, chunk_size, aliases)
+        names = ['pk', mapping['title']] + [mapping[key] for key in ('filename', 'byline') if mapping[key]]
+        for row in queryset.values_list(*names).iterator():
+            row = list(row)
+            pk, title = row.pop(0), row.pop(0)
+            filename = mapping['filename'] and "%s.html" % row.pop(0) or None
+            author = mapping['byline'] and row.pop(0) or None
+            self.add_article(title, source.add(pk, title), filename, author)
     
     def add_image(self, filepath, name=None, mime_type=None):
-        if not name:
-            name = os.path.basename(filepath)
-        if not mime_type:
-            from mimetypes import guess_type
-            mime_type = guess_type(filepath)[0]
-        self.images.append({'orig':filepath, 'dest':'OEBPS/images/%s' % name, 'filename': name, 'mimetype':mime_type})
+        """
+        Adds an image, which the documents can refer to as
+        ``../images/<name>``. ``name`` defaults to the name of the file.
+        
+        An image whose content was already added, under any name, is only
+        stored once. References to ``../images/<name>`` in the articles are
+        then rewritten to point to the stored copy, unless ``name`` is that of
+        another stored image: use the name returned. A different image under a
+        name already used gets ``-2``, ``-3``, ... added to its name.
+        
+        :returns: The name the image is stored under, relative to ``OEBPS``
+        """
+        return self._add_asset(self.images, filepath, 'images/', name, mime_type)
     
     def add_file(self, filepath, name=None, mime_type=None):
+        """
+        Adds any other file, such as a font, next to ``content.opf``. Like
+        images, identical files are only stored once.
+        
+        :returns: The name the file is stored under, relative to ``OEBPS``
+        """
+        return self._add_asset(self.files, filepath, '', name, mime_type)
+    
+    def _add_asset(self, assets, filepath, directory, name, mime_type):
         if not name:
             name = os.path.basename(filepath)
         if not mime_type:
             from mimetypes import guess_type
             mime_type = guess_type(filepath)[0]
-        self.files.append({'orig':filepath, 'dest':"OEBPS/%s" % name, 'filename': name, 'mimetype':mime_type})
+        href = directory + name
+        try:
+            digest = hash_file(filepath)
+        except (OSError, IOError):
+            # Missing files are reported when the ePub is generated
+            digest = None
+        existing = self._assets_by_hash.get(digest)
+        if existing is not None:
+            # A name another asset is stored under is not aliased: its
+            # references must still reach that asset
+            if existing['href'] != href and self.images.get(href) is None and self.files.get(href) is None:
+                self.asset_aliases[href] = existing['href']
+            return existing['href']
+        unique, number = assets.make_unique(href), 2
+        while unique in self.asset_aliases:
+            base, ext = os.path.splitext(href)
+            unique = assets.make_unique('%s-%d%s' % (base, number, ext))
+            number += 1
+        href = unique
+        asset = Asset(orig=filepath, dest='OEBPS/%s' % href, filename=href[len(directory):], mimetype=mime_type, href=href, hash=digest)
+        assets.append(asset)
+        if digest is not None:
+            self._assets_by_hash[digest] = asset
+        return href
+    
+    def _get_aliases(self):
+        """
+        Returns a pattern matching the references to the asset aliases and a
+        key identifying them, compiled again only when the aliases change.
+        """
+        items = tuple(sorted(self.asset_aliases.items()))
+        if self._alias_pattern is None or self._alias_pattern[0] != items:
+            names = sorted(self.asset_aliases.keys(), key=len, reverse=True)
+            pattern = re.compile(r'''(["'])\.\./(%s)(#[^"']*)?\1''' % '|'.join([re.escape(name) for name in names]))
+            key = sha_constructor(smart_str(repr(items))).hexdigest()[:12]
+            self._alias_pattern = (items, pattern, key)
+        return self._alias_pattern[1:]
+    
+    def remap_assets(self, data):
+        """
+        Rewrites the quoted references to aliased images and files (see
+        :meth:`EPub.add_image`) in ``data``, a document of ``OEBPS/text``.
+        """
+        if not self.asset_aliases:
+            return data
+        def replace(match):
+            return '%s../%s%s%s' % (match.group(1), self.asset_aliases[match.group(2)], match.group(3) or '', match.group(1))
+        return self._get_aliases()[0].sub(replace, data)
+    
+    def get_aliases_key(self):
+        """
+        Identifies the current asset aliases, for the fingerprints of the
+        documents they are applied to.
+        """
+        if not self.asset_aliases:
+            return ''
+        return self._get_aliases()[1]
     
     # Generation stuff
+    def get_template(self, name):
+        """
+        Returns the compiled template ``name``, from :attr:`EPub.templates` if
+        it was passed in, otherwise from the process-wide template cache.
+        """
+        if name in self.templates:
+            return self.templates[name]
+        return get_cached_template(name)
+    
+    def get_template_key(self, name):
+        """
+        Returns a string identifying the template ``name``, for the article
+        cache. A template passed in is identified by its key in
+        :attr:`EPub.template_keys`.
+        
+        :returns: The key, or ``None`` for a template passed in without a key
+        """
+        if name in self.templates:
+            if name in self.template_keys:
+                return '%s:%s' % (name, self.template_keys[name])
+            return None
+        return get_template_key(name)
+    
+    def get_fingerprint(self):
+        """
+        Returns a string that changes whenever the generated ePub would,
+        without rendering anything: a hash of the metadata, the templates,
+        the static files, the size and modification time of the images, and
+        the ``content_hash`` of the articles. Entry timestamps are left out.
+        
+        :returns: The fingerprint, or ``None`` if an article has no
+                  ``content_hash`` or a template was passed in without a
+                  key, as their content cannot be known in advance
+        """
+        if [name for name in self.templates if name not in self.template_keys]:
+            return None
+        if [article for article in self.articles if not article['content_hash']]:
+            return None
+        tmpl_dir = os.path.join(os.path.dirname(__file__), 'templates', 'epub')
+        policy = get_policy(self.compression)
+        digest = sha_constructor()
+        digest.update(str(self.metadata))
+        for name in TEMPLATE_NAMES:
+            digest.update('\0%s' % self.get_template_key(name))
+        for name in ('mimetype', 'container.xml', 'stylesheet.css', 'pagetemplate.xpgt'):
+            digest.update('\0%s:%s' % (name, file_fingerprint(os.path.join(tmpl_dir, name))))
+        digest.update('\0%s:%s' % (policy.level, sorted(policy.rules.items())))
+        if self.image_pipeline is not None:
+            digest.update('\0%s' % self.image_pipeline.get_settings_key())
+        for item in self.images + self.files:
+            if item.get('source') is not None:
+                zinfo = item['source'].getinfo(item['dest'])
+                fingerprint = 'archived:%08x:%d' % (zinfo.CRC, zinfo.file_size)
+            else:
+                fingerprint = file_fingerprint(item['orig'])
+            digest.update('\0%s:%s:%s' % (item['dest'], item['mimetype'], fingerprint))
+        digest.update('\0%s' % self.get_aliases_key())
+        digest.update('\0%s' % self.contents_page_size)
+        for article in self.articles:
+            digest.update(smart_str(u'\0%s:%s:%s' % (article['title'], article['filename'], article['content_hash'])))
+            if article['section'] is not None:
+                digest.update(smart_str(u':%s' % article['section']))
+        return digest.hexdigest()
+    
     def generate_opf(self):
+        return u''.join(self.iter_opf())
+    
+    def iter_opf(self):
+        """
+        Yields ``content.opf`` piece by piece. While ``epub/content.opf`` is
+        the template of this application, or extends it only to fill its
+        ``addl*`` blocks, the document is written by :mod:`epub.package`
+        rather than rendered.
+        """
         context = template.Context({
             'metadata': self.metadata, 
             'articles': self.articles,
             'images': self.images,
             'files': self.files,
+            'contents': self.get_contents(),
         })
-        tpl = get_template('epub/content.opf')
-        return tpl.render(context=context)
+        blocks = package.get_extension_blocks(self, 'epub/content.opf')
+        if blocks is None:
+            return iter([self.get_template('epub/content.opf').render(context=context)])
+        return package.iter_opf(self, blocks, context)
     
     def generate_toc(self):
-        tmpl = get_template('epub/toc.ncx')
+        return u''.join(self.iter_toc())
+    
+    def iter_toc(self):
+        """
+        Yields ``toc.ncx`` piece by piece, like :meth:`EPub.iter_opf`.
+        """
         context = template.Context(dict(
             pub_id=self.metadata.unique_id['value'],
             title=self.metadata.title,
-            articles=self.articles
+            articles=self.articles,
+            contents=self.get_contents()
         ))
-        return tmpl.render(context)
+        blocks = package.get_extension_blocks(self, 'epub/toc.ncx')
+        if blocks is None:
+            return iter([self.get_template('epub/toc.ncx').render(context)])
+        return package.iter_ncx(self, blocks, context)
+    
+    def get_contents(self):
+        """
+        Returns the layout of the contents pages and of the navMap.
+        
+        :rtype: :class:`epub.contents.Contents`
+        """
+        return Contents(self.articles, self.contents_page_size)
     
-    def generate_contents(self):
-        tmpl = get_template('epub/contents.html')
+    def generate_contents(self, page=None):
+        """
+        Renders the contents page ``page``, a
+        :class:`epub.contents.ContentsPage`. **Default:** ``contents.html``.
+        """
+        if page is None:
+            page = self.get_contents().pages[0]
+        tmpl = self.get_template('epub/contents.html')
         context = template.Context(dict(
-            articles=self.articles
+            articles=page.articles,
+            page=page
         ))
         return tmpl.render(context)
     
     def generate_titlepage(self):
-        tmpl = get_template('epub/title_page.html')
+        tmpl = self.get_template('epub/title_page.html')
         context = template.Context(dict(
             title=self.metadata.title,
             description=self.metadata.description,
@@ -378,56 +918,481 @@ class EPub(object):
         ))
         return tmpl.render(context)
     
-    def generate_article(self, article):
-        tmpl = get_template('epub/article.html')
+    def render_article(self, article):
+        """
+        Renders the ``epub/article.html`` template for one article's content,
+        returning unicode.
+        """
+        tmpl = self.get_template('epub/article.html')
         context = template.Context(dict(
             article=article
         ))
-        tmplstr = tmpl.render(context)
-        return tmplstr.encode('ascii', 'xmlcharrefreplace')
+        return tmpl.render(context)
+    
+    def generate_article(self, article):
+        return self.render_article(article).encode('ascii', 'xmlcharrefreplace')
+    
+    def generate_epub(self, filepath, workers=None, previous=None, callback=None):
+        """
+        Writes the ePub to ``filepath``, which can be a path or any object with
+        a ``write`` method, such as an open file or an ``HttpResponse``. The
+        archive is written front to back without seeking, so the stream does
+        not need to support ``seek`` or ``tell``.
+        
+        :param workers: Optional. The number of threads used to render and
+                        compress the articles. The articles are still written
+                        in spine order, so the archive is identical to one
+                        built without workers. **Default:** ``None``, render
+                        the articles one at a time.
+        :type workers: ``int``
+        :param previous: Optional. The path to (or open file of) an earlier
+                         build of this ePub, for an incremental build. Images,
+                         static files and articles with an unchanged
+                         ``content_hash`` are copied from it as they are,
+                         without rendering or compressing them again. It must
+                         not be the same file as ``filepath``.
+        :type previous: ``string`` or ``file``
+        :param callback: Optional. Called with each entry of the
+                         :class:`epub.report.BuildReport` as soon as it is
+                         written. The ``epub.signals.entry_written`` signal is
+                         sent at the same time.
+        :type callback: ``callable``
+        :returns: The timings and sizes of the build
+        :rtype: :class:`epub.report.BuildReport`
+        :raises: Any error raised while writing the ePub, once it is logged.
+                 An incomplete file at ``filepath`` is removed.
+        """
+        epub = None
+        report = BuildReport()
+        self._check_sources(filepath)
+        if previous is not None:
+            previous = PreviousArchive(previous)
+        copy = None
+        try:
+            try:
+                epub, copy = self._open_archive(filepath)
+                for arcname in self._write_epub(epub, workers, previous, report, callback):
+                    pass
+                epub.close()
+                epub = None
+            except Exception:
+                logger.exception("Could not generate the ePub %s", filepath)
+                if epub is not None:
+                    epub.close()
+                    epub = None
+                    if isinstance(filepath, basestring) and os.path.exists(filepath):
+                        os.remove(filepath)
+                self._discard_copy(copy)
+                raise
+        finally:
+            if previous is not None:
+                previous.close()
+        self._finish(report, filepath, copy)
+        return report
+    
+    def generate_epub_async(self, filepath, workers=None, previous=None, callback=None):
+        """
+        Starts writing the ePub to ``filepath`` in a background thread and
+        returns at once. The parameters are the same as for
+        :meth:`EPub.generate_epub`, except that ``callback`` is called with
+        every build event, from the build thread.
+        
+        :returns: The running build, whose events can be iterated over
+        :rtype: :class:`epub.asyncbuild.AsyncBuild`
+        """
+        from epub.asyncbuild import AsyncBuild
+        return AsyncBuild(self, filepath, workers, previous, callback).start()
     
-    def generate_epub(self, filepath):
-        import zipfile, os
+    def iter_epub(self, chunk_size=64 * 1024, workers=None, previous=None, callback=None):
+        """
+        Generates the ePub as an iterator of strings, suitable as the content
+        of an ``HttpResponse``. The archive is never held in memory as a whole:
+        a chunk is yielded as soon as at least ``chunk_size`` bytes have been
+        written. ``workers``, ``previous`` and ``callback`` are the same as for
+        :meth:`EPub.generate_epub`.
+        """
+        report = BuildReport()
+        self._check_sources()
+        if previous is not None:
+            previous = PreviousArchive(previous)
+        stream = ZipStream()
+        epub, copy = self._open_archive(stream)
         try:
-            epub = zipfile.ZipFile(filepath, 'w', zipfile.ZIP_DEFLATED)
-            tmpl_dir = os.path.join(os.path.dirname(__file__),'templates','epub')
-            # Write the mimetype,without compression
-            mtypepath = os.path.abspath(os.path.join(tmpl_dir,'mimetype'))
-            epub.write(mtypepath,'mimetype', zipfile.ZIP_STORED)
-            
-            # Write META-INF/container.xml
-            contpath = os.path.abspath(os.path.join(tmpl_dir, 'container.xml'))
-            epub.write(contpath, 'META-INF/container.xml')
-            
-            # Write content.opf
-            epub.writestr('OEBPS/content.opf', self.generate_opf())
-            
-            # Write toc.ncx
-            epub.writestr('OEBPS/toc.ncx', self.generate_toc())
-            
-            # Write stylesheet
-            stylepath = os.path.abspath(os.path.join(tmpl_dir,'stylesheet.css'))
-            epub.write(stylepath, 'OEBPS/stylesheet.css')
-            
-            # write pagetemplate
-            pagetmplpath = os.path.abspath(os.path.join(tmpl_dir,'pagetemplate.xpgt'))
-            epub.write(pagetmplpath, 'OEBPS/pagetemplate.xpgt')
-            
-            # Write title page
-            epub.writestr('OEBPS/text/title_page.html', self.generate_titlepage())
-            
-            # Write contents
-            epub.writestr('OEBPS/text/contents.html', self.generate_contents())
-            
-            # Write images
-            for img in self.images:
-                epub.write(img['orig'], img['dest'])
-            
-            # Write articles
+            for arcname in self._write_epub(epub, workers, previous, report, callback):
+                if stream.size >= chunk_size:
+                    yield stream.drain()
+            epub.close()
+            self._finish(report, None, copy)
+            copy = None
+            yield stream.drain()
+        finally:
+            self._discard_copy(copy)
+            if previous is not None:
+                previous.close()
+    
+    def generate_volumes(self, filepath, max_articles=None, max_size=None, workers=None, callback=None):
+        """
+        Writes the ePub as several volumes, each a complete ePub holding the
+        next articles, in order, and the images and files they refer to. See
+        :mod:`epub.volumes`.
+        
+        :param filepath: The path of each volume, with ``%d`` standing for
+                         its number, starting at 1. It can also be a callable
+                         taking the number and returning the path, or an
+                         object with a ``write`` method for that volume.
+        :param max_articles: Optional. The most articles in a volume.
+        :type max_articles: ``int``
+        :param max_size: Optional. The most bytes of compressed articles,
+                         images and files in a volume. An article bigger
+                         than that gets a volume of its own.
+        :type max_size: ``int``
+        :param workers: The same as for :meth:`EPub.generate_epub`.
+        :param callback: The same as for :meth:`EPub.generate_epub`.
+        :returns: The report of each volume
+        :rtype: ``list`` of :class:`epub.report.BuildReport`
+        """
+        from epub.volumes import VolumeBuilder
+        return VolumeBuilder(self, filepath, max_articles, max_size).generate(workers, callback)
+    
+    def _get_sources(self):
+        """
+        Returns the reopened books the articles, images and files are copied
+        from. See :meth:`epub.reader.EPubReader.reopen`.
+        """
+        sources = {}
+        for item in itertools.chain(self.articles, self.images, self.files):
+            if item['source'] is not None:
+                sources[id(item['source'])] = item['source']
+        return sources.values()
+    
+    def _check_sources(self, filepath=None, sources=None):
+        """
+        Makes sure the entries copied from reopened books can be read while
+        the ePub is written to ``filepath``.
+        
+        :raises: ``ValueError`` if a book is closed, or is ``filepath``
+                 itself, which would be truncated while it is read
+        """
+        if sources is None:
+            sources = self._get_sources()
+        for source in sources:
+            if getattr(source, 'closed', False):
+                raise ValueError("The ePub %s that entries are copied from is closed." % source.path)
+            path = getattr(source, 'path', None)
+            if path is not None and isinstance(filepath, basestring) and os.path.exists(filepath) \
+                    and os.path.samefile(path, filepath):
+                raise ValueError("The ePub cannot be written over %s, which entries are copied from." % path)
+    
+    def _record(self, report, callback, stage, zinfo, stats):
+        """
+        Adds an entry to the build report and tells whoever is listening.
+        """
+        entry = report.add(stage, zinfo, stats)
+        logger.debug("%(stage)s %(name)s: %(size)d bytes, %(compressed_size)d compressed, %(seconds).4fs", entry)
+        entry_written.send(sender=self, **entry)
+        if callback is not None:
+            callback(entry)
+    
+    def _open_archive(self, filepath, date_time=None):
+        """
+        Returns the :class:`EPubZipFile` writing to ``filepath``, and the
+        temporary file a copy of the archive is written to, if it is to be
+        validated but is not written to a path.
+        """
+        copy = None
+        if self.validator is not None and not isinstance(filepath, basestring):
+            copy = tempfile.NamedTemporaryFile(suffix='.epub', delete=False)
+            if isinstance(filepath, ZipStream):
+                filepath.copy = copy
+            else:
+                filepath = StreamWriter(filepath, copy)
+        return EPubZipFile(filepath, date_time or self.date_time, self.compression), copy
+    
+    def _discard_copy(self, copy):
+        if copy is not None:
+            copy.close()
+            os.remove(copy.name)
+    
+    def _finish(self, report, filepath=None, copy=None):
+        report.finish()
+        if copy is not None:
+            copy.close()
+            try:
+                self._validate(report, copy.name)
+            finally:
+                os.remove(copy.name)
+        elif self.validator is not None and isinstance(filepath, basestring):
+            self._validate(report, filepath)
+        logger.info("Generated ePub: %d entries, %d bytes in %.3fs", len(report.entries), report.compressed_size, report.seconds)
+        build_finished.send(sender=self, report=report)
+    
+    def _validate(self, report, filepath):
+        """
+        Runs the :attr:`EPub.validator` on the ePub just written to
+        ``filepath``.
+        """
+        start = time.time()
+        report.problems = self.validator.validate(filepath)
+        report.validation_seconds = time.time() - start
+        for problem in report.problems:
+            logger.warning("Invalid ePub %s: %s", filepath, problem)
+    
+    def _write_file(self, epub, report, callback, previous, stage, filepath, arcname, compress_type=None, mime_type=None):
+        stats = {}
+        zinfo = epub.write_file(filepath, arcname, compress_type, previous, stats, mime_type, self.shared_parts)
+        self._record(report, callback, stage, zinfo, stats)
+        return arcname
+    
+    def _copy_entry(self, epub, report, callback, stage, source, arcname):
+        zinfo, data = source.copy_entry(arcname, epub.date_time)
+        epub.write_compressed(zinfo, data)
+        self._record(report, callback, stage, zinfo, {'reused': True})
+        return arcname
+    
+    def _write_chunks(self, epub, report, callback, stage, arcname, chunks, mime_type):
+        stats = {}
+        zinfo = epub.write_chunks(arcname, chunks, stats=stats, mime_type=mime_type)
+        self._record(report, callback, stage, zinfo, stats)
+        return arcname
+    
+    def _write_document(self, epub, report, callback, stage, arcname, render, mime_type):
+        start = time.time()
+        data = render()
+        if mime_type == 'application/xhtml+xml':
+            data = self.remap_assets(data)
+        stats = {'render': time.time() - start}
+        zinfo = epub.write_data(arcname, data, stats=stats, mime_type=mime_type)
+        self._record(report, callback, stage, zinfo, stats)
+        return arcname
+    
+    def _write_epub(self, epub, workers=None, previous=None, report=None, callback=None):
+        """
+        Writes every entry of the ePub into ``epub``, an :class:`EPubZipFile`,
+        yielding the name of each entry after it is written. Unchanged entries
+        are copied from ``previous``, a :class:`PreviousArchive`, if given.
+        Each entry is recorded in ``report``, a :class:`BuildReport`.
+        """
+        if report is None:
+            report = BuildReport()
+        tmpl_dir = os.path.join(os.path.dirname(__file__),'templates','epub')
+        # Write the mimetype,without compression
+        mtypepath = os.path.abspath(os.path.join(tmpl_dir,'mimetype'))
+        yield self._write_file(epub, report, callback, previous, 'mimetype', mtypepath, 'mimetype', zipfile.ZIP_STORED)
+        
+        # Write META-INF/container.xml
+        contpath = os.path.abspath(os.path.join(tmpl_dir, 'container.xml'))
+        yield self._write_file(epub, report, callback, previous, 'container', contpath, 'META-INF/container.xml', mime_type='text/xml')
+        
+        # Write content.opf
+        yield self._write_chunks(epub, report, callback, 'opf', 'OEBPS/content.opf', self.iter_opf(), 'application/oebps-package+xml')
+        
+        # Write toc.ncx
+        yield self._write_chunks(epub, report, callback, 'ncx', 'OEBPS/toc.ncx', self.iter_toc(), 'application/x-dtbncx+xml')
+        
+        # Write stylesheet
+        stylepath = os.path.abspath(os.path.join(tmpl_dir,'stylesheet.css'))
+        yield self._write_file(epub, report, callback, previous, 'stylesheet', stylepath, 'OEBPS/stylesheet.css', mime_type='text/css')
+        
+        # write pagetemplate
+        pagetmplpath = os.path.abspath(os.path.join(tmpl_dir,'pagetemplate.xpgt'))
+        yield self._write_file(epub, report, callback, previous, 'pagetemplate', pagetmplpath, 'OEBPS/pagetemplate.xpgt', mime_type='application/vnd.adobe-page-template+xml')
+        
+        # Write title page
+        yield self._write_document(epub, report, callback, 'titlepage', 'OEBPS/text/title_page.html', self.generate_titlepage, 'application/xhtml+xml')
+        
+        # Write contents
+        for page in self.get_contents().pages:
+            yield self._write_document(epub, report, callback, 'contents', 'OEBPS/text/%s' % page.filename,
+                lambda: self.generate_contents(page), 'application/xhtml+xml')
+        
+        # Write images
+        for img in self.images:
+            if img.get('source') is not None:
+                yield self._copy_entry(epub, report, callback, 'image', img['source'], img['dest'])
+                continue
+            filepath = img['orig']
+            if self.image_pipeline is not None:
+                filepath = self.image_pipeline.process(filepath, img['mimetype'])
+            yield self._write_file(epub, report, callback, previous, 'image', filepath, img['dest'], mime_type=img['mimetype'])
+        
+        # Write other files
+        for item in self.files:
+            if item.get('source') is not None:
+                yield self._copy_entry(epub, report, callback, 'file', item['source'], item['dest'])
+                continue
+            yield self._write_file(epub, report, callback, previous, 'file', item['orig'], item['dest'], mime_type=item['mimetype'])
+        
+        # Write articles
+        for zinfo, data, stats in self._article_entries(epub, workers, previous):
+            epub.write_compressed(zinfo, data)
+            self._record(report, callback, 'article', zinfo, stats)
+            yield zinfo.filename
+    
+    def _load_content(self, article):
+        """
+        Returns the content of an article, loading it if it is a
+        :class:`epub.sources.LazyContent`. Lazy content is not kept.
+        """
+        content = article['content']
+        if isinstance(content, LazyContent):
+            content = content.load()
+        return content
+    
+    def _get_article_fingerprint(self, article, epub):
+        """
+        Returns the fingerprint an article is compressed into ``epub`` with,
+        by which an incremental build tells whether it has changed, or
+        ``None`` if it cannot be told.
+        """
+        fingerprint = article.get('content_hash')
+        if fingerprint:
+            # A template passed in without a key cannot be told from another
+            template_key = self.get_template_key('epub/article.html')
+            if template_key is None:
+                fingerprint = None
+            else:
+                fingerprint = '%s~%s' % (fingerprint, sha_constructor(template_key).hexdigest()[:12])
+        if fingerprint and self.asset_aliases:
+            fingerprint = '%s~%s' % (fingerprint, self.get_aliases_key())
+        return epub.policy.get_fingerprint(fingerprint)
+    
+    def _article_entry(self, article, epub, previous=None, content=None):
+        """
+        Renders and compresses one article for the :class:`EPubZipFile`
+        ``epub``, returning the result of
+        :func:`epub.archive.compress_entry` and the timings of each phase, or
+        copies it from ``previous`` if neither its ``content_hash`` nor the
+        article template has changed,
+        or from :attr:`EPub.shared_parts` if another EPub made it already.
+        Articles of a reopened book (see :meth:`epub.reader.EPubReader.reopen`)
+        are always copied from it.
+        ``content`` is the already loaded content of the article, if any.
+        """
+        arcname = 'OEBPS/text/%s' % article['filename']
+        if article.get('source') is not None:
+            return article['source'].copy_entry(arcname, epub.date_time) + ({'reused': True},)
+        compress_type = epub.policy.get_compress_type('application/xhtml+xml')
+        fingerprint = self._get_article_fingerprint(article, epub)
+        if previous is not None:
+            entry = previous.get(arcname, fingerprint, epub.date_time, compress_type)
+            if entry:
+                return entry + ({'reused': True},)
+        stats = {}
+        def make():
+            data = self.remap_assets(self._render_article(article, stats, content))
+            return compress_entry(arcname, data, compress_type, epub.date_time, fingerprint, stats, epub.policy.level)
+        if self.shared_parts is None:
+            zinfo, data = make()
+        else:
+            # Without a content_hash, only the same article can be shared, and
+            # without a template key, only what the same template rendered.
+            # Both are alive for as long as the parts are shared.
+            template_key = self.get_template_key('epub/article.html') or id(self.get_template('epub/article.html'))
+            key = ('article', article.get('content_hash') or id(article), template_key,
+                self.get_aliases_key(), fingerprint, compress_type, epub.policy.level)
+            zinfo, data = self.shared_parts.get(key, arcname, epub.date_time, make, stats)
+        return zinfo, data, stats
+    
+    def _render_article(self, article, stats=None, content=None):
+        """
+        Renders an article like :meth:`EPub.generate_article`, going through
+        :attr:`EPub.article_cache` if the article has a ``content_hash``.
+        The timings of rendering and encoding are stored in ``stats``.
+        """
+        if stats is None:
+            stats = {}
+        content_hash = article.get('content_hash')
+        cache = self.article_cache
+        if content_hash and self.get_template_key('epub/article.html') is None:
+            cache = None
+        if cache is not None and content_hash:
+            key = cache.make_key(self.get_template_key('epub/article.html'), content_hash)
+            data = cache.get(key)
+            if data is not None:
+                return data
+        
+        start = time.time()
+        if content is None:
+            content = self._load_content(article)
+        data = self.render_article(content)
+        rendered = time.time()
+        data = data.encode('ascii', 'xmlcharrefreplace')
+        stats['render'] = rendered - start
+        stats['encode'] = time.time() - rendered
+        
+        if cache is not None and content_hash:
+            cache.set(key, data)
+        return data
+    
+    def _article_entries(self, epub, workers=None, previous=None):
+        """
+        Yields the compressed entry of every article and its timings, in spine
+        order. With ``workers``, the articles are rendered and compressed in a
+        pool of threads; zlib releases the GIL while it compresses.
+        
+        Lazy content is always loaded in the calling thread, which owns the
+        database connection, and at most two articles per worker are loaded
+        ahead of the one being written.
+        """
+        if not workers:
             for article in self.articles:
-                epub.writestr('OEBPS/text/%s' % article['filename'], self.generate_article(article['content']))
-        except Exception, e:
-            print e
+                yield self._article_entry(article, epub, previous)
+            return
         
-        if epub:
-            epub.close()
\ No newline at end of file
+        from collections import deque
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(workers)
+        pending = deque()
+        compress_type = epub.policy.get_compress_type('application/xhtml+xml')
+        try:
+            for article in self.articles:
+                content = None
+                arcname = 'OEBPS/text/%s' % article['filename']
+                if article.get('source') is None and (previous is None or
+                        not previous.has(arcname, self._get_article_fingerprint(article, epub), compress_type)):
+                    content = self._load_content(article)
+                pending.append(pool.apply_async(self._article_entry, (article, epub, previous, content)))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+        finally:
+            pool.terminate()
+
+
+BUILD_JOB_STATUSES = (
+    ('queued', 'Queued'),
+    ('running', 'Running'),
+    ('done', 'Done'),
+    ('failed', 'Failed'),
+)
+
+# Some priorities of build jobs. Higher ones are built first.
+PRIORITY_BREAKING = 10
+PRIORITY_NORMAL = 0
+PRIORITY_ARCHIVE = -10
+
+class BuildJob(models.Model):
+    """
+    A request to build the ePub of ``product``, run by
+    :class:`epub.scheduler.BuildScheduler`. The ``fingerprint`` identifies
+    the content to build, so a job for content that is already queued or
+    built is not added again.
+    """
+    product = models.CharField(max_length=255, db_index=True)
+    fingerprint = models.CharField(max_length=64, blank=True)
+    priority = models.IntegerField(default=PRIORITY_NORMAL)
+    status = models.CharField(max_length=10, choices=BUILD_JOB_STATUSES, default='queued', db_index=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(blank=True, null=True)
+    finished = models.DateTimeField(blank=True, null=True)
+    output = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    # The product while the job is queued, so a product is only queued once
+    queue_key = models.CharField(max_length=255, unique=True, null=True, blank=True, editable=False)
+    
+    class Meta:
+        ordering = ('-priority', 'created')
+    
+    def __unicode__(self):
+        return u'%s (%s)' % (self.product, self.get_status_display())
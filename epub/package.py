@@ -0,0 +1,180 @@
+"""
+Writes ``content.opf`` and ``toc.ncx`` without going through the template
+engine.
+
+Rendering a ``{% for %}`` loop over tens of thousands of articles and images
+is slow, and the template engine builds the whole document as one string.
+The writers here produce the same documents as the templates in
+``templates/epub``, piece by piece, so they can be compressed into the
+archive as they are generated (see :meth:`epub.archive.EPubZipFile.write_chunks`).
+
+The writers are only used while the templates are the ones shipped with this
+application. A template passed to :class:`EPub` that extends
+``epub/content.opf`` and only fills its ``addlmetadata``, ``addlmanifest``,
+``addlspine`` or ``addlguide`` blocks keeps the writer too: just those blocks
+are rendered by the template engine. Any other template is rendered as it
+always was.
+"""
+import os
+
+from django.template.loader_tags import BlockNode, ExtendsNode
+from django.utils.encoding import force_unicode
+from django.utils.hashcompat import sha_constructor
+from django.utils.html import conditional_escape
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+# The blocks of each template that can be filled without giving up the writer
+EXTENSION_BLOCKS = {
+    'epub/content.opf': ('addlmetadata', 'addlmanifest', 'addlspine', 'addlguide'),
+    'epub/toc.ncx': (),
+}
+
+_stock_keys = {}
+
+
+def get_stock_key(name):
+    """
+    Returns the key of the template ``name`` shipped with this application,
+    in the form of :func:`epub.models.get_template_key`.
+    """
+    try:
+        return _stock_keys[name]
+    except KeyError:
+        f = open(os.path.join(TEMPLATE_DIR, name), 'rb')
+        try:
+            source = f.read()
+        finally:
+            f.close()
+        key = _stock_keys[name] = '%s:%s' % (name, sha_constructor(source).hexdigest())
+        return key
+
+
+def get_extension_blocks(epub, name):
+    """
+    Tells whether the template ``name`` of ``epub`` can be written natively.
+
+    :returns: The blocks that must still be rendered by the template engine,
+              by name, or ``None`` if the whole template must be
+    :rtype: ``dict``
+    """
+    from epub.models import get_template_key
+    if name not in epub.templates:
+        if get_template_key(name) == get_stock_key(name):
+            return {}
+        return None
+    if get_template_key(name) != get_stock_key(name):
+        return None
+    nodelist = getattr(epub.templates[name], 'nodelist', None)
+    if not nodelist or not isinstance(nodelist[0], ExtendsNode) or nodelist[0].parent_name != name:
+        return None
+    extends = nodelist[0]
+    for node in extends.nodelist.get_nodes_by_type(BlockNode):
+        if node.name not in EXTENSION_BLOCKS[name]:
+            return None
+    return dict([(node.name, node) for node in extends.nodelist if isinstance(node, BlockNode)])
+
+
+def _escape(value):
+    # What {{ value }} renders with autoescaping on
+    return conditional_escape(force_unicode(value))
+
+
+def _render_block(blocks, name, context):
+    if name not in blocks:
+        return u''
+    return blocks[name].render(context)
+
+
+def iter_opf(epub, blocks, context):
+    """
+    Yields the pieces of ``content.opf``, as rendered from the template
+    ``epub/content.opf`` with ``context``. ``blocks`` are the blocks returned
+    by :func:`get_extension_blocks`.
+    """
+    metadata = epub.metadata
+    yield u'<?xml version="1.0"?>\n'
+    yield u'<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="%s">\n' % _escape(metadata.unique_id['id'])
+    yield u' <metadata xmlns:dc="http://purl.org/dc/elements/1.1/" xmlns:opf="http://www.idpf.org/2007/opf">\n'
+    yield u'   %s\n' % force_unicode(metadata)
+    yield u'   %s\n' % _render_block(blocks, 'addlmetadata', context)
+    yield (u' </metadata>\n'
+        u' <manifest>\n'
+        u'  <item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml" />\n'
+        u'  <item id="style" href="stylesheet.css" media-type="text/css" />\n'
+        u'  <item id="pagetemplate" href="pagetemplate.xpgt" media-type="application/vnd.adobe-page-template+xml" />\n'
+        u'  <item id="titlepage" href="text/title_page.html" media-type="application/xhtml+xml" />\n'
+        u'  <item id="contents" href="text/contents.html" media-type="application/xhtml+xml" />')
+    contents = context['contents']
+    for page in contents.extra_pages:
+        yield u'<item id="%s" href="text/%s" media-type="application/xhtml+xml"/>' % (page.id, page.filename)
+    yield u'\n  '
+    for counter, item in enumerate(epub.articles):
+        yield u'<item id="article%d" href="text/%s" media-type="application/xhtml+xml"/>' % (
+            counter + 1, force_unicode(item['filename']))
+    yield u'\n  '
+    for counter, item in enumerate(epub.images):
+        yield u'<item id="img%d" href="images/%s" media-type="%s"/>' % (
+            counter + 1, force_unicode(item['filename']), _escape(item['mimetype']))
+    yield u'\n  '
+    for counter, item in enumerate(epub.files):
+        yield u'<item id="file%d" href="%s" media-type="%s"/>' % (
+            counter + 1, force_unicode(item['filename']), _escape(item['mimetype']))
+    yield u'\n %s</manifest>\n' % _render_block(blocks, 'addlmanifest', context)
+    yield (u' <spine toc="ncx">\n'
+        u'  <itemref idref="titlepage" />\n'
+        u'  <itemref idref="contents" />\n'
+        u'  ')
+    for idref in contents.iter_spine():
+        yield u'<itemref idref="%s" />' % idref
+    yield u'\n %s</spine>\n' % _render_block(blocks, 'addlspine', context)
+    yield (u' <guide>\n'
+        u'\t<reference type="toc" title="Contents" href="text/contents.html" />\n'
+        u' %s</guide>\n'
+        u'</package>') % _render_block(blocks, 'addlguide', context)
+
+
+def iter_ncx(epub, blocks, context):
+    """
+    Yields the pieces of ``toc.ncx``, as rendered from the template
+    ``epub/toc.ncx``. See :func:`iter_opf`.
+    """
+    contents = context['contents']
+    yield (u'<?xml version="1.0" encoding="UTF-8"?>\n'
+        u'<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">\n'
+        u'  <head>\n'
+        u'    <meta name="dtb:uid" content="%s"/>\n'
+        u'    <meta name="dtb:depth" content="%d"/>\n'
+        u'    <meta name="dtb:totalPageCount" content="0"/>\n'
+        u'    <meta name="dtb:maxPageNumber" content="0"/>\n'
+        u'  </head>\n'
+        u'  <docTitle>\n'
+        u'    <text>%s</text>\n'
+        u'  </docTitle>\n'
+        u'  <navMap>\n'
+        u'\t<navPoint id="titlepage" playOrder="1">\n'
+        u'      <navLabel><text>Title Page</text></navLabel>\n'
+        u'      <content src="text/title_page.html"/>\n'
+        u'    </navPoint>\n'
+        u'\t<navPoint id="contents" playOrder="2">\n'
+        u'      <navLabel><text>Contents</text></navLabel>\n'
+        u'      <content src="text/contents.html"/>\n'
+        u'    </navPoint>\n'
+        u'\t') % (_escape(context['pub_id']), contents.depth, _escape(context['title']))
+    for item in contents.iter_nav_points():
+        yield (u'\n'
+            u'    <navPoint id="%s" playOrder="%d">\n'
+            u'      <navLabel><text>%s</text></navLabel>\n'
+            u'      <content src="text/%s"/>') % (item.id, item.play_order, _escape(item.title), _escape(item.filename))
+        for child in item.children:
+            yield (u'\n'
+                u'      <navPoint id="%s" playOrder="%d">\n'
+                u'        <navLabel><text>%s</text></navLabel>\n'
+                u'        <content src="text/%s"/>\n'
+                u'      </navPoint>') % (child.id, child.play_order, _escape(child.title), _escape(child.filename))
+        yield (u'\n'
+            u'    </navPoint>\n'
+            u'\t')
+    yield (u'\n'
+        u'  </navMap>\n'
+        u'</ncx>')
@@ -0,0 +1,417 @@
+"""
+Reading single documents out of stored ePubs, and adding articles to them.
+
+Serving a chapter or the cover of a stored ePub should not mean unzipping
+all of it. An :class:`EPubReader` maps the archive into memory, indexes its
+central directory once, and reads the package file and the NCX only when
+they are asked for. Each document is then read with a single seek::
+
+    from epub.models import EPub
+
+    book = EPub.open('/srv/epub/2010-03-01.epub')
+    try:
+        print book.metadata.title
+        for article in book.articles:
+            print article['title'], article['filename']
+        chapter = book.read_article('front-page.html')
+        cover = book.get_cover()
+    finally:
+        book.close()
+
+The index of the central directory and the parsed package are cached by the
+path, size and modification time of the archive, so opening the same book
+again costs almost nothing.
+
+A book written by this package can also be reopened with
+:meth:`EPubReader.reopen` to add articles. The entries already in it are
+copied into the new archive as they are stored, without decompressing,
+rendering or compressing them again.
+"""
+import mmap
+import os
+import posixpath
+import re
+import struct
+import threading
+import urllib
+import zipfile
+import zlib
+
+from epub.archive import copy_entry
+from epub.records import Article, Asset
+from epub.validation import ElementTree, CONTAINER_NS, DC_NS, NCX_NS, OPF_NS
+
+OPF_ATTR = '{http://www.idpf.org/2007/opf}'
+
+# The manifest items of the documents every ePub of this package has
+STANDARD_ITEMS = ('ncx', 'style', 'pagetemplate', 'titlepage', 'contents')
+
+# The further contents pages, see epub.contents
+CONTENTS_PAGE_ID = re.compile(r'^contents\d+$')
+
+# The indexes of the archives opened so far, by path, size and modification time
+_index_cache = {}
+_index_cache_lock = threading.Lock()
+_INDEX_CACHE_SIZE = 1000
+
+
+def is_standard_item(item_id):
+    """
+    Tells whether the manifest item ``item_id`` is one of the documents
+    every ePub of this package has, rather than an article or an asset.
+    """
+    return item_id in STANDARD_ITEMS or CONTENTS_PAGE_ID.match(item_id) is not None
+
+
+def resolve_href(base, href):
+    """
+    Returns the name of the entry ``href`` refers to, relative to the entry
+    ``base``.
+    """
+    href = urllib.unquote(href.split('#', 1)[0])
+    return posixpath.normpath(posixpath.join(posixpath.dirname(base), href))
+
+
+class _Index(object):
+    """
+    What is known about one version of an archive: the entries of its central
+    directory by name and, once they are read, its package and NCX.
+    """
+    def __init__(self, fileobj):
+        zf = zipfile.ZipFile(fileobj)
+        self.names = zf.namelist()
+        self.entries = dict([(zinfo.filename, zinfo) for zinfo in zf.infolist()])
+        self.package = None
+        self.toc = None
+
+
+def _get_index(path, st, fileobj):
+    key = (os.path.abspath(path), st.st_size, st.st_mtime)
+    index = _index_cache.get(key)
+    if index is None:
+        index = _Index(fileobj)
+        _index_cache_lock.acquire()
+        try:
+            if len(_index_cache) >= _INDEX_CACHE_SIZE:
+                _index_cache.clear()
+            _index_cache[key] = index
+        finally:
+            _index_cache_lock.release()
+    return index
+
+
+def clear_index_cache():
+    """
+    Forgets the indexes of the archives opened so far.
+    """
+    _index_cache.clear()
+
+
+def read_metadata(element, unique_identifier=None):
+    """
+    Returns an :class:`epub.models.EPubMetadata` holding the content of the
+    ``<metadata>`` element of a package file.
+    """
+    from epub.models import EPubMetadata
+    metadata = EPubMetadata()
+    # Drop the identifier made up for a new book; the book has its own
+    metadata._metadata['identifier'] = []
+    for child in element:
+        if child.tag == OPF_NS + 'meta':
+            if child.get('name'):
+                metadata.add_meta(child.get('name'), child.get('content', ''))
+            continue
+        if not child.tag.startswith(DC_NS):
+            continue
+        tag = child.tag[len(DC_NS):]
+        value = (child.text or '').strip()
+        if tag == 'identifier':
+            if unique_identifier and child.get('id') == unique_identifier:
+                metadata.set_unique_id(value, child.get('id'), child.get(OPF_ATTR + 'scheme'))
+            else:
+                metadata.add_identifier(value, child.get('id'), child.get(OPF_ATTR + 'scheme'))
+        elif tag == 'creator':
+            metadata.add_creator(value, child.get(OPF_ATTR + 'file-as'), child.get(OPF_ATTR + 'role'))
+        elif tag == 'contributor':
+            metadata.add_contributor(value, child.get(OPF_ATTR + 'file-as'), child.get(OPF_ATTR + 'role'))
+        elif tag == 'date':
+            metadata.add_date(value, child.get(OPF_ATTR + 'event'))
+        elif tag in ('subject', 'relation', 'type'):
+            getattr(metadata, 'add_%s' % tag)(value)
+        else:
+            setattr(metadata, tag, value)
+    return metadata
+
+
+class EPubReader(object):
+    """
+    Random access to the entries and documents of the ePub at ``path``.
+    The archive is memory-mapped and several threads can read from it at the
+    same time.
+    """
+    closed = False
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            st = os.fstat(self._file.fileno())
+            if not st.st_size:
+                raise zipfile.BadZipfile("File is not a zip file")
+            self._index = _get_index(path, st, self._file)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+        self.closed = True
+
+    # The archive
+    def namelist(self):
+        return list(self._index.names)
+
+    def __contains__(self, name):
+        return name in self._index.entries
+
+    def getinfo(self, name):
+        """
+        Returns the :class:`zipfile.ZipInfo` of the entry ``name``.
+
+        :raises: ``KeyError`` if there is no such entry
+        """
+        try:
+            return self._index.entries[name]
+        except KeyError:
+            raise KeyError("There is no item named %r in the archive" % name)
+
+    def read_raw(self, name):
+        """
+        Returns the data of the entry ``name`` as it is stored, without
+        decompressing it.
+        """
+        zinfo = self.getinfo(name)
+        offset = zinfo.header_offset
+        fheader = struct.unpack(zipfile.structFileHeader, self._map[offset:offset + zipfile.sizeFileHeader])
+        if fheader[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipfile("Bad magic number for file header")
+        offset += zipfile.sizeFileHeader + fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH]
+        return self._map[offset:offset + zinfo.compress_size]
+
+    def read(self, name):
+        """
+        Returns the content of the entry ``name``.
+        """
+        zinfo = self.getinfo(name)
+        data = self.read_raw(name)
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        elif zinfo.compress_type != zipfile.ZIP_STORED:
+            raise zipfile.BadZipfile("Unsupported compression method %d for %s" % (zinfo.compress_type, name))
+        if zlib.crc32(data) & 0xffffffff != zinfo.CRC:
+            raise zipfile.BadZipfile("Bad CRC-32 for file %s" % name)
+        return data
+
+    def copy_entry(self, name, date_time, arcname=None):
+        """
+        Returns the entry ``name`` in the same form as
+        :func:`epub.archive.compress_entry`, to be written into another
+        archive as ``arcname`` with the timestamp ``date_time``.
+        """
+        return copy_entry(self.getinfo(name), arcname or name, date_time), self.read_raw(name)
+
+    # The package
+    def get_package(self):
+        """
+        Returns what the package file says about the book, reading it the
+        first time:
+
+        * ``path``: the name of the package file in the archive
+        * ``metadata``: an :class:`epub.models.EPubMetadata`, shared by
+          every reader of the same archive, so it should not be changed
+        * ``manifest``: the items of the manifest by id, each a ``dict`` with
+          the ``id``, the ``href`` and the ``path`` in the archive, and the
+          ``mimetype``
+        * ``items``: the same items, in the order of the manifest
+        * ``spine``: the ids of the items in the spine
+        * ``toc``: the id of the NCX
+        * ``cover``: the id of the cover image, if there is one
+        """
+        if self._index.package is None:
+            self._index.package = self._read_package()
+        return self._index.package
+    package = property(get_package)
+
+    def _read_opf(self):
+        container = ElementTree.fromstring(self.read('META-INF/container.xml'))
+        rootfile = container.find('%srootfiles/%srootfile' % (CONTAINER_NS, CONTAINER_NS))
+        if rootfile is None:
+            raise zipfile.BadZipfile("The container has no rootfile")
+        path = rootfile.get('full-path')
+        return path, ElementTree.fromstring(self.read(path))
+
+    def _read_package(self):
+        path, root = self._read_opf()
+        package = {'path': path, 'manifest': {}, 'items': [], 'spine': [], 'toc': None, 'cover': None}
+        for item in root.findall('%smanifest/%sitem' % (OPF_NS, OPF_NS)):
+            item = {
+                'id': item.get('id'),
+                'href': item.get('href'),
+                'path': resolve_href(path, item.get('href', '')),
+                'mimetype': item.get('media-type'),
+            }
+            package['manifest'][item['id']] = item
+            package['items'].append(item)
+        spine = root.find(OPF_NS + 'spine')
+        if spine is not None:
+            package['toc'] = spine.get('toc')
+            package['spine'] = [itemref.get('idref') for itemref in spine.findall(OPF_NS + 'itemref')]
+        element = root.find(OPF_NS + 'metadata')
+        if element is None:
+            element = []
+        package['metadata'] = read_metadata(element, root.get('unique-identifier'))
+        for meta in element:
+            if meta.tag == OPF_NS + 'meta' and meta.get('name') == 'cover':
+                package['cover'] = meta.get('content')
+        if package['cover'] is None:
+            for reference in root.findall('%sguide/%sreference' % (OPF_NS, OPF_NS)):
+                if reference.get('type') == 'cover':
+                    target = resolve_href(path, reference.get('href', ''))
+                    for item in package['items']:
+                        if item['path'] == target:
+                            package['cover'] = item['id']
+        return package
+
+    metadata = property(lambda x: x.package['metadata'])
+    manifest = property(lambda x: x.package['manifest'])
+    spine = property(lambda x: x.package['spine'])
+
+    def get_toc(self):
+        """
+        Returns the entries of the NCX, in order: a ``dict`` with the
+        ``title`` and the ``path`` in the archive of each ``navPoint``, and
+        the title of the ``navPoint`` it is nested in as its ``section``.
+        """
+        if self._index.toc is None:
+            toc = []
+            ncx = self.manifest.get(self.package['toc'])
+            if ncx is not None:
+                root = ElementTree.fromstring(self.read(ncx['path']))
+                nav_map = root.find(NCX_NS + 'navMap')
+                if nav_map is not None:
+                    self._read_nav_points(ncx['path'], nav_map, None, toc)
+            self._index.toc = toc
+        return self._index.toc
+    toc = property(get_toc)
+
+    def _read_nav_points(self, ncx_path, parent, section, toc):
+        for nav_point in parent.findall(NCX_NS + 'navPoint'):
+            title = (nav_point.findtext('%snavLabel/%stext' % (NCX_NS, NCX_NS)) or '').strip()
+            content = nav_point.find(NCX_NS + 'content')
+            if content is not None:
+                toc.append({
+                    'title': title,
+                    'path': resolve_href(ncx_path, content.get('src', '')),
+                    'section': section,
+                })
+            self._read_nav_points(ncx_path, nav_point, title, toc)
+
+    def get_articles(self):
+        """
+        Returns the articles of the book in spine order, leaving out the
+        title and contents pages. Each is a ``dict`` with the ``id`` of its
+        manifest item, its ``title`` and ``section`` from the NCX, its
+        ``filename`` and its ``path`` in the archive.
+        """
+        titles = {}
+        for nav in self.toc:
+            titles.setdefault(nav['path'], (nav['title'], nav['section']))
+        text_dir = posixpath.join(posixpath.dirname(self.package['path']), 'text')
+        articles = []
+        for item_id in self.spine:
+            item = self.manifest.get(item_id)
+            if item is None or is_standard_item(item_id):
+                continue
+            title, section = titles.get(item['path'], ('', None))
+            articles.append({
+                'id': item_id,
+                'title': title,
+                'section': section,
+                'filename': posixpath.relpath(item['path'], text_dir),
+                'path': item['path'],
+            })
+        return articles
+    articles = property(get_articles)
+
+    def read_item(self, item_id):
+        """
+        Returns the content of the manifest item ``item_id``.
+        """
+        try:
+            item = self.manifest[item_id]
+        except KeyError:
+            raise KeyError("There is no item %r in the manifest" % item_id)
+        return self.read(item['path'])
+
+    def read_article(self, filename):
+        """
+        Returns the XHTML of the article ``filename``, as given to
+        :meth:`EPub.add_article`.
+        """
+        text_dir = posixpath.join(posixpath.dirname(self.package['path']), 'text')
+        return self.read(posixpath.join(text_dir, filename))
+
+    def get_cover(self):
+        """
+        Returns the media type and the content of the cover image, or
+        ``None`` if the book has no cover. The cover is the item named by the
+        ``cover`` meta element or the ``cover`` reference of the guide.
+        """
+        item = self.manifest.get(self.package['cover'])
+        if item is None:
+            return None
+        return item['mimetype'], self.read(item['path'])
+
+    def reopen(self):
+        """
+        Returns an :class:`epub.models.EPub` holding the metadata, articles,
+        images and files of this book, to add articles to it. Its entries
+        are copied from this archive as they are stored when the new one is
+        written, so the reader must stay open until then. The new archive
+        cannot be written over this one: building it then raises
+        ``ValueError``, as does building it once the reader is closed.
+
+        :raises: ``ValueError`` if the book was not laid out by this package
+        """
+        from epub.models import EPub
+        path, root = self._read_opf()
+        epub = EPub()
+        element = root.find(OPF_NS + 'metadata')
+        if element is None:
+            element = []
+        epub._metadata = read_metadata(element, root.get('unique-identifier'))
+        oebps = posixpath.dirname(self.package['path'])
+        if oebps != 'OEBPS':
+            raise ValueError("Only ePubs written by this package can be reopened.")
+        spine_ids = set(self.spine)
+        for article in self.articles:
+            if posixpath.dirname(article['filename']) or article['filename'].startswith('.'):
+                raise ValueError("The article %s is not in OEBPS/text." % article['path'])
+            zinfo = self.getinfo(article['path'])
+            epub.articles.append(Article(title=article['title'], filename=article['filename'],
+                content_hash='archived:%08x:%d' % (zinfo.CRC, zinfo.file_size), section=article['section'],
+                source=self))
+        for item in self.package['items']:
+            if is_standard_item(item['id']) or item['id'] in spine_ids:
+                continue
+            href = posixpath.relpath(item['path'], oebps)
+            asset = Asset(dest=item['path'], mimetype=item['mimetype'], href=href, source=self)
+            if href.startswith('images/'):
+                asset.filename = href[len('images/'):]
+                epub.images.append(asset)
+            else:
+                asset.filename = href
+                epub.files.append(asset)
+        return epub
@@ -0,0 +1,308 @@
+"""
+The records :class:`EPub` keeps for its articles, images and files.
+
+Each is a small object with ``__slots__`` rather than a ``dict``, so tens of
+thousands of them take little memory. They still behave like the dicts they
+replace: ``article['filename']``, ``article.get('content_hash')`` and
+``article['content_hash'] = ...`` work as before, but only the fields of the
+record can be set. A ``dict`` put into a :class:`RecordList` is turned into a
+record, its missing fields left ``None``.
+
+The records are kept in a :class:`RecordList`, a ``list`` that also indexes
+them by file name, manifest id and, for images and files, the path they were
+added from. Those fields cannot be changed once a record is in a list, which
+would leave the indexes wrong: replace the record instead, with
+:meth:`RecordList.replace` or :meth:`EPub.replace_article`. As a record can be
+in more than one list, they stay read-only after it is taken out of one; a
+:meth:`Record.copy` of it can be changed.
+"""
+import posixpath
+
+
+class Record(object):
+    """
+    The base class of the records. Fields that are not given are ``None``.
+    """
+    # The fields a RecordList indexes the record by, which are read-only
+    __slots__ = ('_locked',)
+    _no_fields = frozenset()
+
+    def __setattr__(self, name, value):
+        if name in getattr(self, '_locked', self._no_fields):
+            raise AttributeError("The %s of a %s in a list cannot be changed; replace the %s instead." % (
+                name, self.__class__.__name__, self.__class__.__name__.lower()))
+        object.__setattr__(self, name, value)
+
+    def _lock(self, names):
+        locked = getattr(self, '_locked', self._no_fields)
+        if not locked.issuperset(names):
+            object.__setattr__(self, '_locked', locked.union(names))
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields.pop(name, None))
+        if fields:
+            raise TypeError("%s has no field %s" % (self.__class__.__name__, ', '.join(sorted(fields.keys()))))
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.__slots__
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        if key in self.__slots__:
+            return getattr(self, key)
+        return default
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def copy(self, **changes):
+        """
+        Returns a copy of the record, with the fields in ``changes`` changed.
+        """
+        fields = dict(self.items())
+        fields.update(changes)
+        return self.__class__(**fields)
+
+    def __repr__(self):
+        return '<%s: %s>' % (self.__class__.__name__, self.get('filename'))
+
+
+class Article(Record):
+    """
+    An article: its ``title``, its ``content`` (see :mod:`epub.sources`), the
+    ``filename`` of its document in ``OEBPS/text``, its ``content_hash`` and
+    the title of its ``section`` (see :mod:`epub.contents`). ``source`` is the
+    archive it is copied from, if it comes from a reopened book (see
+    :meth:`epub.reader.EPubReader.reopen`).
+    """
+    __slots__ = ('title', 'content', 'filename', 'content_hash', 'section', 'source')
+
+
+class Asset(Record):
+    """
+    An image or another file: the path it was added from (``orig``), its
+    name in the archive (``dest``), its ``filename`` and ``href`` relative to
+    ``OEBPS/images`` and ``OEBPS``, its ``mimetype`` and the ``hash`` of its
+    content. ``source`` is the same as for :class:`Article`.
+    """
+    __slots__ = ('orig', 'dest', 'filename', 'mimetype', 'href', 'hash', 'source')
+
+
+class RecordList(list):
+    """
+    A list of records, indexed by the field ``key`` and, if ``path_key`` is
+    given, by that field too. The manifest id of a record is ``id_prefix``
+    followed by its position, counting from 1, as in ``content.opf``.
+
+    Appending keeps the indexes up to date; any other change to the list
+    rebuilds them the next time they are used.
+
+    ``reserved`` is an optional regular expression matching the values of
+    ``key`` kept for other files, which :meth:`RecordList.make_unique`
+    never returns. A ``dict`` added to the list is turned into a
+    ``record_class``.
+    """
+    def __init__(self, records=(), id_prefix='item', key='filename', path_key=None, reserved=None, record_class=None):
+        self.record_class = record_class
+        list.__init__(self, self._records(records))
+        self.id_prefix = id_prefix
+        self.key = key
+        self.path_key = path_key
+        self.reserved = reserved
+        self._index = None
+        self._paths = None
+        self._suffixes = {}
+        self._lock(self)
+
+    def _record(self, record):
+        if self.record_class is not None and isinstance(record, dict):
+            return self.record_class(**record)
+        return record
+
+    def _records(self, records):
+        return [self._record(record) for record in records]
+
+    def _lock(self, records):
+        names = [name for name in (self.key, self.path_key) if name is not None]
+        for record in records:
+            if isinstance(record, Record):
+                record._lock(names)
+
+    def _build(self):
+        self._index = {}
+        self._paths = {}
+        for position, record in enumerate(self):
+            self._add(position, record)
+
+    def _add(self, position, record):
+        self._index.setdefault(record[self.key], position)
+        if self.path_key is not None:
+            self._paths.setdefault(record[self.path_key], position)
+
+    def _changed(self):
+        self._index = self._paths = None
+
+    def _get(self, index, value):
+        if self._index is None:
+            self._build()
+        position = getattr(self, index).get(value)
+        if position is None:
+            return None
+        return self[position]
+
+    def append(self, record):
+        record = self._record(record)
+        self._lock((record,))
+        list.append(self, record)
+        if self._index is not None:
+            self._add(len(self) - 1, record)
+
+    def get(self, value):
+        """
+        Returns the record whose ``key`` field is ``value``, or ``None``.
+        """
+        return self._get('_index', value)
+
+    def get_by_path(self, path):
+        """
+        Returns the first record whose ``path_key`` field is ``path``, or
+        ``None``.
+        """
+        return self._get('_paths', path)
+
+    def get_by_id(self, item_id):
+        """
+        Returns the record with the manifest id ``item_id``, or ``None``.
+        """
+        if not item_id.startswith(self.id_prefix):
+            return None
+        try:
+            position = int(item_id[len(self.id_prefix):]) - 1
+        except ValueError:
+            return None
+        if 0 <= position < len(self):
+            return self[position]
+        return None
+
+    def get_id(self, record):
+        """
+        Returns the manifest id of ``record``, or ``None`` if it is not in the
+        list.
+        """
+        if self._index is None:
+            self._build()
+        position = self._index.get(record[self.key])
+        if position is None or self[position] is not record:
+            return None
+        return '%s%d' % (self.id_prefix, position + 1)
+
+    def make_unique(self, value):
+        """
+        Returns ``value`` if no record has it as its ``key`` and it is not
+        reserved, otherwise ``value`` with ``-2``, ``-3``, ... added before
+        its extension.
+        """
+        if not self._taken(value):
+            return value
+        base, ext = posixpath.splitext(value)
+        number = self._suffixes.get(value, 2)
+        while self._taken('%s-%d%s' % (base, number, ext)):
+            number += 1
+        self._suffixes[value] = number + 1
+        return '%s-%d%s' % (base, number, ext)
+
+    def _taken(self, value):
+        if self.reserved is not None and self.reserved.match(value):
+            return True
+        return self.get(value) is not None
+
+    def replace(self, value, record):
+        """
+        Puts ``record`` in the place of the record whose ``key`` field is
+        ``value``.
+
+        :raises: ``KeyError`` if there is no such record
+        """
+        if self._index is None:
+            self._build()
+        position = self._index.get(value)
+        if position is None:
+            raise KeyError(value)
+        old = self[position]
+        record = self._record(record)
+        self._lock((record,))
+        list.__setitem__(self, position, record)
+        del self._index[value]
+        if self.path_key is not None and self._paths.get(old[self.path_key]) == position:
+            del self._paths[old[self.path_key]]
+        self._add(position, record)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = self._records(value)
+            self._lock(value)
+        else:
+            value = self._record(value)
+            self._lock((value,))
+        list.__setitem__(self, index, value)
+        self._changed()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._changed()
+
+    def __setslice__(self, i, j, records):
+        records = self._records(records)
+        self._lock(records)
+        list.__setslice__(self, i, j, records)
+        self._changed()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._changed()
+
+    def __iadd__(self, records):
+        for record in records:
+            self.append(record)
+        return self
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def insert(self, index, record):
+        record = self._record(record)
+        self._lock((record,))
+        list.insert(self, index, record)
+        self._changed()
+
+    def remove(self, record):
+        list.remove(self, record)
+        self._changed()
+
+    def pop(self, *args):
+        record = list.pop(self, *args)
+        self._changed()
+        return record
+
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        list.reverse(self)
+        self._changed()
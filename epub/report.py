@@ -0,0 +1,99 @@
+"""
+Timings and sizes collected while an :class:`EPub` is generated.
+"""
+import time
+
+# The parts of writing an entry that are timed, in seconds. Not every entry
+# goes through every one: static files are read, not rendered, and entries
+# copied from a previous build are neither.
+PHASES = ('read', 'render', 'encode', 'compress')
+
+
+class BuildReport(object):
+    """
+    Returned by :meth:`EPub.generate_epub`. Each item of ``entries`` is a dict
+    describing one entry of the archive:
+
+    * ``stage``: what the entry is, such as ``opf``, ``ncx``, ``article`` or
+      ``image``
+    * ``name``: the name of the entry in the archive
+    * ``size`` and ``compressed_size``: in bytes
+    * ``read``, ``render``, ``encode`` and ``compress``: the seconds spent in
+      each phase, ``0.0`` if the entry did not go through it
+    * ``seconds``: the total of the phases
+    * ``reused``: ``True`` if the entry was copied from a previous build,
+      or from another edition (see :mod:`epub.fanout`)
+
+    If the :class:`EPub` has a ``validator``, ``problems`` is the list of
+    :class:`epub.validation.Problem` it found, and ``validation_seconds`` the
+    time it took. Otherwise ``problems`` is ``None``.
+    """
+    def __init__(self):
+        self.entries = []
+        self.started = time.time()
+        self.finished = None
+        self.problems = None
+        self.validation_seconds = 0.0
+
+    def add(self, stage, zinfo, stats):
+        """
+        Records the entry ``zinfo`` and returns the new item of ``entries``.
+        ``stats`` holds the timings of the phases and, optionally, ``reused``.
+        """
+        entry = {
+            'stage': stage,
+            'name': zinfo.filename,
+            'size': zinfo.file_size,
+            'compressed_size': zinfo.compress_size,
+            'reused': stats.get('reused', False),
+        }
+        for phase in PHASES:
+            entry[phase] = stats.get(phase, 0.0)
+        entry['seconds'] = sum([entry[phase] for phase in PHASES])
+        self.entries.append(entry)
+        return entry
+
+    def finish(self):
+        self.finished = time.time()
+
+    def get_seconds(self):
+        """
+        The wall time of the build, including the time spent between entries.
+        """
+        return (self.finished or time.time()) - self.started
+    seconds = property(get_seconds)
+
+    size = property(lambda x: sum([entry['size'] for entry in x.entries]))
+    compressed_size = property(lambda x: sum([entry['compressed_size'] for entry in x.entries]))
+
+    def get_stages(self):
+        """
+        Sums the entries by stage.
+
+        :returns: ``{stage: {'count': ..., 'size': ..., 'compressed_size': ..., 'seconds': ..., <phase>: ...}}``
+        :rtype: ``dict``
+        """
+        stages = {}
+        for entry in self.entries:
+            totals = stages.setdefault(entry['stage'], dict(
+                [(key, 0) for key in ('count', 'size', 'compressed_size', 'seconds') + PHASES]))
+            totals['count'] += 1
+            for key in ('size', 'compressed_size', 'seconds') + PHASES:
+                totals[key] += entry[key]
+        return stages
+    stages = property(get_stages)
+
+    def __unicode__(self):
+        lines = [u'%-12s %6s %12s %12s %9s' % ('stage', 'count', 'size', 'compressed', 'seconds')]
+        for stage, totals in sorted(self.stages.items()):
+            lines.append(u'%-12s %6d %12d %12d %9.3f' % (
+                stage, totals['count'], totals['size'], totals['compressed_size'], totals['seconds']))
+        lines.append(u'%-12s %6d %12d %12d %9.3f' % (
+            'total', len(self.entries), self.size, self.compressed_size, self.seconds))
+        if self.problems is not None:
+            lines.append(u'%d problems found in %.3fs' % (len(self.problems), self.validation_seconds))
+            lines.extend([unicode(problem) for problem in self.problems])
+        return u'\n'.join(lines)
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
@@ -0,0 +1,232 @@
+"""
+Building ePubs in the background, from a queue kept in the database.
+
+Publishing a product adds a :class:`epub.models.BuildJob` instead of
+generating the ePub in the request::
+
+    from epub.scheduler import submit
+    from epub.models import PRIORITY_BREAKING
+
+    job = submit('todays-news', priority=PRIORITY_BREAKING)
+
+A :class:`BuildScheduler` runs the queued jobs on a few threads, highest
+priority first, in the web process or in the ``epub_worker`` management
+command. Only the database and the local file system are used, so several
+processes can share the queue.
+
+The ePub of a product comes from the ``EPUB_PROVIDER`` setting, called with
+``None`` for the request and the product as the ``slug`` (see
+:func:`epub.views.download`). The finished archives go into the archive cache
+of the download view, so it serves them without building them again.
+"""
+import datetime
+import logging
+import threading
+import traceback
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.db import IntegrityError, connection, transaction
+
+from epub.downloads import get_archive, get_default_archive_cache
+from epub.models import BuildJob, PRIORITY_NORMAL
+
+logger = logging.getLogger('epub')
+
+PENDING = ('queued', 'running')
+
+
+def submit(product, fingerprint='', priority=PRIORITY_NORMAL):
+    """
+    Queues a build of ``product``, unless one is already pending.
+
+    * If a job for ``product`` with the same ``fingerprint`` is queued or
+      running, that job is returned.
+    * If a job for ``product`` is queued with another fingerprint, it is
+      updated to build the new one, since the old content is out of date.
+      It keeps the higher of the two priorities.
+
+    A product has at most one queued job, which the database enforces with
+    the unique ``queue_key`` of the job: when two processes queue the same
+    product at once, the one that loses the race goes with the job of the
+    other.
+
+    :returns: The job that will build ``product``
+    :rtype: :class:`epub.models.BuildJob`
+    """
+    while True:
+        job = _find_pending(product, fingerprint, priority)
+        if job is not None:
+            return job
+        sid = transaction.savepoint()
+        try:
+            job = BuildJob.objects.create(product=product, fingerprint=fingerprint, priority=priority, queue_key=product)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            continue
+        transaction.savepoint_commit(sid)
+        return job
+
+
+def _find_pending(product, fingerprint, priority):
+    """
+    Returns the pending job of ``product`` that will build ``fingerprint``,
+    updating the queued one if needed, or ``None`` if a job must be added.
+    """
+    pending = BuildJob.objects.filter(product=product, status__in=PENDING)
+    for job in pending.filter(fingerprint=fingerprint):
+        if job.status == 'queued' and priority > job.priority:
+            BuildJob.objects.filter(pk=job.pk, status='queued').update(priority=priority)
+            job.priority = priority
+        return job
+    for job in pending.filter(status='queued'):
+        job.fingerprint = fingerprint
+        job.priority = max(job.priority, priority)
+        if BuildJob.objects.filter(pk=job.pk, status='queued').update(
+                fingerprint=job.fingerprint, priority=job.priority):
+            return job
+    return None
+
+
+def get_status(limit=50):
+    """
+    Returns the jobs by status: all the ``queued`` and ``running`` ones,
+    and the latest ``limit`` ``done`` and ``failed`` ones.
+
+    :rtype: ``dict``
+    """
+    status = {}
+    for name, label in BuildJob._meta.get_field('status').choices:
+        jobs = BuildJob.objects.filter(status=name)
+        if name not in PENDING:
+            jobs = jobs.order_by('-finished')[:limit]
+        status[name] = list(jobs)
+    return status
+
+
+class BuildScheduler(object):
+    """
+    Runs the queued :class:`epub.models.BuildJob`, ``workers`` at a time.
+
+    :param provider: A callable returning the :class:`EPub` of a product, or
+                     its dotted path. **Default:** the ``EPUB_PROVIDER``
+                     setting.
+    :param archive_cache: Where the ePubs are stored. **Default:** the archive
+                          cache of the download view.
+    :param poll_interval: How many seconds the threads started by
+                          :meth:`BuildScheduler.start` wait when the queue
+                          is empty.
+    """
+    def __init__(self, workers=2, provider=None, archive_cache=None, poll_interval=2.0):
+        self.workers = workers
+        self.provider = provider
+        self.archive_cache = archive_cache
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._threads = []
+
+    def get_provider(self):
+        return get_callable(self.provider or settings.EPUB_PROVIDER)
+
+    def claim(self):
+        """
+        Marks the next queued job as running and returns it, or ``None`` if
+        the queue is empty. Two schedulers never claim the same job.
+        """
+        while True:
+            jobs = list(BuildJob.objects.filter(status='queued')[:1])
+            if not jobs:
+                return None
+            job = jobs[0]
+            now = datetime.datetime.now()
+            if BuildJob.objects.filter(pk=job.pk, status='queued').update(status='running', started=now, queue_key=None):
+                job.status, job.started, job.queue_key = 'running', now, None
+                return job
+
+    def run_job(self, job):
+        """
+        Builds the ePub of ``job`` and records the outcome.
+        """
+        try:
+            epub = self.get_provider()(None, slug=job.product)
+            archive_cache = self.archive_cache or get_default_archive_cache()
+            key = epub.get_fingerprint() or 'job-%s' % job.pk
+            archive = get_archive(epub, archive_cache, key)
+            job.status, job.output, job.error = 'done', archive.path or key, ''
+        except Exception:
+            logger.exception("Could not build %s", job.product)
+            job.status, job.error = 'failed', traceback.format_exc()
+        job.finished = datetime.datetime.now()
+        BuildJob.objects.filter(pk=job.pk).update(
+            status=job.status, output=job.output, error=job.error, finished=job.finished)
+        return job
+
+    def run_pending(self, limit=None):
+        """
+        Runs queued jobs in this thread until the queue is empty, or
+        ``limit`` jobs have run.
+
+        :returns: The jobs that ran
+        """
+        done = []
+        while limit is None or len(done) < limit:
+            job = self.claim()
+            if job is None:
+                break
+            done.append(self.run_job(job))
+        return done
+
+    def _work(self):
+        try:
+            while not self._stop.isSet():
+                if not self.run_pending(limit=1):
+                    self._stop.wait(self.poll_interval)
+        finally:
+            # Each thread has a connection of its own
+            connection.close()
+
+    def start(self):
+        """
+        Starts ``workers`` threads that run the jobs as they are queued.
+        """
+        self._stop.clear()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def stop(self, wait=True):
+        """
+        Stops the threads once they finish the jobs they are running.
+        """
+        self._stop.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    def requeue_stale(self, seconds=3600):
+        """
+        Queues again the jobs that have been running for more than
+        ``seconds``, such as those of a worker process that was killed. A job
+        whose product was queued again in the meantime fails instead, as the
+        queued job builds newer content.
+
+        :returns: The number of jobs queued again
+        """
+        started = datetime.datetime.now() - datetime.timedelta(seconds=seconds)
+        count = 0
+        for job in BuildJob.objects.filter(status='running', started__lt=started):
+            sid = transaction.savepoint()
+            try:
+                count += BuildJob.objects.filter(pk=job.pk, status='running').update(
+                    status='queued', started=None, queue_key=job.product)
+            except IntegrityError:
+                transaction.savepoint_rollback(sid)
+                BuildJob.objects.filter(pk=job.pk, status='running').update(
+                    status='failed', error='Superseded by a newer build.', finished=datetime.datetime.now())
+            else:
+                transaction.savepoint_commit(sid)
+        return count
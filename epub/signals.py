@@ -0,0 +1,12 @@
+"""
+Signals sent while an :class:`EPub` is generated. The sender is the
+:class:`EPub` being built.
+"""
+from django.dispatch import Signal
+
+# Sent after each entry is written into the archive. The arguments are the
+# keys of a :class:`epub.report.BuildReport` entry.
+entry_written = Signal(providing_args=['stage', 'name', 'size', 'compressed_size', 'seconds', 'reused'])
+
+# Sent when the archive is complete.
+build_finished = Signal(providing_args=['report'])
@@ -0,0 +1,213 @@
+"""
+Article content that is only loaded when the article is written into the
+ePub, and released right after.
+
+An article's ``content`` is normally the object the ``epub/article.html``
+template renders, such as a model instance. It can also be a
+:class:`LazyContent`, whose :meth:`LazyContent.load` is called to get that
+object when the article is rendered. Only one article at a time is then held
+in memory, whatever the size of the book::
+
+    from epub.sources import FileContent
+
+    for path in sorted(glob.glob('columns/*.html')):
+        e.add_article(title, FileContent(path, headline=title))
+
+:meth:`EPub.add_article` also accepts a function, called when the article is
+written, or a generator of the chunks of text of the story. A generator can
+only be written once, so an ePub with one is built only once.
+"""
+import logging
+import os
+import types
+
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+logger = logging.getLogger('epub')
+
+# The story of an article whose row was deleted before it was written
+MISSING_STORY = u'<p>This article is no longer available.</p>'
+
+
+class LazyContent(object):
+    """
+    The base class of content that is loaded on demand. ``content_hash`` is
+    used as the ``content_hash`` of the article if none is given to
+    :meth:`EPub.add_article`.
+    """
+    content_hash = None
+
+    def load(self):
+        """
+        Returns the object to render with the article template.
+        """
+        raise NotImplementedError
+
+
+def make_story(story, headline=None, subhead=None, byline=None):
+    """
+    Returns the object the article template renders, with ``story`` as the
+    body.
+    """
+    return {'headline': headline, 'subhead': subhead, 'byline': byline, 'story': story}
+
+
+class CallableContent(LazyContent):
+    """
+    Content returned by ``func``, called with ``args`` and ``kwargs`` when the
+    article is written.
+    """
+    def __init__(self, func, *args, **kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+
+    def load(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class FileContent(LazyContent):
+    """
+    The body of an article, as HTML in the file at ``path``. It is read when
+    the article is written and decoded with ``encoding``. The
+    ``content_hash`` is made from the size and modification time of the file,
+    so the article is rendered again only when the file changes.
+    """
+    def __init__(self, path, headline=None, subhead=None, byline=None, encoding='utf-8'):
+        self.path = path
+        self.headline = headline
+        self.subhead = subhead
+        self.byline = byline
+        self.encoding = encoding
+        st = os.stat(path)
+        self.content_hash = sha_constructor(smart_str(u'%s:%s:%s:%s:%d:%d' % (
+            path, headline, subhead, byline, st.st_size, int(st.st_mtime)))).hexdigest()
+
+    def load(self):
+        f = open(self.path, 'rb')
+        try:
+            story = f.read().decode(self.encoding)
+        finally:
+            f.close()
+        return make_story(story, self.headline, self.subhead, self.byline)
+
+
+class ChunkedContent(LazyContent):
+    """
+    The body of an article, as the chunks of text yielded by ``chunks``. It
+    is either a generator, which can be written only once, or a function
+    returning one, which is called each time the article is written.
+    Loading a generator a second time raises ``ValueError``.
+    """
+    def __init__(self, chunks, headline=None, subhead=None, byline=None):
+        self.chunks = chunks
+        self.headline = headline
+        self.subhead = subhead
+        self.byline = byline
+        self.consumed = False
+
+    def load(self):
+        chunks = self.chunks
+        if callable(chunks):
+            chunks = chunks()
+        elif self.consumed:
+            raise ValueError("The chunks of %r were already written. Give a function returning them to write the article again." % self.headline)
+        else:
+            self.consumed = True
+        return make_story(u''.join(chunks), self.headline, self.subhead, self.byline)
+
+
+def get_lazy_content(content, title=None):
+    """
+    Wraps a function or a generator given as the ``content`` of an article
+    in a :class:`LazyContent`. Other content is returned as it is.
+    """
+    if isinstance(content, LazyContent):
+        return content
+    if isinstance(content, types.GeneratorType):
+        return ChunkedContent(content, headline=title)
+    if isinstance(content, (types.FunctionType, types.MethodType, types.BuiltinFunctionType)):
+        return CallableContent(content)
+    return content
+
+
+class MappedObject(object):
+    """
+    Gives the attributes the article template expects (``headline``,
+    ``subhead``, ``byline`` and ``story``) to an object that stores them
+    under other names. Any other attribute is looked up on the object itself.
+    """
+    def __init__(self, obj, aliases):
+        self._obj = obj
+        self._aliases = aliases
+
+    def __getattr__(self, name):
+        return getattr(self._obj, self._aliases.get(name, name))
+
+
+class QuerySetSource(object):
+    """
+    Loads the rows of a QuerySet, by primary key, ``chunk_size`` rows at a
+    time. Only one chunk is held in memory.
+
+    The primary keys are registered with :meth:`QuerySetSource.add` in the
+    order the articles will be written, so each chunk is loaded with a single
+    query, the first time one of its rows is asked for.
+    """
+    def __init__(self, queryset, chunk_size=100, aliases=None):
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+        self.aliases = aliases or {}
+        self._pks = []
+        self._positions = {}
+        self._chunk = {}
+        self._chunk_pks = set()
+
+    def add(self, pk, headline=None):
+        """
+        Registers a row and returns the :class:`QuerySetContent` that loads it.
+        ``headline`` is the headline of the placeholder written if the row is
+        deleted before it is loaded.
+        """
+        self._positions[pk] = len(self._pks)
+        self._pks.append(pk)
+        return QuerySetContent(self, pk, headline)
+
+    def get(self, pk):
+        """
+        Returns the row with the primary key ``pk``, loading its chunk if it
+        is not the current one.
+
+        :returns: The row, or ``None`` if it was deleted since it was added
+        """
+        if pk not in self._chunk_pks:
+            position = self._positions[pk]
+            pks = self._pks[position:position + self.chunk_size]
+            self._chunk = self.queryset.in_bulk(pks)
+            self._chunk_pks = set(pks)
+        obj = self._chunk.get(pk)
+        if obj is None:
+            return None
+        if self.aliases:
+            obj = MappedObject(obj, self.aliases)
+        return obj
+
+
+class QuerySetContent(LazyContent):
+    """
+    One row of a :class:`QuerySetSource`. A row deleted before it is loaded
+    is written as a placeholder story, :data:`MISSING_STORY`, so the article
+    the package file already lists is not left out.
+    """
+    def __init__(self, source, pk, headline=None):
+        self.source = source
+        self.pk = pk
+        self.headline = headline
+
+    def load(self):
+        obj = self.source.get(self.pk)
+        if obj is None:
+            logger.warning("The row %r of %s was deleted before it was written.", self.pk, self.source.queryset.model.__name__)
+            return make_story(MISSING_STORY, headline=self.headline)
+        return obj
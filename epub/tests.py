@@ -1,8 +1,23 @@
 from django.conf import settings
 from django.test import TestCase
-from epub.models import EPub, EPubMetadata, format_name
+from epub import models
+from epub.models import EPub, EPubMetadata, format_name, format_names, clear_name_cache
 from simplestory.models import Story
 
+def make_epub():
+    """
+    Builds an :class:`EPub` from the ``stories.json`` fixture.
+    """
+    import os
+    img_path = os.path.abspath(os.path.join(settings.APP,'example','simplestory','fixtures','dailytimes.svg'))
+    e = EPub()
+    e.metadata.title="A Good Day to Enjoy"
+    e.metadata.publisher = "Daily Times Publishing Inc"
+    e.metadata.add_date('2009-07-05')
+    e.add_image(img_path, 'logo.svg')
+    for item in Story.objects.all():
+        e.add_article(item.headline, item, item.slug+".html", item.byline.replace("by ", ""))
+    return e
 
 
 class TestEPub(TestCase):
@@ -41,6 +56,1029 @@ class TestEPub(TestCase):
             print retcode[1]
             raise Exception("epub is not valid.")
 
+class TestEPubStreaming(TestCase):
+    fixtures = ['stories.json']
+    
+    def testGenerateToStream(self):
+        import zipfile
+        from StringIO import StringIO
+        output = StringIO()
+        make_epub().generate_epub(output)
+        epub = zipfile.ZipFile(StringIO(output.getvalue()))
+        self.assertEquals(epub.testzip(), None)
+        first = epub.infolist()[0]
+        self.assertEquals(first.filename, 'mimetype')
+        self.assertEquals(first.compress_type, zipfile.ZIP_STORED)
+        self.assertEquals(output.getvalue()[30:38], 'mimetype')
+    
+    def testIterEPub(self):
+        import zipfile
+        from StringIO import StringIO
+        chunks = list(make_epub().iter_epub(chunk_size=1024))
+        self.assert_(len(chunks) > 1)
+        epub = zipfile.ZipFile(StringIO(''.join(chunks)))
+        self.assertEquals(epub.testzip(), None)
+        self.assertEquals(epub.read('mimetype'), 'application/epub+zip')
+        self.assert_('OEBPS/text/new-device-desirable-old-device-undesirable.html' in epub.namelist())
+
+    def testParallelBuild(self):
+        from StringIO import StringIO
+        e = make_epub()
+        e.date_time = (2009, 7, 5, 12, 0, 0)
+        serial, parallel = StringIO(), StringIO()
+        e.generate_epub(serial)
+        e.generate_epub(parallel, workers=3)
+        self.assertEquals(serial.getvalue(), parallel.getvalue())
+    
+    def testFailure(self):
+        import os, shutil, tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            e = make_epub()
+            e.add_image('/nonexistent/logo.svg')
+            path = os.path.join(directory, 'broken.epub')
+            self.assertRaises(OSError, e.generate_epub, path)
+            self.failIf(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+class TestQuerySetArticles(TestCase):
+    fixtures = ['stories.json']
+    
+    def testAddArticlesFromQuerySet(self):
+        import zipfile
+        from StringIO import StringIO
+        from epub.sources import LazyContent
+        e = EPub()
+        e.add_articles_from_queryset(Story.objects.order_by('pk'), chunk_size=2)
+        self.assertEquals(len(e.articles), 3)
+        self.assert_(isinstance(e.articles[0]['content'], LazyContent))
+        self.assertEquals(e.articles[0]['filename'], 'report-most-college-males-admit-regularly-getting.html')
+        self.assert_(u'I. P. Indere' in e.metadata._metadata['contributor'])
+        
+        output = StringIO()
+        e.generate_epub(output)
+        epub = zipfile.ZipFile(StringIO(output.getvalue()))
+        story = Story.objects.get(pk=3)
+        article = epub.read('OEBPS/text/%s.html' % story.slug)
+        self.assert_(story.story[:40] in article)
+        self.assert_(story.headline in epub.read('OEBPS/text/contents.html'))
+    
+    def testDeletedRow(self):
+        import zipfile
+        from StringIO import StringIO
+        from epub.sources import MISSING_STORY
+        e = EPub()
+        e.add_articles_from_queryset(Story.objects.order_by('pk'), chunk_size=2)
+        story = Story.objects.get(pk=2)
+        story.delete()
+        output = StringIO()
+        report = e.generate_epub(output)
+        self.assertEquals(len([entry for entry in report.entries if entry['stage'] == 'article']), 3)
+        article = zipfile.ZipFile(StringIO(output.getvalue())).read('OEBPS/text/%s.html' % story.slug)
+        self.assert_(MISSING_STORY in article and story.headline in article)
+    
+    def testFieldMapping(self):
+        e = EPub()
+        e.add_articles_from_queryset(Story.objects.order_by('pk'), fields={'title': 'slug', 'filename': None, 'byline': None, 'body': 'byline'})
+        self.assertEquals(e.articles[0]['filename'], 'report-most-college-males-admit-regularly-getting.html')
+        self.assertEquals(e.metadata._metadata['contributor'], {})
+        article = e._render_article(e.articles[0])
+        self.assert_('<p class="byline">I. P. Indere</p>\n\tI. P. Indere' in article)
+
+class TestLazySources(TestCase):
+    def testSources(self):
+        import os, tempfile, zipfile
+        from StringIO import StringIO
+        from epub.sources import FileContent
+        fd, path = tempfile.mkstemp(suffix='.html')
+        os.write(fd, u'<p>Caf\xe9 column</p>'.encode('utf-8'))
+        os.close(fd)
+        loaded = []
+        def load():
+            loaded.append(True)
+            return {'headline': 'Called', 'story': '<p>called</p>'}
+        def chunks():
+            for i in range(3):
+                yield u'<p>chunk %d</p>' % i
+        try:
+            e = EPub()
+            e.add_article('Column', FileContent(path, headline='Column'))
+            e.add_article('Called', load)
+            e.add_article('Chunks', chunks())
+            self.assert_(e.articles[0]['content_hash'])
+            self.assertEquals(loaded, [])
+            output = StringIO()
+            e.generate_epub(output)
+            self.assertEquals(loaded, [True])
+            # The generator is used up, so the article can't be written again
+            self.assertRaises(ValueError, e.generate_epub, StringIO())
+        finally:
+            os.remove(path)
+        
+        epub = zipfile.ZipFile(StringIO(output.getvalue()))
+        self.assert_('<p>Caf&#233; column</p>' in epub.read('OEBPS/text/column.html'))
+        self.assert_('<p>called</p>' in epub.read('OEBPS/text/called.html'))
+        self.assert_('<p>chunk 0</p><p>chunk 1</p><p>chunk 2</p>' in epub.read('OEBPS/text/chunks.html'))
+
+class TestAssets(TestCase):
+    def testDeduplication(self):
+        import os, shutil, tempfile, zipfile
+        from StringIO import StringIO
+        directory = tempfile.mkdtemp()
+        try:
+            photo = os.path.join(directory, 'photo.jpg')
+            f = open(photo, 'wb')
+            f.write(os.urandom(100))
+            f.close()
+            copy = os.path.join(directory, 'copy.jpg')
+            shutil.copyfile(photo, copy)
+            
+            e = EPub()
+            self.assertEquals(e.add_image(photo), 'images/photo.jpg')
+            self.assertEquals(e.add_image(copy, 'same.jpg'), 'images/photo.jpg')
+            self.assertEquals(len(e.images), 1)
+            e.add_article('One', {'headline': 'One', 'story': '<img src="../images/same.jpg" alt="" />'}, 'one.html')
+            output = StringIO()
+            e.generate_epub(output)
+            epub = zipfile.ZipFile(StringIO(output.getvalue()))
+            self.assertEquals(len([name for name in epub.namelist() if name.startswith('OEBPS/images/')]), 1)
+            self.assert_('src="../images/photo.jpg"' in epub.read('OEBPS/text/one.html'))
+            
+            other = os.path.join(directory, 'other.jpg')
+            f = open(other, 'wb')
+            f.write(os.urandom(100))
+            f.close()
+            e = EPub()
+            e.add_image(photo, 'a.jpg')
+            e.add_image(other, 'b.jpg')
+            self.assertEquals(e.add_image(copy, 'b.jpg'), 'images/a.jpg')
+            self.assertEquals(e.asset_aliases, {})
+            self.assertEquals(e.add_image(copy, 'c.jpg'), 'images/a.jpg')
+            self.assertEquals(e.add_image(os.path.join(directory, 'missing.jpg'), 'c.jpg'), 'images/c-2.jpg')
+            key = e.get_aliases_key()
+            e.asset_aliases['images/c.jpg'] = 'images/b.jpg'
+            self.assertNotEqual(e.get_aliases_key(), key)
+            self.assertEquals(e.remap_assets('"../images/c.jpg"'), '"../images/b.jpg"')
+        finally:
+            shutil.rmtree(directory)
+    
+    def testStreamLargeFiles(self):
+        import os, shutil, tempfile, zipfile
+        from StringIO import StringIO
+        from epub import archive
+        directory = tempfile.mkdtemp()
+        old_threshold = archive.STREAM_THRESHOLD
+        archive.STREAM_THRESHOLD = 1000
+        try:
+            photo = os.path.join(directory, 'photo.jpg')
+            font = os.path.join(directory, 'font.otf')
+            for path, data in ((photo, os.urandom(200000)), (font, 'glyph ' * 50000)):
+                f = open(path, 'wb')
+                f.write(data)
+                f.close()
+            e = EPub()
+            e.add_image(photo)
+            e.add_file(font, mime_type='application/vnd.ms-opentype')
+            output = StringIO()
+            e.generate_epub(output)
+            epub = zipfile.ZipFile(StringIO(output.getvalue()))
+            self.assertEquals(epub.testzip(), None)
+            self.assertEquals(epub.read('OEBPS/images/photo.jpg'), open(photo, 'rb').read())
+            self.assertEquals(epub.getinfo('OEBPS/images/photo.jpg').compress_type, zipfile.ZIP_STORED)
+            self.assertEquals(epub.read('OEBPS/font.otf'), 'glyph ' * 50000)
+            self.assert_(epub.getinfo('OEBPS/font.otf').compress_size < 300000)
+            self.assert_('href="font.otf"' in epub.read('OEBPS/content.opf'))
+        finally:
+            archive.STREAM_THRESHOLD = old_threshold
+            shutil.rmtree(directory)
+
+class TestFanOut(TestCase):
+    def testSharedArticles(self):
+        import zipfile
+        from StringIO import StringIO
+        from epub.fanout import FanOutBuilder
+        builder = FanOutBuilder()
+        for key in ('front', 'north', 'south', 'sports'):
+            builder.add_article(key, key.title(), {'headline': key.title(), 'story': '<p>%s</p>' % key}, author='Jane Doe')
+        builder.add_edition('north', ['north', 'front', 'sports'], {'title': 'North'})
+        builder.add_edition('south', ['front', 'south'], {'title': 'South'})
+        self.assertRaises(KeyError, builder.add_edition, 'east', ['east'])
+        outputs = {'north': StringIO(), 'south': StringIO()}
+        reports = builder.generate(outputs, workers=2)
+        
+        north = zipfile.ZipFile(StringIO(outputs['north'].getvalue()))
+        south = zipfile.ZipFile(StringIO(outputs['south'].getvalue()))
+        self.assertEquals(north.testzip(), None)
+        self.assertEquals([name for name in north.namelist() if name.startswith('OEBPS/text/') and name[11:] not in ('title_page.html', 'contents.html')],
+            ['OEBPS/text/north.html', 'OEBPS/text/front.html', 'OEBPS/text/sports.html'])
+        self.assert_('South' in south.read('OEBPS/content.opf'))
+        self.assert_('south.html' not in north.read('OEBPS/content.opf'))
+        self.assertEquals(north.read('OEBPS/text/front.html'), south.read('OEBPS/text/front.html'))
+        # Four articles and four static files, each compressed once
+        self.assertEquals(builder.shared_parts.made, 8)
+        self.assertEquals(len([entry for report in reports.values() for entry in report.entries if entry['reused']]), 5)
+
+class TestReader(TestCase):
+    def testReadAndAppend(self):
+        import os, shutil, tempfile, zipfile
+        from epub.validation import validate
+        directory = tempfile.mkdtemp()
+        try:
+            photo = os.path.join(directory, 'photo.jpg')
+            f = open(photo, 'wb')
+            f.write(os.urandom(100))
+            f.close()
+            e = EPub()
+            e.metadata.title = 'Daily Times'
+            e.metadata.add_meta('cover', 'img1')
+            e.add_image(photo)
+            e.add_article('Front Page', {'headline': 'Front Page', 'story': '<p>Today</p>'}, author='Jane Doe')
+            path = os.path.join(directory, 'book.epub')
+            e.generate_epub(path)
+            
+            book = EPub.open(path)
+            try:
+                self.assertEquals(book.metadata.title, 'Daily Times')
+                self.assertEquals(book.metadata.unique_id['value'], e.metadata.unique_id['value'])
+                self.assertEquals([(a['title'], a['filename']) for a in book.articles], [('Front Page', 'front-page.html')])
+                self.assert_('<p>Today</p>' in book.read_article('front-page.html'))
+                self.assertEquals(book.get_cover(), ('image/jpeg', open(photo, 'rb').read()))
+                
+                edition = book.reopen()
+                edition.add_article('Sports', {'headline': 'Sports', 'story': '<p>Scores</p>'})
+                new_path = os.path.join(directory, 'book2.epub')
+                report = edition.generate_epub(new_path)
+                self.assertEquals([entry['stage'] for entry in report.entries if entry['reused']], ['image', 'article'])
+                old = zipfile.ZipFile(path)
+                new = zipfile.ZipFile(new_path)
+                self.assertEquals(new.read('OEBPS/text/front-page.html'), old.read('OEBPS/text/front-page.html'))
+                self.assert_('Sports' in new.read('OEBPS/toc.ncx'))
+                self.assert_('Daily Times' in new.read('OEBPS/content.opf'))
+                self.assertEquals(validate(new_path), [])
+                
+                size = os.path.getsize(path)
+                self.assertRaises(ValueError, edition.generate_epub, path)
+                self.assertEquals(os.path.getsize(path), size)
+                self.assertRaises(ValueError, edition.generate_volumes, lambda number: path, max_articles=1)
+            finally:
+                book.close()
+            self.assertRaises(ValueError, edition.generate_epub, os.path.join(directory, 'book3.epub'))
+            self.assertRaises(ValueError, list, edition.iter_epub())
+        finally:
+            shutil.rmtree(directory)
+
+class TestVolumes(TestCase):
+    def testSplitByCount(self):
+        import os, shutil, tempfile, zipfile
+        from epub.reader import EPubReader
+        from epub.validation import validate
+        directory = tempfile.mkdtemp()
+        try:
+            for name in ('one.jpg', 'four.jpg', 'notes.txt'):
+                f = open(os.path.join(directory, name), 'wb')
+                f.write(os.urandom(100))
+                f.close()
+            e = EPub()
+            e.metadata.title = 'Daily Times'
+            e.add_image(os.path.join(directory, 'one.jpg'))
+            e.add_image(os.path.join(directory, 'four.jpg'))
+            e.add_file(os.path.join(directory, 'notes.txt'), mime_type='text/plain')
+            for number, word in enumerate(('one', 'two', 'three', 'four', 'five')):
+                story = '<p>%s</p>' % word
+                if word == 'one':
+                    story += '<img src="../images/one.jpg" alt="" />'
+                elif word == 'four':
+                    story += '<div style="background: url(../images/four.jpg)"></div>'
+                e.add_article(word, {'headline': word, 'story': story})
+            reports = e.generate_volumes(os.path.join(directory, 'vol%d.epub'), max_articles=2)
+            self.assertEquals(len(reports), 3)
+            
+            contents = []
+            for number in (1, 2, 3):
+                path = os.path.join(directory, 'vol%d.epub' % number)
+                self.assertEquals(validate(path), [])
+                book = EPubReader(path)
+                try:
+                    self.assertEquals(book.metadata.title, 'Daily Times, Volume %d' % number)
+                    self.assertEquals(book.metadata.unique_id['value'], '%s-vol%d' % (e.metadata.unique_id['value'], number))
+                    self.assert_(e.metadata.unique_id['value'] in book.metadata.relation)
+                    contents.append(([article['title'] for article in book.articles],
+                        sorted([name for name in book.namelist() if name.startswith('OEBPS/images/') or name.endswith('.txt')])))
+                finally:
+                    book.close()
+            self.assertEquals(contents, [
+                (['one', 'two'], ['OEBPS/images/one.jpg']),
+                (['three', 'four'], ['OEBPS/images/four.jpg']),
+                (['five'], ['OEBPS/notes.txt']),
+            ])
+            self.assertEquals(e.metadata.title, 'Daily Times')
+            
+            reports = e.generate_volumes(os.path.join(directory, 'big%d.epub'), max_size=10 ** 6)
+            self.assertEquals(len(reports), 1)
+            
+            from StringIO import StringIO
+            self.assertRaises(TypeError, e.generate_volumes, StringIO(), max_articles=2)
+        finally:
+            shutil.rmtree(directory)
+
+class TestRecords(TestCase):
+    def testIndexes(self):
+        e = EPub()
+        first = e.add_article('Weather', {'headline': 'Weather', 'story': 'Sunny'})
+        second = e.add_article('Weather', {'headline': 'Weather', 'story': 'Rainy'})
+        third = e.add_article('Weather', {'headline': 'Weather', 'story': 'Snowy'}, 'weather.html')
+        self.assertEquals([article['filename'] for article in e.articles], ['weather.html', 'weather-2.html', 'weather-3.html'])
+        self.assert_(e.get_article('weather-2.html') is second)
+        self.assert_(e.articles.get_by_id('article3') is third)
+        self.assertEquals(e.articles.get_id(second), 'article2')
+        self.assertEquals(e.get_article('missing.html'), None)
+        self.assertRaises(AttributeError, setattr, first, 'author', 'Jane Doe')
+        self.assertRaises(KeyError, first.__setitem__, 'author', 'Jane Doe')
+        self.assertRaises(AttributeError, first.__setitem__, 'filename', 'renamed.html')
+        self.assertEquals(first.copy(filename='renamed.html')['filename'], 'renamed.html')
+        first['content_hash'] = 'changed'
+        
+        new = e.replace_article('weather-2.html', 'Weather', {'headline': 'Weather', 'story': 'Windy'})
+        self.assert_(e.articles[1] is new)
+        self.assert_(e.get_article('weather-2.html') is new)
+        self.assertEquals(e.articles.get_id(second), None)
+        self.assertRaises(KeyError, e.replace_article, 'missing.html', 'Missing', {})
+        
+        e.articles.reverse()
+        self.assertEquals(e.articles.get_id(first), 'article3')
+        e.articles = [first]
+        self.assert_(e.get_article('weather.html') is first)
+        
+        e.add_image(__file__, 'tests.py', 'text/plain')
+        self.assert_(e.images.get_by_path(__file__) is e.images[0])
+        self.assert_(e.images.get('images/tests.py') is e.images[0])
+        self.assertRaises(AttributeError, setattr, e.images[0], 'orig', 'other.py')
+        
+        # Dicts are turned into records, and a record is locked only once
+        from StringIO import StringIO
+        e.articles.append({'title': 'Plain', 'content': {'headline': 'Plain', 'story': ''}, 'filename': 'plain.html'})
+        e.articles.insert(0, {'title': 'First', 'content': {'headline': 'First', 'story': ''}, 'filename': 'first.html'})
+        self.assertEquals([article['section'] for article in e.articles], [None, None, None])
+        self.assert_(e.get_article('plain.html') is e.articles[2])
+        e.articles.append(e.articles.pop())
+        self.assertEquals(e.articles[2]._locked, frozenset(['filename']))
+        e.generate_epub(StringIO())
+
+class TestPackageWriter(TestCase):
+    def render(self, e, name, **context):
+        from django.template import Context
+        return e.get_template(name).render(Context(context))
+    
+    def testSameAsTemplates(self):
+        import os
+        from epub import package
+        e = EPub()
+        e.metadata.title = u'Caf\xe9 & "Bar" <News>'
+        e.metadata.add_creator(u'Jos\xe9 O\'Neil')
+        for title in (u'Tom & Jerry', u'<b>"Quoted"</b>', u'Caf\xe9', u"It's"):
+            e.add_article(title, {'headline': title, 'story': ''})
+        e.add_image(__file__, 'one.py', 'text/x-python')
+        e.add_file(os.path.join(os.path.dirname(__file__), 'models.py'), 'two.unknown')
+        self.assertEquals(e.images[0]['filename'], 'one.py')
+        e.files[0]['mimetype'] = None
+        self.assertEquals(package.get_extension_blocks(e, 'epub/content.opf'), {})
+        for sections in ((), (u'News & Views', u'Sports', None)):
+            for position, article in enumerate(e.articles):
+                article['section'] = sections and sections[min(position, 2)] or None
+            e.contents_page_size = sections and 1 or None
+            self.assertEquals(e.generate_opf(), self.render(e, 'epub/content.opf', metadata=e.metadata,
+                articles=e.articles, images=e.images, files=e.files, contents=e.get_contents()))
+            self.assertEquals(e.generate_toc(), self.render(e, 'epub/toc.ncx', pub_id=e.metadata.unique_id['value'],
+                title=e.metadata.title, articles=e.articles, contents=e.get_contents()))
+    
+    def testExtensionBlocks(self):
+        from django.template import Template
+        from epub import package
+        tmpl = Template('{% extends "epub/content.opf" %}{% block addlmanifest %}<item id="{{ files|length }}" />{% endblock %}')
+        e = EPub({'epub/content.opf': tmpl})
+        e.add_article('One', {'headline': 'One', 'story': ''})
+        self.assertEquals(package.get_extension_blocks(e, 'epub/content.opf').keys(), ['addlmanifest'])
+        opf = e.generate_opf()
+        self.assert_('<item id="0" /></manifest>' in opf)
+        self.assertEquals(opf, self.render(e, 'epub/content.opf', metadata=e.metadata,
+            articles=e.articles, images=e.images, files=e.files, contents=e.get_contents()))
+        
+        tmpl = Template('{% extends "epub/content.opf" %}{% block spine %}{% endblock %}')
+        e = EPub({'epub/content.opf': tmpl})
+        self.assertEquals(package.get_extension_blocks(e, 'epub/content.opf'), None)
+        self.assert_('<spine toc="ncx"></spine>' in e.generate_opf())
+
+class TestContents(TestCase):
+    def testPages(self):
+        e = EPub()
+        e.contents_page_size = 2
+        for number in range(5):
+            e.add_article('Story %d' % number, {'headline': 'Story', 'story': ''})
+        contents = e.get_contents()
+        self.assertEquals([page.filename for page in contents.pages], ['contents.html', 'contents_2.html', 'contents_3.html'])
+        self.assertEquals(contents.depth, 1)
+        self.assertEquals(list(contents.iter_spine())[:3], ['contents2', 'contents3', 'article1'])
+        self.assert_('<item id="contents3" href="text/contents_3.html"' in e.generate_opf())
+        html = e.generate_contents(contents.pages[1])
+        self.assert_('story-2.html' in html and 'story-3.html' in html and 'story-4.html' not in html)
+        self.assert_('<a href="contents.html">Previous</a> | <a href="contents_3.html">Next</a>' in html)
+        
+        e.contents_page_size = None
+        self.assertEquals(len(e.get_contents().pages), 1)
+        self.assert_('<p class="pages">' not in e.generate_contents())
+        
+        # Articles are not given the names of the title and contents pages
+        for title in ('Contents', 'Contents 2', 'Contents_2', 'Title Page', 'Title_Page'):
+            e.add_article(title, {'headline': title, 'story': ''})
+        self.assertEquals([article['filename'] for article in e.articles[5:]],
+            ['contents-2.html', 'contents-2-2.html', 'contents_2-2.html', 'title-page.html', 'title_page-2.html'])
+    
+    def testSections(self):
+        import os, shutil, tempfile
+        from epub.validation import validate
+        e = EPub()
+        e.metadata.title = 'Daily Times'
+        e.contents_page_size = 2
+        for section, count in (('News', 3), ('Sports', 1)):
+            for number in range(count):
+                e.add_article('%s %d' % (section, number), {'headline': section, 'story': ''}, section=section)
+        contents = e.get_contents()
+        self.assertEquals([(page.filename, page.section) for page in contents.pages], [('contents.html', None),
+            ('contents_2.html', 'News'), ('contents_3.html', 'News'), ('contents_4.html', 'Sports')])
+        self.assertEquals(list(contents.iter_spine()), ['contents2', 'contents3', 'article1', 'article2',
+            'article3', 'contents4', 'article4'])
+        nav_points = list(contents.iter_nav_points())
+        self.assertEquals([(nav.id, nav.play_order, nav.filename) for nav in nav_points],
+            [('section1', 3, 'contents_2.html'), ('section2', 7, 'contents_4.html')])
+        self.assertEquals([nav.play_order for nav in nav_points[0].children], [4, 5, 6])
+        self.assert_('<meta name="dtb:depth" content="2"/>' in e.generate_toc())
+        self.assert_('<a href="contents_4.html">Sports</a>' in e.generate_contents())
+        
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'sections.epub')
+            e.generate_epub(path)
+            self.assertEquals(validate(path), [])
+            book = EPub.open(path)
+            try:
+                self.assert_('OEBPS/text/contents_4.html' in book)
+                self.assertEquals([(article['title'], article['section']) for article in book.articles],
+                    [('News 0', 'News'), ('News 1', 'News'), ('News 2', 'News'), ('Sports 0', 'Sports')])
+                reopened = book.reopen()
+                self.assertEquals([article['section'] for article in reopened.articles], ['News'] * 3 + ['Sports'])
+                self.assertEquals(reopened.files, [])
+            finally:
+                book.close()
+        finally:
+            shutil.rmtree(directory)
+        
+        # The list of sections is split into pages too
+        e = EPub()
+        e.contents_page_size = 2
+        for number in range(6):
+            e.add_article('Story %d' % number, {'headline': 'Story', 'story': ''}, section='Section %d' % number)
+        contents = e.get_contents()
+        self.assertEquals([len(page.sections or ()) for page in contents.pages], [2, 2, 2, 0, 0, 0, 0, 0, 0])
+        self.assertEquals(list(contents.iter_spine())[:4], ['contents2', 'contents3', 'contents4', 'article1'])
+        html = e.generate_contents(contents.pages[1])
+        self.assert_('<a href="contents_6.html">Section 2</a>' in html and 'Section 4' not in html)
+        self.assert_('<a href="contents.html">Previous</a> | <a href="contents_3.html">Next</a>' in html)
+
+class TestAsyncBuild(TestCase):
+    fixtures = ['stories.json']
+    
+    def testEvents(self):
+        import zipfile
+        from StringIO import StringIO
+        output = StringIO()
+        done = []
+        build = make_epub().generate_epub_async(output, workers=2)
+        events = list(build)
+        build.add_done_callback(done.append)
+        self.assertEquals(events[-1]['type'], 'finished')
+        self.assertEquals([event['type'] for event in events[:-1]], ['entry'] * 12)
+        self.assert_(build.done())
+        self.assert_(build.wait() is events[-1]['report'])
+        self.assertEquals(done, [build])
+        self.assertEquals(zipfile.ZipFile(StringIO(output.getvalue())).testzip(), None)
+    
+    def testFailure(self):
+        from StringIO import StringIO
+        e = EPub()
+        e.add_image('/nonexistent/logo.svg')
+        build = e.generate_epub_async(StringIO())
+        self.assertRaises(OSError, build.wait, 5)
+        self.assertEquals(list(build)[-1]['type'], 'failed')
+    
+    def testLastEventBeforeDone(self):
+        from StringIO import StringIO
+        seen = []
+        build = make_epub().generate_epub_async(StringIO(), callback=lambda event: seen.append((event['type'], build.done())))
+        build.wait(10)
+        # The waiter finds the last event, sent while the build was running
+        self.assertEquals(build.poll()[-1]['type'], 'finished')
+        self.assertEquals(seen[-1], ('finished', False))
+
+class TestCompressionPolicy(TestCase):
+    fixtures = ['stories.json']
+    
+    def testProfiles(self):
+        import zipfile
+        from StringIO import StringIO
+        from epub.archive import CompressionPolicy
+        e = make_epub()
+        sizes = {}
+        for profile in ('fast', 'max'):
+            e.compression = profile
+            output = StringIO()
+            e.generate_epub(output)
+            epub = zipfile.ZipFile(StringIO(output.getvalue()))
+            self.assertEquals(epub.testzip(), None)
+            sizes[profile] = sum([info.compress_size for info in epub.infolist()])
+        self.assert_(sizes['max'] < sizes['fast'])
+        
+        e.compression = CompressionPolicy(rules={'image/svg+xml': zipfile.ZIP_STORED, 'text/css': zipfile.ZIP_STORED})
+        output = StringIO()
+        e.generate_epub(output)
+        epub = zipfile.ZipFile(StringIO(output.getvalue()))
+        self.assertEquals(epub.getinfo('OEBPS/images/logo.svg').compress_type, zipfile.ZIP_STORED)
+        self.assertEquals(epub.getinfo('OEBPS/stylesheet.css').compress_type, zipfile.ZIP_STORED)
+        self.assertEquals(epub.getinfo('OEBPS/content.opf').compress_type, zipfile.ZIP_DEFLATED)
+        self.assertEquals(epub.getinfo('mimetype').compress_type, zipfile.ZIP_STORED)
+    
+    def testUnknownProfile(self):
+        from epub.archive import get_policy
+        self.assertRaises(ValueError, get_policy, 'tiny')
+
+class TestImagePipeline(TestCase):
+    def testProcess(self):
+        import os, shutil, tempfile, zipfile
+        from StringIO import StringIO
+        from epub.images import ImagePipeline, Image
+        if Image is None:
+            self.skipTest('PIL is not installed')
+        directory = tempfile.mkdtemp()
+        try:
+            photo = os.path.join(directory, 'photo.jpg')
+            Image.new('RGB', (2000, 1000), (200, 30, 30)).save(photo, 'JPEG', quality=100)
+            pipeline = ImagePipeline(max_dimension=500, cache_dir=os.path.join(directory, 'cache'))
+            processed = pipeline.process(photo, 'image/jpeg')
+            self.assertNotEquals(processed, photo)
+            self.assertEquals(Image.open(processed).size, (500, 250))
+            self.assertEquals(pipeline.process(photo, 'image/jpeg'), processed)
+            self.assertEquals(pipeline.process(photo, 'image/svg+xml'), photo)
+            
+            e = EPub()
+            e.image_pipeline = pipeline
+            e.add_image(photo)
+            output = StringIO()
+            e.generate_epub(output)
+            info = zipfile.ZipFile(StringIO(output.getvalue())).getinfo('OEBPS/images/photo.jpg')
+            self.assertEquals(info.compress_type, zipfile.ZIP_STORED)
+            self.assertEquals(info.file_size, os.path.getsize(processed))
+        finally:
+            shutil.rmtree(directory)
+
+class TestBuildReport(TestCase):
+    fixtures = ['stories.json']
+    
+    def testReport(self):
+        from StringIO import StringIO
+        from epub.signals import entry_written
+        e = make_epub()
+        received = []
+        def receiver(sender, **kwargs):
+            received.append(kwargs['name'])
+        entry_written.connect(receiver, sender=e)
+        try:
+            called = []
+            report = e.generate_epub(StringIO(), callback=called.append)
+        finally:
+            entry_written.disconnect(receiver, sender=e)
+        
+        self.assertEquals(len(report.entries), 12)
+        self.assertEquals(received, [entry['name'] for entry in report.entries])
+        self.assertEquals(called, report.entries)
+        stages = report.stages
+        self.assertEquals(stages['article']['count'], 3)
+        self.assertEquals(stages['image']['count'], 1)
+        self.assert_(stages['opf']['render'] > 0)
+        self.assert_(stages['article']['compressed_size'] < stages['article']['size'])
+        self.assert_(unicode(report).startswith(u'stage'))
+
+class TestValidation(TestCase):
+    fixtures = ['stories.json']
+    
+    def testValidBuild(self):
+        import os, tempfile
+        from epub.validation import Validator
+        fd, path = tempfile.mkstemp(suffix='.epub')
+        os.close(fd)
+        try:
+            e = make_epub()
+            e.validator = Validator()
+            report = e.generate_epub(path)
+            self.assertEquals([unicode(problem) for problem in report.problems], [])
+        finally:
+            os.remove(path)
+    
+    def testStreamBuilds(self):
+        import os
+        from StringIO import StringIO
+        from epub.validation import Validator
+        seen = []
+        class Recorder(Validator):
+            def validate(self, path):
+                seen.append((path, open(path, 'rb').read()))
+                return Validator.validate(self, path)
+        e = make_epub()
+        e.validator = Recorder()
+        output = StringIO()
+        report = e.generate_epub(output)
+        self.assertEquals(report.problems, [])
+        data = ''.join(e.iter_epub(chunk_size=1024))
+        self.assertEquals([content for path, content in seen], [output.getvalue(), data])
+        self.failIf([path for path, content in seen if os.path.exists(path)])
+    
+    def testProblems(self):
+        import zipfile
+        from StringIO import StringIO
+        from epub.validation import validate, check, InvalidEPub
+        output = StringIO()
+        make_epub().generate_epub(output)
+        source = zipfile.ZipFile(StringIO(output.getvalue()))
+        broken = StringIO()
+        dest = zipfile.ZipFile(broken, 'w', zipfile.ZIP_DEFLATED)
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if info.filename == 'OEBPS/images/logo.svg':
+                continue
+            if info.filename.endswith('.html'):
+                data = data.replace('</p>', '', 1)
+            dest.writestr(info.filename, data)
+        dest.close()
+        
+        problems = [unicode(problem) for problem in validate(StringIO(broken.getvalue()))]
+        self.assert_(u'ERROR: mimetype: The mimetype entry must not be compressed.' in problems)
+        self.assert_(u'ERROR: OEBPS/content.opf: The manifest item img1 refers to images/logo.svg, which does not exist.' in problems)
+        self.assert_([p for p in problems if p.startswith(u'ERROR: OEBPS/text/title_page.html: Not well-formed')])
+        self.assertRaises(InvalidEPub, check, StringIO(broken.getvalue()))
+
+class TestEpubCheck(TestCase):
+    fixtures = ['stories.json']
+    
+    def testParseOutput(self):
+        from epub.epubcheck import parse_output
+        problems = parse_output('Epubcheck Version 1.0.3\n\n'
+            'ERROR: book.epub/OEBPS/content.opf(12): element "foo" not allowed here\n'
+            'WARNING: book.epub: item (OEBPS/extra.css) exists in the zip file, but is not declared in the OPF file\n'
+            'Check finished with warnings or errors!\n', 'book.epub')
+        self.assertEquals([unicode(problem) for problem in problems], [
+            u'ERROR: OEBPS/content.opf(12): element "foo" not allowed here',
+            u'WARNING: : item (OEBPS/extra.css) exists in the zip file, but is not declared in the OPF file'])
+    
+    def testNoWorker(self):
+        from epub.epubcheck import EpubCheckPool
+        # A jrunscript that can't run the worker script leaves java -jar
+        pool = EpubCheckPool(jrunscript='false')
+        try:
+            self.assertEquals(pool.persistent, False)
+        finally:
+            pool.close()
+    
+    def testWorkerTimeout(self):
+        import os, shutil, tempfile, time
+        from epub.epubcheck import EpubCheckError, EpubCheckPool
+        directory = tempfile.mkdtemp()
+        def script(name, body):
+            path = os.path.join(directory, name)
+            open(path, 'w').write('#!/bin/sh\n' + body)
+            os.chmod(path, 0755)
+            return path
+        try:
+            # A worker that never gets ready is given up on
+            start = time.time()
+            pool = EpubCheckPool(jrunscript=script('hang', 'exec sleep 30\n'), timeout=1)
+            self.assertEquals(pool.persistent, False)
+            self.assert_(time.time() - start < 10)
+            
+            working = script('working', "printf 'epubcheck\\tready\\n'\n"
+                "while read path; do printf 'epubcheck\\tmessage\\terror\\tOEBPS/a.html\\t3\\tbad\\nepubcheck\\tdone\\tfalse\\n'; done\n")
+            pool = EpubCheckPool(jrunscript=working, timeout=5)
+            try:
+                self.assertEquals(pool.persistent, True)
+                self.assertEquals([unicode(problem) for problem in pool.check('book.epub').problems], [u'ERROR: OEBPS/a.html(3): bad'])
+            finally:
+                pool.close()
+            
+            # A worker that stops answering, or dies, on both tries is an error
+            for body in ('read path; exec sleep 30\n', 'read path; exit 1\n'):
+                pool = EpubCheckPool(jrunscript=script('stuck', "printf 'epubcheck\\tready\\n'\n" + body), persistent=True, timeout=1)
+                try:
+                    self.assertRaises(EpubCheckError, pool.check, 'book.epub')
+                finally:
+                    pool.close()
+        finally:
+            shutil.rmtree(directory)
+    
+    def testBatch(self):
+        import os, shutil, tempfile
+        from distutils.spawn import find_executable
+        from epub.epubcheck import EpubCheckPool
+        if find_executable('java') is None:
+            return
+        directory = tempfile.mkdtemp()
+        pool = EpubCheckPool(workers=2)
+        try:
+            paths = [os.path.join(directory, '%d.epub' % i) for i in range(3)]
+            for path in paths:
+                make_epub().generate_epub(path)
+            results = pool.validate_batch(paths)
+            self.assertEquals([result.path for result in results], paths)
+            self.assertEquals([result.errors for result in results], [[], [], []])
+        finally:
+            pool.close()
+            shutil.rmtree(directory)
+
+class TestDownloadView(TestCase):
+    fixtures = ['stories.json']
+    urls = 'epub.urls'
+    
+    def setUp(self):
+        import tempfile
+        from epub import downloads
+        self.directory = tempfile.mkdtemp()
+        self.old_cache = downloads._default_archive_cache
+        downloads._default_archive_cache = downloads.FileArchiveCache(self.directory)
+        self.old_provider = getattr(settings, 'EPUB_PROVIDER', None)
+        settings.EPUB_PROVIDER = 'simplestory.views.edition'
+    
+    def tearDown(self):
+        import shutil
+        from epub import downloads
+        downloads._default_archive_cache = self.old_cache
+        settings.EPUB_PROVIDER = self.old_provider
+        shutil.rmtree(self.directory)
+    
+    def testConditionalGet(self):
+        import zipfile
+        from StringIO import StringIO
+        response = self.client.get('/todays-news.epub')
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response['Content-Disposition'], 'attachment; filename=todays-news.epub')
+        content = response.content
+        epub = zipfile.ZipFile(StringIO(content))
+        self.assertEquals(epub.testzip(), None)
+        self.assertEquals(int(response['Content-Length']), len(content))
+        
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        response = self.client.get('/todays-news.epub', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 304)
+        response = self.client.get('/todays-news.epub', HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEquals(response.status_code, 304)
+        # Another book is another archive
+        response = self.client.get('/yesterdays-news.epub', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response['ETag'], etag)
+        
+        # An edited story is another archive
+        story = Story.objects.get(pk=1)
+        story.story += '<p>Correction</p>'
+        story.save()
+        response = self.client.get('/todays-news.epub', HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assert_('Correction' in zipfile.ZipFile(StringIO(response.content)).read('OEBPS/text/%s.html' % story.slug))
+    
+    def testSingleBuild(self):
+        import threading
+        from epub import downloads
+        cache = downloads.FileArchiveCache(self.directory)
+        built = []
+        original_build = cache.build
+        def build(key, epub):
+            built.append(key)
+            return original_build(key, epub)
+        cache.build = build
+        
+        # The articles are not loaded from the database, as the test database
+        # is not shared between threads.
+        e = EPub()
+        for i in range(20):
+            e.add_article(u'Story %d' % i, {'headline': u'Story %d' % i, 'story': u'caf\xe9 ' * 1000}, content_hash=u'%d' % i)
+        archives = []
+        def fetch():
+            archives.append(downloads.get_archive(e, cache))
+        threads = [threading.Thread(target=fetch) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(built), 1)
+        self.assertEquals(len(archives), 4)
+        self.assertEquals(len(set([archive.path for archive in archives])), 1)
+
+class TestBuildScheduler(TestCase):
+    fixtures = ['stories.json']
+    
+    def testQueue(self):
+        import os, shutil, tempfile
+        from epub.downloads import FileArchiveCache
+        from epub.models import BuildJob, PRIORITY_BREAKING, PRIORITY_ARCHIVE
+        from epub.scheduler import BuildScheduler, submit, get_status
+        old = submit('archive', 'a1', PRIORITY_ARCHIVE)
+        first = submit('news', 'n1')
+        # Duplicates are coalesced, and a newer fingerprint replaces the old
+        self.assertEquals(submit('news', 'n1').pk, first.pk)
+        newer = submit('news', 'n2', PRIORITY_BREAKING)
+        self.assertEquals(newer.pk, first.pk)
+        self.assertEquals(BuildJob.objects.get(pk=first.pk).fingerprint, 'n2')
+        self.assertEquals(BuildJob.objects.count(), 2)
+        self.assertEquals([job.pk for job in get_status()['queued']], [first.pk, old.pk])
+        
+        directory = tempfile.mkdtemp()
+        try:
+            scheduler = BuildScheduler(provider='simplestory.views.edition',
+                                       archive_cache=FileArchiveCache(directory))
+            jobs = scheduler.run_pending()
+            self.assertEquals([job.product for job in jobs], ['news', 'archive'])
+            self.assertEquals([job.status for job in jobs], ['done', 'done'])
+            self.assert_(os.path.exists(jobs[0].output))
+            self.assertEquals(len(get_status()['done']), 2)
+            self.assertEquals(scheduler.run_pending(), [])
+            # A finished build does not hold back a new one
+            self.assertNotEquals(submit('news', 'n2').pk, first.pk)
+            
+            # A product is queued only once, even by submits that race
+            import epub.scheduler
+            queued = submit('news', 'n3')
+            count = BuildJob.objects.count()
+            find_pending, calls = epub.scheduler._find_pending, []
+            def racing(*args):
+                calls.append(args)
+                if len(calls) == 1:
+                    # As if the other submit had not added its job yet
+                    return None
+                return find_pending(*args)
+            epub.scheduler._find_pending = racing
+            try:
+                self.assertEquals(submit('news', 'n3').pk, queued.pk)
+            finally:
+                epub.scheduler._find_pending = find_pending
+            self.assertEquals((len(calls), BuildJob.objects.count()), (2, count))
+            
+            # A stale job is not queued again next to a newer one
+            import datetime
+            running = scheduler.claim()
+            newest = submit('news', 'n4')
+            BuildJob.objects.filter(pk=running.pk).update(started=datetime.datetime(2009, 1, 1))
+            self.assertEquals(scheduler.requeue_stale(), 0)
+            self.assertEquals(BuildJob.objects.get(pk=running.pk).status, 'failed')
+            newest.delete()
+            BuildJob.objects.filter(pk=running.pk).update(status='running')
+            self.assertEquals(scheduler.requeue_stale(), 1)
+            self.assertEquals(scheduler.claim().pk, running.pk)
+        finally:
+            shutil.rmtree(directory)
+
+class TestBenchmark(TestCase):
+    def testRunCase(self):
+        from epub.benchmark import run_case, compare
+        result = run_case(5)
+        self.assertEquals(result['size'], 5)
+        self.assert_(result['output_bytes'] > 0)
+        self.assertEquals(run_case(5)['output_bytes'], result['output_bytes'])
+        rows = compare([result], [result])
+        self.assert_(('output_bytes' in [row[1] for row in rows]))
+        self.assertEquals(set([row[4] for row in rows]), set([1.0]))
+    
+    def testChildDied(self):
+        import os
+        from multiprocessing import Process, Queue
+        from epub.benchmark import _wait_for_result
+        child = Process(target=os._exit, args=(9,))
+        child.start()
+        self.assertRaises(RuntimeError, _wait_for_result, child, Queue())
+        self.assertEquals(child.exitcode, 9)
+
+class TestIncrementalBuild(TestCase):
+    def testReuseUnchangedArticles(self):
+        import zipfile
+        from StringIO import StringIO
+        first = EPub()
+        first.add_article('One', {'headline': 'One', 'story': 'first'}, 'one.html', content_hash='1')
+        first.add_article('Two', {'headline': 'Two', 'story': 'first'}, 'two.html', content_hash='2')
+        previous = StringIO()
+        first.generate_epub(previous)
+        
+        second = EPub()
+        second.add_article('One', {'headline': 'One', 'story': 'second'}, 'one.html', content_hash='1')
+        second.add_article('Two', {'headline': 'Two', 'story': 'second'}, 'two.html', content_hash='2b')
+        second.add_article('Three', {'headline': 'Three', 'story': 'second'}, 'three.html')
+        output = StringIO()
+        second.generate_epub(output, previous=StringIO(previous.getvalue()))
+        
+        epub = zipfile.ZipFile(StringIO(output.getvalue()))
+        self.assertEquals(epub.testzip(), None)
+        self.assert_('first' in epub.read('OEBPS/text/one.html'))
+        self.assert_('second' in epub.read('OEBPS/text/two.html'))
+        self.assert_('second' in epub.read('OEBPS/text/three.html'))
+        self.assert_(epub.getinfo('OEBPS/text/two.html').comment.startswith('2b~'))
+        
+        from django.template import Template
+        third = EPub({'epub/article.html': Template('<p>{{ article.story }}</p>')}, {'epub/article.html': 'v2'})
+        third.add_article('One', {'headline': 'One', 'story': 'third'}, 'one.html', content_hash='1')
+        output = StringIO()
+        report = third.generate_epub(output, previous=StringIO(previous.getvalue()))
+        self.assertEquals([entry['reused'] for entry in report.entries if entry['stage'] == 'article'], [False])
+        self.assert_('third' in zipfile.ZipFile(StringIO(output.getvalue())).read('OEBPS/text/one.html'))
+    
+    def testParallelReuse(self):
+        import threading, zipfile
+        from StringIO import StringIO
+        from epub.archive import CompressionPolicy
+        from epub.sources import CallableContent
+        loads = []
+        def load(story):
+            loads.append(threading.currentThread())
+            return {'headline': story, 'story': '<img src="../images/alias.py" alt="" />'}
+        def make(compression=None):
+            e = EPub()
+            e.compression = compression
+            e.add_image(__file__, 'tests.py')
+            e.add_image(__file__, 'alias.py')
+            for number in range(4):
+                e.add_article('Story %d' % number, CallableContent(load, 'Story %d' % number), content_hash=str(number))
+            return e
+        previous = StringIO()
+        make().generate_epub(previous)
+        del loads[:]
+        
+        make().generate_epub(StringIO(), workers=2, previous=StringIO(previous.getvalue()))
+        self.assertEquals(loads, [])
+        stored = CompressionPolicy(rules={'application/xhtml+xml': zipfile.ZIP_STORED})
+        make(stored).generate_epub(StringIO(), workers=2, previous=StringIO(previous.getvalue()))
+        self.assertEquals(loads, [threading.currentThread()] * 4)
+
+class TestArticleCache(TestCase):
+    def testLocMemEviction(self):
+        from epub.cache import LocMemArticleCache
+        cache = LocMemArticleCache(max_entries=2)
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        self.assertEquals(cache.get('a'), 'aaa')
+        cache.set('c', 'ccc')
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals(len(cache), 2)
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+        
+        cache = LocMemArticleCache(max_entries=None, max_bytes=5)
+        cache.set('a', 'aaa')
+        cache.set('b', 'bbb')
+        self.assertEquals(cache.get('a'), None)
+        self.assertEquals(cache.size, 3)
+    
+    def testSharedBetweenEPubs(self):
+        from epub.cache import LocMemArticleCache, DjangoArticleCache
+        for cache in (LocMemArticleCache(), DjangoArticleCache()):
+            for story in ('first', 'second'):
+                e = EPub()
+                e.article_cache = cache
+                e.add_article('One', {'headline': 'One', 'story': story}, 'one.html', content_hash='1')
+                self.assert_('first' in e._render_article(e.articles[0]))
+            self.assertEquals((cache.hits, cache.misses), (1, 1))
+            cache.clear()
+            self.assertEquals(cache.get(cache.make_key(e.get_template_key('epub/article.html'), '1')), None)
+    
+    def testPassedInTemplates(self):
+        from django.template import Template
+        from epub.cache import LocMemArticleCache
+        cache = LocMemArticleCache()
+        for story, keys in (('first', None), ('second', None), ('third', {'epub/article.html': 'v1'}), ('fourth', {'epub/article.html': 'v1'})):
+            tmpl = Template('<p>{{ article.story }}</p>')
+            e = EPub({'epub/article.html': tmpl}, keys)
+            e.article_cache = cache
+            e.add_article('One', {'headline': 'One', 'story': story}, 'one.html', content_hash='1')
+            self.assertEquals(e.get_fingerprint() is None, keys is None)
+            self.assert_(story in e._render_article(e.articles[0]) or story == 'fourth')
+        self.assertEquals((cache.hits, cache.misses), (1, 1))
+
+class TestTemplateCache(TestCase):
+    def testCachedTemplate(self):
+        from epub.models import get_cached_template, clear_template_cache
+        clear_template_cache()
+        tmpl = get_cached_template('epub/article.html')
+        self.assert_(get_cached_template('epub/article.html') is tmpl)
+        self.assert_(EPub().get_template('epub/article.html') is tmpl)
+        clear_template_cache()
+        self.assert_(get_cached_template('epub/article.html') is not tmpl)
+    
+    def testPreloadedTemplate(self):
+        from django.template import Template
+        tmpl = Template('<p>{{ article.headline }}</p>')
+        e = EPub(templates={'epub/article.html': tmpl})
+        self.assertEquals(e.generate_article({'headline': u'Caf\xe9'}), '<p>Caf&#233;</p>')
+
 class TestNameParsing(TestCase):
     def testNameParsing(self):
         test_data = (
@@ -54,8 +1092,25 @@ class TestNameParsing(TestCase):
         for testval, answer in test_data:
             self.assertEquals(format_name(testval), answer)
     
+    def testNameCache(self):
+        clear_name_cache()
+        names = ['Charles H. Pearson', 'Mary Kate L Van Hinder, Jr.', 'Charles H. Pearson']
+        self.assertEquals(format_names(names), ['Pearson, Charles H', 'Van Hinder Jr, Mary Kate L', 'Pearson, Charles H'])
+        self.assertEquals(len(models._name_cache), 2)
+        
+        old_size = models.NAME_CACHE_SIZE
+        models.NAME_CACHE_SIZE = 2
+        try:
+            format_name('Charles H. Pearson')
+            format_name('Ana de la Cruz')
+            # The least recently used name is dropped
+            self.assertEquals(models._name_cache.keys(), ['Charles H. Pearson', 'Ana de la Cruz'])
+        finally:
+            models.NAME_CACHE_SIZE = old_size
+            clear_name_cache()
+    
     def testMetadata(self):
-        results = u'<dc:publisher>Daily Times Publishing Inc</dc:publisher>\n<dc:language>en-US</dc:language>\n<dc:creator opf:file-as="Oordt, Corey J" opf:role="aut">Corey J Oordt</dc:creator>\n<dc:title>A Good Day to Enjoy</dc:title>\n<dc:date >2009-07-05</dc:date>\n<dc:relation>Uncle</dc:relation>\n<dc:relation>Grandmother</dc:relation>\n<dc:identifier opf:scheme="uuid" id="BookId">81ca5fdd-4546-42dd-8b81-86ad52d4c271</dc:identifier>\n<dc:subject>Zombies</dc:subject>\n<dc:subject>Apocolypse</dc:subject>\n<dc:subject>Teen Angst</dc:subject>'
+        results = u'<dc:title>A Good Day to Enjoy</dc:title>\n<dc:language>en-US</dc:language>\n<dc:identifier id="BookId" opf:scheme="uuid">81ca5fdd-4546-42dd-8b81-86ad52d4c271</dc:identifier>\n<dc:creator opf:file-as="Oordt, Corey J" opf:role="aut">Corey J Oordt</dc:creator>\n<dc:publisher>Daily Times Publishing Inc</dc:publisher>\n<dc:subject>Zombies</dc:subject>\n<dc:subject>Apocolypse</dc:subject>\n<dc:subject>Teen Angst</dc:subject>\n<dc:date>2009-07-05</dc:date>\n<dc:relation>Uncle</dc:relation>\n<dc:relation>Grandmother</dc:relation>'
         
         md = EPubMetadata()
         md.set_unique_id(value='81ca5fdd-4546-42dd-8b81-86ad52d4c271', id='BookId', scheme='uuid')
@@ -69,4 +1124,29 @@ class TestNameParsing(TestCase):
         md.add_subject("Teen Angst")
         md.add_relation("Uncle")
         md.add_relation("Grandmother")
-        self.assertEquals(unicode(md), results)
\ No newline at end of file
+        self.assertEquals(unicode(md), results)
+    
+    def testMetadataEscaping(self):
+        md = EPubMetadata()
+        md.set_unique_id(value='81ca5fdd-4546-42dd-8b81-86ad52d4c271', id='BookId', scheme='uuid')
+        md.title = u'Fish & Chips <Caf\xe9>'
+        md.add_contributor(u'Jos\xe9 "Pepe" Garc\xeda')
+        md.add_meta('cover', 'cover-image')
+        self.assertEquals(unicode(md), u'<dc:title>Fish &amp; Chips &lt;Caf\xe9&gt;</dc:title>\n<dc:language>en</dc:language>\n<dc:identifier id="BookId" opf:scheme="uuid">81ca5fdd-4546-42dd-8b81-86ad52d4c271</dc:identifier>\n<dc:contributor opf:file-as="Garc\xeda, Jos\xe9 &quot;Pepe&quot;" opf:role="aut">Jos\xe9 &quot;Pepe&quot; Garc\xeda</dc:contributor>\n<meta name="cover" content="cover-image" />')
+        self.assert_('<dc:title>Fish &amp; Chips &lt;Caf&#233;&gt;</dc:title>' in str(md))
+        # The stored values are left alone
+        self.assertEquals(md._metadata['contributor'][u'Jos\xe9 "Pepe" Garc\xeda']['opf:role'], 'aut')
+        
+        # The output is kept until the metadata changes
+        self.assert_(unicode(md) is unicode(md))
+        md.add_subject('Fish')
+        self.assert_(u'<dc:subject>Fish</dc:subject>' in unicode(md))
+        md.title = 'Chips'
+        self.assert_(unicode(md).startswith(u'<dc:title>Chips</dc:title>'))
+        
+        # The lists and dicts handed out are copies
+        md.subject.append('Chips')
+        md.unique_id['value'] = 'changed'
+        self.assertEquals(md.subject, ['Fish'])
+        self.assert_(u'<dc:subject>Chips</dc:subject>' not in unicode(md))
+        self.assert_(u'changed' not in unicode(md))
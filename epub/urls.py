@@ -1,5 +1,6 @@
 from django.conf.urls.defaults import *
 
+# The ePubs come from the EPUB_PROVIDER setting, which is called with the slug
 urlpatterns = patterns('',
-    url(r'^$', 'views.index', name='index'),
+    url(r'^(?P<slug>[-\w]+)\.epub$', 'epub.views.download', name='epub_download'),
 )
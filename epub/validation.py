@@ -0,0 +1,351 @@
+"""
+A fast structural check of an ePub, in pure Python.
+
+It reads the archive once and checks what most often goes wrong in a
+generated ePub:
+
+* the ``mimetype`` entry comes first, is stored uncompressed and holds
+  ``application/epub+zip``
+* ``META-INF/container.xml`` points to a package file that exists
+* the package file has the required metadata, its manifest points to files
+  that exist, and its spine and NCX refer to items of the manifest
+* every XML and XHTML document is well-formed
+
+It takes milliseconds, so it can check every build::
+
+    from epub.validation import Validator
+
+    e = EPub()
+    e.validator = Validator()
+    report = e.generate_epub('edition.epub')
+    for problem in report.problems:
+        print problem
+
+It is not a full validator: schemas, CSS and the content of the documents are
+not checked. The epubcheck jar in ``epub/bin`` still does that.
+"""
+import posixpath
+import struct
+import urllib
+import zipfile
+from xml.parsers import expat
+
+try:
+    from xml.etree import cElementTree as ElementTree
+except ImportError:
+    from xml.etree import ElementTree
+
+ERROR = 'error'
+WARNING = 'warning'
+
+MIMETYPE = 'application/epub+zip'
+OPF_MEDIA_TYPE = 'application/oebps-package+xml'
+NCX_MEDIA_TYPE = 'application/x-dtbncx+xml'
+XHTML_MEDIA_TYPES = ('application/xhtml+xml', 'text/x-oeb1-document', 'application/x-dtbook+xml')
+XML_MEDIA_TYPES = ('text/xml', 'application/xml', 'image/svg+xml', NCX_MEDIA_TYPE, OPF_MEDIA_TYPE)
+
+CONTAINER_NS = '{urn:oasis:names:tc:opendocument:xmlns:container}'
+OPF_NS = '{http://www.idpf.org/2007/opf}'
+DC_NS = '{http://purl.org/dc/elements/1.1/}'
+NCX_NS = '{http://www.daisy.org/z3986/2005/ncx/}'
+
+
+class Problem(object):
+    """
+    Something wrong with the entry ``path`` of an ePub, at ``line`` if it is
+    known. ``severity`` is ``error`` when reading systems may reject the
+    ePub, ``warning`` when it is only suspicious.
+    """
+    def __init__(self, severity, path, message, line=None):
+        self.severity = severity
+        self.path = path
+        self.message = message
+        self.line = line
+
+    is_error = property(lambda x: x.severity == ERROR)
+
+    def __unicode__(self):
+        if self.line is not None:
+            return u'%s: %s(%d): %s' % (self.severity.upper(), self.path, self.line, self.message)
+        return u'%s: %s: %s' % (self.severity.upper(), self.path, self.message)
+
+    def __str__(self):
+        return self.__unicode__().encode('utf-8')
+
+    def __repr__(self):
+        return '<Problem: %s>' % self
+
+
+class InvalidEPub(Exception):
+    """
+    Raised by :func:`check` with the ``problems`` found.
+    """
+    def __init__(self, problems):
+        self.problems = problems
+        Exception.__init__(self, '\n'.join([str(problem) for problem in problems]))
+
+
+class Validator(object):
+    """
+    Checks the structure of ePub archives.
+
+    :param check_xhtml: Whether the XHTML documents are parsed to check that
+                        they are well-formed. It is the slowest check, as it
+                        reads every document.
+    :type check_xhtml: ``bool``
+    """
+    def __init__(self, check_xhtml=True):
+        self.check_xhtml = check_xhtml
+
+    def validate(self, file):
+        """
+        Checks the ePub at ``file``, a path or an open file.
+
+        :returns: The problems found, an empty list if there are none
+        :rtype: ``list`` of :class:`Problem`
+        """
+        try:
+            zf = zipfile.ZipFile(file)
+        except (zipfile.BadZipfile, IOError), e:
+            return [Problem(ERROR, '', 'Not a zip archive: %s' % e)]
+        try:
+            validation = _Validation(zf, self.check_xhtml)
+            validation.run()
+            return validation.problems
+        finally:
+            zf.close()
+
+
+def validate(file, check_xhtml=True):
+    """
+    Checks the ePub at ``file`` with a :class:`Validator` and returns the
+    problems found.
+    """
+    return Validator(check_xhtml).validate(file)
+
+
+def check(file, check_xhtml=True):
+    """
+    Checks the ePub at ``file`` and raises :class:`InvalidEPub` if there are
+    any errors. Warnings are ignored.
+    """
+    errors = [problem for problem in validate(file, check_xhtml) if problem.is_error]
+    if errors:
+        raise InvalidEPub(errors)
+
+
+class _Validation(object):
+    """
+    The state of the validation of one archive.
+    """
+    def __init__(self, zf, check_xhtml):
+        self.zf = zf
+        self.check_xhtml = check_xhtml
+        self.names = set(zf.namelist())
+        self.problems = []
+
+    def error(self, path, message):
+        self.problems.append(Problem(ERROR, path, message))
+
+    def warning(self, path, message):
+        self.problems.append(Problem(WARNING, path, message))
+
+    def parse(self, path):
+        """
+        Returns the root element of the XML document ``path``, or ``None`` if
+        it is not well-formed.
+        """
+        try:
+            return ElementTree.fromstring(self.zf.read(path))
+        except SyntaxError, e:
+            # ElementTree.ParseError is a SyntaxError
+            self.error(path, 'Not well-formed: %s' % e)
+            return None
+
+    def resolve(self, base, href):
+        """
+        Returns the name of the entry ``href`` refers to, relative to the
+        entry ``base``, or ``None`` if it points outside of the archive.
+        """
+        href = urllib.unquote(href.split('#', 1)[0])
+        path = posixpath.normpath(posixpath.join(posixpath.dirname(base), href))
+        if path.startswith('../') or path.startswith('/'):
+            return None
+        return path
+
+    def run(self):
+        self.check_mimetype()
+        opf_path = self.check_container()
+        if opf_path is not None:
+            self.check_package(opf_path)
+
+    def check_mimetype(self):
+        infos = self.zf.infolist()
+        if not infos or infos[0].filename != 'mimetype':
+            self.error('mimetype', 'The mimetype entry must be the first entry of the archive.')
+            if 'mimetype' not in self.names:
+                return
+        zinfo = self.zf.getinfo('mimetype')
+        if zinfo.compress_type != zipfile.ZIP_STORED:
+            self.error('mimetype', 'The mimetype entry must not be compressed.')
+        if self._local_extra_length(zinfo):
+            self.error('mimetype', 'The mimetype entry must not have an extra field.')
+        if self.zf.read('mimetype') != MIMETYPE:
+            self.error('mimetype', 'The mimetype entry must contain exactly %r.' % MIMETYPE)
+
+    def _local_extra_length(self, zinfo):
+        fp = self.zf.fp
+        fp.seek(zinfo.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+        return header[zipfile._FH_EXTRA_FIELD_LENGTH]
+
+    def check_container(self):
+        """
+        Returns the name of the package file, or ``None`` if there is none to
+        check.
+        """
+        path = 'META-INF/container.xml'
+        if path not in self.names:
+            self.error(path, 'The archive has no container.xml.')
+            return None
+        root = self.parse(path)
+        if root is None:
+            return None
+        for rootfile in root.getiterator(CONTAINER_NS + 'rootfile'):
+            if rootfile.get('media-type') != OPF_MEDIA_TYPE:
+                continue
+            full_path = rootfile.get('full-path')
+            if not full_path:
+                self.error(path, 'The rootfile has no full-path.')
+            elif full_path not in self.names:
+                self.error(path, 'The package file %s does not exist.' % full_path)
+            else:
+                return full_path
+            return None
+        self.error(path, 'There is no rootfile of type %s.' % OPF_MEDIA_TYPE)
+        return None
+
+    def check_package(self, opf_path):
+        root = self.parse(opf_path)
+        if root is None:
+            return
+        self.check_metadata(opf_path, root)
+
+        # The manifest, by id
+        items = {}
+        hrefs = {}
+        manifest = root.find(OPF_NS + 'manifest')
+        if manifest is None:
+            self.error(opf_path, 'The package has no manifest.')
+            manifest = []
+        for item in manifest:
+            if item.tag != OPF_NS + 'item':
+                continue
+            item_id, href, media_type = item.get('id'), item.get('href'), item.get('media-type')
+            if not item_id or not href or not media_type:
+                self.error(opf_path, 'A manifest item needs an id, an href and a media-type: %s' % (item_id or href))
+                continue
+            if item_id in items:
+                self.error(opf_path, 'The id %s is used by more than one manifest item.' % item_id)
+            path = self.resolve(opf_path, href)
+            if path is None or path not in self.names:
+                self.error(opf_path, 'The manifest item %s refers to %s, which does not exist.' % (item_id, href))
+                path = None
+            elif path in hrefs:
+                self.error(opf_path, 'The manifest items %s and %s refer to the same file.' % (hrefs[path], item_id))
+            else:
+                hrefs[path] = item_id
+            items[item_id] = (path, media_type)
+
+        for name in sorted(self.names):
+            if name not in hrefs and name != opf_path and name != 'mimetype' and not name.startswith('META-INF/'):
+                self.warning(name, 'The file is not in the manifest.')
+
+        self.check_spine(opf_path, root, items)
+
+        for item_id, (path, media_type) in items.items():
+            if path is None:
+                continue
+            if media_type in XHTML_MEDIA_TYPES:
+                if self.check_xhtml:
+                    self.check_well_formed(path)
+            elif media_type in XML_MEDIA_TYPES and media_type != NCX_MEDIA_TYPE:
+                self.parse(path)
+
+    def check_metadata(self, opf_path, root):
+        metadata = root.find(OPF_NS + 'metadata')
+        if metadata is None:
+            self.error(opf_path, 'The package has no metadata.')
+            return
+        for name in ('title', 'language', 'identifier'):
+            element = metadata.find(DC_NS + name)
+            if element is None or not (element.text or '').strip():
+                self.error(opf_path, 'The metadata must have a dc:%s.' % name)
+        unique_id = root.get('unique-identifier')
+        self.unique_id = None
+        for element in metadata.findall(DC_NS + 'identifier'):
+            if unique_id and element.get('id') == unique_id:
+                self.unique_id = (element.text or '').strip()
+        if self.unique_id is None:
+            self.error(opf_path, 'The unique-identifier %s is not the id of a dc:identifier.' % unique_id)
+
+    def check_spine(self, opf_path, root, items):
+        spine = root.find(OPF_NS + 'spine')
+        if spine is None:
+            self.error(opf_path, 'The package has no spine.')
+            return
+        itemrefs = spine.findall(OPF_NS + 'itemref')
+        if not itemrefs:
+            self.error(opf_path, 'The spine is empty.')
+        for itemref in itemrefs:
+            idref = itemref.get('idref')
+            if idref not in items:
+                self.error(opf_path, 'The spine refers to %s, which is not in the manifest.' % idref)
+            elif items[idref][1] not in XHTML_MEDIA_TYPES:
+                self.warning(opf_path, 'The spine item %s is not an XHTML document.' % idref)
+
+        toc = spine.get('toc')
+        if not toc or toc not in items:
+            self.error(opf_path, 'The spine must refer to the NCX in the manifest with its toc attribute.')
+            return
+        ncx_path, media_type = items[toc]
+        if media_type != NCX_MEDIA_TYPE:
+            self.error(opf_path, 'The NCX must have the media-type %s, not %s.' % (NCX_MEDIA_TYPE, media_type))
+        if ncx_path is not None:
+            self.check_ncx(ncx_path, items)
+
+    def check_ncx(self, ncx_path, items):
+        root = self.parse(ncx_path)
+        if root is None:
+            return
+        for meta in root.getiterator(NCX_NS + 'meta'):
+            if meta.get('name') == 'dtb:uid' and self.unique_id is not None and \
+                    (meta.get('content') or '').strip() != self.unique_id:
+                self.error(ncx_path, 'The dtb:uid does not match the unique identifier of the package.')
+        paths = set([path for path, media_type in items.values()])
+        ids = set()
+        play_orders = set()
+        for nav_point in root.getiterator(NCX_NS + 'navPoint'):
+            nav_id = nav_point.get('id')
+            if nav_id in ids:
+                self.error(ncx_path, 'The id %s is used by more than one navPoint.' % nav_id)
+            ids.add(nav_id)
+            play_order = nav_point.get('playOrder')
+            if play_order is not None:
+                if play_order in play_orders:
+                    self.warning(ncx_path, 'The playOrder %s is used by more than one navPoint.' % play_order)
+                play_orders.add(play_order)
+            content = nav_point.find(NCX_NS + 'content')
+            if content is None or not content.get('src'):
+                self.error(ncx_path, 'The navPoint %s has no content.' % nav_id)
+            elif self.resolve(ncx_path, content.get('src')) not in paths:
+                self.error(ncx_path, 'The navPoint %s refers to %s, which is not in the manifest.' % (nav_id, content.get('src')))
+
+    def check_well_formed(self, path):
+        # Expat is used directly, rather than ElementTree, because the named
+        # entities of XHTML (&nbsp; ...) are declared in its external DTD.
+        parser = expat.ParserCreate()
+        try:
+            parser.Parse(self.zf.read(path), True)
+        except expat.ExpatError, e:
+            self.error(path, 'Not well-formed: %s' % e)
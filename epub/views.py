@@ -1,4 +1,70 @@
-from django.shortcuts import render_to_response
-from django.http import HttpResponseRedirect, HttpResponseForbidden, Http404
-from django.template import RequestContext
-from django.utils.translation import ugettext, ugettext_lazy as _
+from email.Utils import parsedate_tz, mktime_tz
+
+from django.conf import settings
+from django.core.urlresolvers import get_callable
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.template.defaultfilters import slugify
+from django.utils.http import http_date, parse_etags, quote_etag
+
+from epub.downloads import get_archive, get_default_archive_cache
+
+def download(request, provider=None, filename=None, archive_cache=None, **kwargs):
+    """
+    Sends an ePub as a download. The ePub comes from ``provider``, a callable
+    called with the request and the other keyword arguments of the view, that
+    returns an :class:`EPub` or raises ``Http404``. It should only add the
+    articles and images, not render anything, and give the book a unique id
+    that stays the same from one request to the next.
+    
+    When the :class:`EPub` has a fingerprint (every article has a
+    ``content_hash``), the finished archive is kept in ``archive_cache`` and
+    sent with an ``ETag`` and a ``Last-Modified`` date, and a client that has
+    it already gets a ``304 Not Modified``. Otherwise it is generated for
+    every request.
+    
+    :param provider: The callable, or its dotted path. **Default:** the
+                     ``EPUB_PROVIDER`` setting.
+    :param filename: The name the file is saved as. **Default:** the title of
+                     the ePub.
+    :param archive_cache: An :class:`epub.downloads.ArchiveCache`.
+                          **Default:** a :class:`epub.downloads.FileArchiveCache`
+                          in the ``EPUB_ARCHIVE_CACHE_DIR`` directory.
+    """
+    if provider is None:
+        provider = getattr(settings, 'EPUB_PROVIDER', None)
+        if provider is None:
+            raise Http404("No EPUB_PROVIDER is configured.")
+    provider = get_callable(provider)
+    if archive_cache is None:
+        archive_cache = get_default_archive_cache()
+    
+    epub = provider(request, **kwargs)
+    if not filename:
+        filename = '%s.epub' % (slugify(epub.metadata.title) or 'book')
+    
+    fingerprint = epub.get_fingerprint()
+    if fingerprint is None:
+        response = HttpResponse(epub.iter_epub(), mimetype='application/epub+zip')
+    else:
+        etag = quote_etag(fingerprint)
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match and (fingerprint in parse_etags(if_none_match) or '*' in parse_etags(if_none_match)):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+        
+        archive = get_archive(epub, archive_cache, fingerprint)
+        if_modified_since = request.META.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and not if_none_match:
+            since = parsedate_tz(if_modified_since)
+            if since is not None and int(archive.modified) <= mktime_tz(since):
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+        
+        response = HttpResponse(archive.open(), mimetype='application/epub+zip')
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(archive.modified)
+        response['Content-Length'] = str(archive.size)
+    response['Content-Disposition'] = 'attachment; filename=%s' % filename
+    return response
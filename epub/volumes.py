@@ -0,0 +1,175 @@
+"""
+Splitting a very large ePub into volumes.
+
+A year of a daily edition can hold tens of thousands of articles: too many
+for reading systems, and too many to build in one go. With
+:meth:`EPub.generate_volumes` the articles are split, in order, into volumes
+of at most ``max_articles`` articles or about ``max_size`` bytes. Each volume
+is a complete ePub with its own package file, NCX and contents page::
+
+    reports = e.generate_volumes('/srv/epub/2009-vol%d.epub', max_articles=500)
+
+Each volume holds only the images and files its articles refer to, as
+``../<name>`` in the article's XHTML: in an attribute, quoted or not, or in
+a CSS ``url()``. Images and files that no article refers to that way, such
+as those only an added stylesheet or font file refers to, go into the last
+volume; add them to every volume's articles explicitly if earlier volumes
+need them.
+
+The articles are rendered and compressed in order, and only those of the
+volume being filled are kept, so the memory used is bounded by one volume
+however many articles there are.
+
+Every volume has the metadata of the whole ePub, with:
+
+* the volume number appended to the title, as in ``Daily Times, Volume 2``
+* ``-vol<number>`` appended to the unique identifier
+* the unique identifier of the whole ePub as a ``dc:relation``
+* a ``volume`` meta element holding the volume number
+"""
+import os
+import re
+import zipfile
+import zlib
+
+from epub.archive import EPubZipFile, ZipStream
+from epub.records import Article
+from epub.report import BuildReport
+
+
+class _VolumeEntries(object):
+    """
+    The compressed articles of the volume being filled, copied into its
+    archive like the entries of a reopened book.
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def add(self, zinfo, data):
+        self.entries[zinfo.filename] = (zinfo, data)
+
+    def copy_entry(self, name, date_time, arcname=None):
+        # Each entry goes into one volume only, so its ZipInfo is not copied
+        return self.entries[name]
+
+
+def get_volume_metadata(metadata, number):
+    """
+    Returns a copy of ``metadata``, an :class:`epub.models.EPubMetadata`, for
+    the volume ``number``.
+    """
+    volume = metadata.copy()
+    unique_id = metadata.unique_id
+    volume.set_unique_id('%s-vol%d' % (unique_id['value'], number), unique_id['id'], unique_id['opf:scheme'])
+    volume.add_relation(unique_id['value'])
+    volume.add_meta('volume', str(number))
+    if metadata.title:
+        volume.title = u'%s, Volume %d' % (metadata.title, number)
+    return volume
+
+
+class VolumeBuilder(object):
+    """
+    Writes the volumes of ``epub``. See :meth:`EPub.generate_volumes`.
+    """
+    def __init__(self, epub, filepath, max_articles=None, max_size=None):
+        if not max_articles and not max_size:
+            raise ValueError("A volume needs a max_articles or a max_size.")
+        if not isinstance(filepath, basestring) and not callable(filepath):
+            raise TypeError("The path of the volumes must be a string or a callable.")
+        self.epub = epub
+        self.filepath = filepath
+        self.max_articles = max_articles
+        self.max_size = max_size
+        self.sources = epub._get_sources()
+        assets = epub.images + epub.files
+        self.assets = dict([(asset['href'], asset) for asset in assets])
+        self.pattern = None
+        if assets:
+            hrefs = sorted(self.assets.keys(), key=len, reverse=True)
+            # Any ../<href> not followed by more of a name
+            self.pattern = re.compile(r'\.\./(%s)(?![\w.\-/])' % '|'.join([re.escape(href) for href in hrefs]))
+
+    def get_filepath(self, number):
+        if isinstance(self.filepath, basestring):
+            return self.filepath % number
+        return self.filepath(number)
+
+    def get_asset_size(self, asset):
+        if asset.get('source') is not None:
+            return asset['source'].getinfo(asset['dest']).compress_size
+        return os.path.getsize(asset['orig'])
+
+    def get_references(self, zinfo, data):
+        """
+        Returns the hrefs of the images and files the article ``zinfo``
+        refers to.
+        """
+        if self.pattern is None:
+            return set()
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            data = zlib.decompress(data, -15)
+        return set([match.group(1) for match in self.pattern.finditer(data)])
+
+    def generate(self, workers=None, callback=None):
+        """
+        :returns: The :class:`epub.report.BuildReport` of each volume
+        """
+        epub = self.epub
+        epub._check_sources(None, self.sources)
+        # Only lends its compression policy and timestamp to the articles,
+        # so that every volume has the same ones
+        entries_archive = EPubZipFile(ZipStream(), epub.date_time, epub.compression)
+        reports = []
+        referenced = set()
+        articles, hrefs, size = [], set(), 0
+        volume = _VolumeEntries()
+        pending = iter(epub.articles)
+        for zinfo, data, stats in epub._article_entries(entries_archive, workers):
+            article = pending.next()
+            references = self.get_references(zinfo, data) - hrefs
+            added = zinfo.compress_size + sum([self.get_asset_size(self.assets[href]) for href in references])
+            if articles and ((self.max_articles and len(articles) >= self.max_articles) or
+                    (self.max_size and size + added > self.max_size)):
+                reports.append(self.write_volume(len(reports) + 1, articles, hrefs, entries_archive.date_time, callback))
+                referenced.update(hrefs)
+                articles, hrefs, size = [], set(), 0
+                volume = _VolumeEntries()
+                references = self.get_references(zinfo, data)
+                added = zinfo.compress_size + sum([self.get_asset_size(self.assets[href]) for href in references])
+            volume.add(zinfo, data)
+            articles.append(Article(**dict(article, content=None, source=volume)))
+            hrefs.update(references)
+            size += added
+        if articles or not reports:
+            # Whatever no article refers to is kept with the last volume
+            hrefs.update(set(self.assets.keys()) - referenced - hrefs)
+            reports.append(self.write_volume(len(reports) + 1, articles, hrefs, entries_archive.date_time, callback))
+        return reports
+
+    def write_volume(self, number, articles, hrefs, date_time, callback):
+        from epub.models import EPub
+        epub = self.epub
+        volume = EPub(epub.templates, epub.template_keys)
+        for attr in ('image_pipeline', 'compression', 'validator', 'contents_page_size'):
+            setattr(volume, attr, getattr(epub, attr))
+        volume._metadata = get_volume_metadata(epub.metadata, number)
+        volume.articles = articles
+        volume.asset_aliases = epub.asset_aliases
+        volume.images = [image for image in epub.images if image['href'] in hrefs]
+        volume.files = [item for item in epub.files if item['href'] in hrefs]
+
+        filepath = self.get_filepath(number)
+        epub._check_sources(filepath, self.sources)
+        report = BuildReport()
+        archive, copy = volume._open_archive(filepath, date_time)
+        try:
+            for arcname in volume._write_epub(archive, None, None, report, callback):
+                pass
+        except:
+            archive.close()
+            volume._discard_copy(copy)
+            raise
+        archive.close()
+        volume._finish(report, filepath, copy)
+        return report
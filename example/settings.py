@@ -83,3 +83,6 @@ INSTALLED_APPS = (
     'simplestory',
     'django.contrib.admin',
 )
+
+# Where epub.views.download gets its ePubs from
+EPUB_PROVIDER = 'simplestory.views.edition'
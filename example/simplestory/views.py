@@ -1 +1,27 @@
-# Create your views here.
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor
+
+from epub.models import EPub
+from simplestory.models import Story
+
+def edition(request, slug):
+    """
+    Provides the ePub of all the stories to ``epub.views.download``. The
+    stories are only read when the ePub is generated.
+    """
+    e = EPub()
+    # The identifier must not change, or neither will the fingerprint
+    e.metadata.set_unique_id(value='dailytimes-%s' % slug, id='BookId')
+    e.metadata.title = slug.replace('-', ' ').title()
+    e.metadata.publisher = "Daily Times Publishing Inc"
+    e.add_articles_from_queryset(Story.objects.order_by('id'))
+    # Hash the fields the article template renders, so an edited story gets
+    # a new content_hash: it is rendered again and the ePub is built again
+    hashes = {}
+    fields = Story.objects.values_list('pk', 'headline', 'subhead', 'byline', 'story')
+    for row in fields.iterator():
+        hashes[row[0]] = sha_constructor(smart_str(u'\0'.join(row[1:]))).hexdigest()
+    for article in e.articles:
+        # A story added since has no hash, and the ePub no fingerprint
+        article['content_hash'] = hashes.get(article['content'].pk)
+    return e